@@ -17,6 +17,8 @@ from medis.params import mp, ap, iop, sp, tp
 from medis.utils import dprint
 from medis.plot_tools import view_spectra
 from medis.telescope import Telescope
+import medis.chunking as chunking
+import medis.optics as opx
 from medis.plot_tools import grid, quick2D
 
 
@@ -162,7 +164,16 @@ class Camera():
         return {'photons': self.photons, 'rebinned_cube': self.rebinned_cube}
 
     def quantize(self, fields, abs_step=0):
-        self.rebinned_cube = np.abs(np.sum(fields[:, -1], axis=2)) ** 2  # select detector plane and sum over objects
+        size = opx.plane_size('detector')
+        detector = fields[:, -1]
+        lo = detector.shape[-1] // 2 - size // 2
+        detector = detector[..., lo:lo + size, lo:lo + size]  # the plane is zero padded when others are saved larger
+        detector = opx.interp_wavelength(detector, ax=1)  # fields left at ap.n_wvl_init by ap.interp_on_read
+        if opx.plane_spec('detector')['intensity']:
+            self.rebinned_cube = np.sum(detector.real, axis=2)  # already saved as intensity so only sum over objects
+        else:
+            # the objects are incoherent so their intensities are summed (see opx.cpx_to_intensity)
+            self.rebinned_cube = np.sum(opx.cpx_to_intensity(detector), axis=2)
         self.rebinned_cube = self.rescale_cube(self.rebinned_cube)  # interpolate onto pixel spacing
 
         if sp.quick_detect and self.product == 'rebinned_cube':
@@ -236,29 +247,29 @@ class Camera():
         """
         Determines the maximum duration each chunk can be to fit within the memory limit
 
+        The estimate uses the photon density of datacube (including dark and hot counts) and the peak memory of
+        get_photons. See chunking.photons_plan
+
         :return: integer
         """
-
-        # max_counts = 50e6
         num_events = self.num_from_cube(datacube)
-        self.photons_size = num_events * 32  # in Bytes (verified using photons[:,0].nbytes)
+        extra_events = 0
+        if mp.bad_pix and mp.dark_counts:
+            extra_events += self.total_dark
+        if mp.bad_pix and mp.hot_pix:
+            extra_events += self.total_hot
 
-        max_chunk = sp.memory_limit*1e9 / self.photons_size
-        # max_chunk = 1
-        print(f'This observation will produce {num_events} photons, which is {self.photons_size/1e9} GB, meaning no '
-              f'more than {max_chunk} of this observation can fit in the memory at one time')
-        max_chunk = min([len(datacube)*max_chunk, len(datacube)])
+        plan = chunking.photons_plan(num_events, datacube.shape, extra_events=extra_events)
+        self.photons_size = plan['photons_size']  # in Bytes (verified using photons[:,0].nbytes)
+
+        max_chunk = plan['max_steps']
+        print(f'This observation will produce {num_events} photons, which is {self.photons_size/1e9} GB and needs '
+              f'{plan["step_bytes"]/1e6} MB per timestep while sampling, meaning no more than {max_chunk} timesteps '
+              f'of this observation can fit in the memory at one time')
 
         if round_chunk:
             # get nice max cut
-            round_nums = [1, 2, 5]
-            nice_cut = 0
-            i = 0
-            while nice_cut <= max_chunk:
-                nice_cut = round_nums[i % len(round_nums)] * 10 ** (i // len(round_nums))  # [1,2,5,10,20,50,100,200,...]
-                i += 1
-
-            max_chunk = round_nums[(i - 2) % len(round_nums)] * 10 ** ((i - 2) // len(round_nums))  # we want the nice value thats below max_chunk so go back 2
+            max_chunk = chunking.nice_chunk(max_chunk)
 
         print(f'Input cubes will be split up into time length {max_chunk}')
 
@@ -960,11 +971,32 @@ class Camera():
                     photons[:,:,x*npixcounts:(x+1)*npixcounts,y*npixcounts:(y+1)*npixcounts] = [x,y]
 
     def rescale_cube(self, rebinned_cube, conserve=True):
+        """
+        interpolates the focal plane cube onto the MKID pixels
+
+        With sp.focal_mft the fields were propagated straight onto the sp.mft_grid pixels (see
+        optics.Wavefronts.mft_focal_plane). If that grid is at the MKID platescale the array is only cut out of it and
+        no interpolation is done. The bin and downsample of sp.save_specs['detector'] make the saved pixels that many
+        propagated pixels across
+        """
+        spec = opx.plane_spec('detector')
+        step = spec['bin'] * spec['downsample']
+        if sp.focal_mft:
+            platescale = opx.mft_grid()[1] * step
+            n = rebinned_cube.shape[-1]
+            if np.isclose(platescale, self.platescale) and n >= np.max(self.array_size):
+                lo = n // 2 - np.array(self.array_size) // 2
+                return rebinned_cube[..., lo[0]:lo[0] + self.array_size[0], lo[1]:lo[1] + self.array_size[1]]
+
         if conserve:
             total = np.sum(rebinned_cube)
-        nyq_sampling = ap.wvl_range[0]*360*3600/(4*np.pi*tp.entrance_d) # 1/2 lambda/pi converted to rad
-        self.sampling = 2*nyq_sampling*sp.beam_ratio  # sample at 2x nyquist, scaled by beam_ratio
-        x = np.arange(-sp.grid_size*self.sampling/2, sp.grid_size*self.sampling/2, self.sampling)
+        if sp.focal_mft:
+            self.sampling = platescale
+        else:
+            nyq_sampling = ap.wvl_range[0]*360*3600/(4*np.pi*tp.entrance_d) # 1/2 lambda/pi converted to rad
+            self.sampling = 2*nyq_sampling*sp.beam_ratio*step  # sample at 2x nyquist, scaled by beam_ratio
+        n = rebinned_cube.shape[-1]
+        x = np.arange(-n*self.sampling/2, n*self.sampling/2, self.sampling)[:n]
         xnew = np.arange(-self.array_size[0]*self.platescale/2, self.array_size[0]*self.platescale/2, self.platescale)
         ynew = np.arange(-self.array_size[1]*self.platescale/2, self.array_size[1]*self.platescale/2, self.platescale)
         mkid_cube = np.zeros((rebinned_cube.shape[0], rebinned_cube.shape[1], self.array_size[0], self.array_size[1]))
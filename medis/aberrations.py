@@ -13,7 +13,9 @@ import numpy as np
 import proper
 import os
 import pickle
+import hashlib
 
+import medis.static_optics as static
 from medis.params import iop
 from medis.utils import *
 
@@ -21,6 +23,55 @@ from medis.utils import *
 ################################################################################################################
 # Aberrations
 ################################################################################################################
+loaded_maps = {}  # aberration maps held in memory (eg shipped once to pool workers) keyed by their filename
+
+
+def map_key(lens):
+    """
+    hash of everything the aberration map of a lens is made from: the grid, the beam ratio and the lens diameter, PSD
+    values and name. The name also seeds the random phase so lenses with the same PSD get different maps
+
+    :param lens: dict of tp.lens_params
+    :return: str
+    """
+    recipe = [sp.grid_size, float(sp.beam_ratio), float(lens['diam']), [float(v) for v in lens['aber_vals']],
+              lens['name']]
+    return hashlib.sha1(pickle.dumps(recipe, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()[:16]
+
+
+def map_filename(lens_name, aberdir=None):
+    """
+    the FITS file of the aberration map of a lens in tp.lens_params, named <lens_name>_<map_key>.fits so the maps in
+    iop.aberdir can be shared by every test and every number of timesteps. Lenses that aren't in tp.lens_params fall
+    back to the old t0_<lens_name>.fits
+
+    :param lens_name: name of the lens
+    :param aberdir: directory of the aberration maps. Defaults to iop.aberdir
+    :return: str
+    """
+    if aberdir is None:
+        aberdir = iop.aberdir
+    for lens in tp.lens_params or []:
+        if lens['name'] == lens_name:
+            return os.path.join(aberdir, f'{lens_name}_{map_key(lens)}.fits')
+    return os.path.join(aberdir, f't0_{lens_name}.fits')
+
+
+def load_maps(aberdir=None):
+    """
+    reads the aberration maps of tp.lens_params into loaded_maps so add_aber doesn't have to open the FITS files each
+    call
+
+    :param aberdir: directory of the aberration maps. Defaults to iop.aberdir
+    :return: loaded_maps dict
+    """
+    for lens in tp.lens_params or []:
+        filename = map_filename(lens['name'], aberdir)
+        if os.path.exists(filename):
+            loaded_maps[filename] = readFITS(filename)
+    return loaded_maps
+
+
 def generate_maps(aber_vals, lens_diam, lens_name='lens', quasi_static=False):
     """
     generate PSD-defined aberration maps for a lens(mirror) using Proper
@@ -43,8 +94,8 @@ def generate_maps(aber_vals, lens_diam, lens_name='lens', quasi_static=False):
         Manual pg 56
     :param lens_diam: diameter of the lens/mirror to generate an aberration map for
     :param lens_name: name of the lens, for file naming
-    :return: will create a FITs file in the folder specified by iop.quasi for each optic (and  timestep in the case
-     of quasi-static aberrations)
+    :return: will create a FITs file (see map_filename) in iop.aberdir for each optic (and  timestep in the case
+     of quasi-static aberrations). Maps that already exist are kept
     """
     # TODO add different timescale aberations
     if sp.verbose: dprint(f'Generating optic aberration maps using Proper at directory {iop.aberdir}')
@@ -54,6 +105,10 @@ def generate_maps(aber_vals, lens_diam, lens_name='lens', quasi_static=False):
         print('aberration maps should be created at the beginng, not on the fly')
         os.makedirs(iop.aberdir, exist_ok=True)
 
+    filename = map_filename(lens_name)
+    if os.path.isfile(filename):
+        return
+
     # create blank lens wavefront for proper to add phase to
     wfo = proper.prop_begin(lens_diam, 1., sp.grid_size, sp.beam_ratio)
     aber_cube = np.zeros((1, sp.grid_size, sp.grid_size))
@@ -68,18 +123,26 @@ def generate_maps(aber_vals, lens_diam, lens_name='lens', quasi_static=False):
     # perms = np.random.rand(sp.numframes, sp.grid_size, sp.grid_size)-0.5
     # perms *= 1e-7
 
-    phase = 2 * np.pi * np.random.uniform(size=(sp.grid_size, sp.grid_size)) - np.pi
-    aber_cube[0] = proper.prop_psd_errormap(wfo, rms_error, c_freq, high_power, TPF=True, PHASE_HISTORY=phase)
+    # np.random is seeded by the map key so the same lens always gets the same map. PROPER draws the random phase of
+    # the map from np.random unless it is patched to take PHASE_HISTORY, so the seed covers the call too. The state of
+    # np.random is put back afterwards so the rest of the simulation isn't tied to the map key
+    state = np.random.get_state()
+    np.random.seed(int(map_key({'name': lens_name, 'diam': lens_diam, 'aber_vals': aber_vals}), 16) % 2**32)
+    try:
+        phase = 2 * np.pi * np.random.uniform(size=(sp.grid_size, sp.grid_size)) - np.pi
+        aber_cube[0] = proper.prop_psd_errormap(wfo, rms_error, c_freq, high_power, TPF=True, PHASE_HISTORY=phase)
+    finally:
+        np.random.set_state(state)
         # PHASE_HISTORY stuff is a kwarg Rupert added to a proper.prop_pds_errormap in proper_mod that helps
         #  ennable the small perturbations to the phase aberrations over time (quasi-static aberration evolution)
         #  however, this may not be implemented here, and the functionality may not be robust. It has yet to be
         #  verified in a robust manner. However, I am not sure it is being used....? KD 10-15-19
     # TODO verify this and add qusi-static functionality
 
-    filename = f"{iop.aberdir}/t{0}_{lens_name}.fits"
-    #dprint(f"filename = {filename}")
-    if not os.path.isfile(filename):
-        saveFITS(aber_cube[0], filename)
+    # written to a temporary file so a map is only in the cache once it is complete
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    saveFITS(aber_cube[0], tmp)
+    os.replace(tmp, filename)
 
     if quasi_static:
         # todo implement monkey patch of proper.prop_psd_error that return phase too so it can be incremented with correlated gaussian noise
@@ -108,16 +171,23 @@ def add_aber(wf, aberdir=None, step=0, lens_name=None):
         # Load in or Generate Aberration Map
         # iop.aberdata = f"gridsz{sp.grid_size}_bmratio{sp.beam_ratio}_tsteps{sp.numframes}"
         # iop.aberdir = os.path.join(iop.testdir, iop.aberroot, iop.aberdata)
-        filename = f"{iop.aberdir}/t{0}_{lens_name}.fits"
+        filename = map_filename(lens_name)
         # print(f'Adding Abberations from {filename}')
 
         # if not os.path.isfile(filename):
         #     generate_maps(aber_vals, d_lens, lens_name)
 
-        phase_map = readFITS(filename)
+        if filename in loaded_maps:
+            phase_map = loaded_maps[filename]
+        else:
+            phase_map = readFITS(filename)
         proper.prop_add_phase(wf, phase_map)     # Add Phase Map
 
 
+# the same map is applied every timestep so add_aber can be folded into a static segment
+static.register(add_aber)
+
+
 def add_zern_ab(wf, zern_order=[2,3,4], zern_vals=np.array([175,-150,200])*1.0e-9):
     """
     adds low-order aberrations from Zernike polynomials
@@ -7,29 +7,31 @@ Contains functions that will create, load, save, and apply atmospheric maps
 """
 import numpy as np
 import os
-import astropy.io.fits as fits
-import hcipy
+import pickle
+import hashlib
+import multiprocessing
+import threading
+import tables
 import proper
-from skimage.restoration import unwrap_phase
 # from mkidpipeline.speckle.genphotonlist_IcIsIr import corrsequence
-from scipy import special
+from scipy import special, signal
 
 from medis.params import iop, ap, tp, sp, atmp
-from medis.utils import dprint, clipped_zoom
+from medis.utils import dprint, clipped_zoom, h5_lock
 from medis.optics import circular_mask
 
-def recursion(r,g, f, sqrt1mf2, n):
-    for i in range(1, n):
-        r[i] = r[i - 1]*f + g[i]*sqrt1mf2
-    return r
+_engine = {}  # the ScreenEngine of this process and the params it was made with
+_step_cache = {'key': None}  # OPD screens of the last timestep read from the store, shared by add_atmos calls for
+                             # every wavelength and body of that timestep in this process
+_engine_lock = threading.Lock()  # guards _engine, _step_cache and the block cache of the ScreenEngine for the threads
+                                 # of sp.collection_mode='thread' when atmp.on_the_fly is set
 
 def corrsequence(Ttot, tau):
     """
     Generate a sequence of correlated Gaussian noise, correlation time
     tau.  Algorithm is recursive and from Markus Deserno.  The
-    recursion is implemented as an explicit for loop but has a lower
-    computational cost than converting uniform random variables to
-    modified-Rician random variables.
+    recursion r[i] = f r[i-1] + sqrt(1 - f^2) g[i] is an AR(1) process
+    so it is applied as a linear filter rather than a python loop.
 
     Arguments:
     Ttot: int, the total integration time in microseconds.
@@ -43,120 +45,392 @@ def corrsequence(Ttot, tau):
 
     t = np.arange(Ttot)
     g = np.random.normal(0, 1, Ttot)
-    r = np.zeros(g.shape)
     f = np.exp(-1. / tau)
     sqrt1mf2 = np.sqrt(1 - f ** 2)
-    r = recursion(r, g, f, sqrt1mf2, g.shape[0])
+    g[0] = 0  # the sequence starts at r[0] = 0
+    r = signal.lfilter([sqrt1mf2], [1, -f], g)
 
     return t, r
 
+
+def layer_profile(model=None):
+    """
+    heights [m], velocities [m/s] and integrated Cn^2 [m^(1/3)] of the layers of an atmosphere model
+
+    :param model: 'single', 'hcipy_standard' or 'evolving'. Defaults to atmp.model
+    :return: three lists, one entry per layer
+    """
+    if model is None:
+        model = atmp.model
+    if model == 'single':
+        heights, velocities, Cn_squared = [atmp.h], [atmp.vel], [atmp.cn_sq]
+    elif model == 'hcipy_standard':
+        # Make multi-layer atmosphere
+        # layers = hcipy.make_standard_atmospheric_layers(pupil_grid, atmp.L0)
+        heights = np.array([500, 1000, 2000, 4000, 8000, 16000])
+        velocities = np.array([10, 10, 10, 10, 10, 10])
+        Cn_squared = np.array([0.2283, 0.0883, 0.0666, 0.1458, 0.3350, 0.1350]) * 3.5e-12
+    elif model == 'evolving':
+        raise NotImplementedError
+    return heights, velocities, Cn_squared
+
+
+def sample_times(n_frames, debug=False):
+    """
+    time [s] of each timestep. With atmp.correlated_sampling the steps are random, drawn from np.random
+
+    :param n_frames: number of timesteps
+    :return: (n_frames,) array
+    """
+    if atmp.correlated_sampling:
+        # Damage Detection and Localization from Dense Network of Strain Sensors
+
+        # fancy sampling goes here
+        normal = corrsequence(n_frames, atmp.tau/sp.sample_time)[1] * atmp.std
+        uniform = (special.erf(normal / np.sqrt(2)) + 1)
+
+        times = np.cumsum(uniform) * sp.sample_time
+
+        if debug:
+            import matplotlib.pylab as plt
+            plt.plot(normal)
+            plt.figure()
+            plt.plot(uniform)
+            plt.figure()
+            plt.hist(uniform)
+            plt.figure()
+            plt.plot(np.arange(0, n_frames * sp.sample_time, sp.sample_time))
+            plt.plot(times)
+            plt.show()
+    else:
+        times = np.arange(n_frames) * sp.sample_time
+
+    return times
+
+
 def gen_atmos(plot=False, debug=True):
     """
-    generates atmospheric phase distortions using hcipy (updated from original using CAOS)
+    generates the atmospheric OPD maps of the store (see get_store)
 
-    read more on HCIpy here: https://hcipy.readthedocs.io/en/latest/index.html
-    In hcipy, the atmosphere evolves as a function of time, specified by the user. User can thus specify the
-    timescale of evolution through both velocity of layer and time per step in the obs_sequence, in loop for
-    medis_main.gen_timeseries().
+    The layers of layer_profile() are moved with frozen flow through the timesteps of sample_times. hcipy extends the
+    screen of a layer with random rows as it moves, so its layers have to be stepped through every timestep from t=0.
+    The maps are made by the ScreenEngine instead, whose screen at a timestep only depends on the seed and the time
+
+    The store holds the timesteps from 0, so runs starting at sp.startframe need sp.startframe + sp.numframes of
+    them. Only the ones missing from an existing store are made and appended to it, with the seed it was made with.
+    They are split into sp.num_processes segments of consecutive timesteps that are made in parallel (see
+    _gen_segment) and appended to the store in order. The frozen flow is continuous across the segments and the
+    maps are the same however many processes make them and however many appends they are made in. np.random is
+    left as it was
 
     :param plot: turn plotting on or off
     :return:
-
-    todo add simple mp.Pool.map code to make maps in parrallel
     """
-    if tp.use_atmos is False:
-        pass  # only make new atmosphere map if using the atmosphere
+    if tp.use_atmos is False or atmp.on_the_fly:
+        pass  # only make new atmosphere map if using the atmosphere and not making it in memory (ScreenEngine)
     else:
+        filename = get_store()
+        n_frames = sp.startframe + sp.numframes
+        n_stored, seed = stored_frames(filename)
+        if n_stored >= n_frames:
+            return
+
+        if sp.verbose: dprint(f"Making New Atmosphere Model for timesteps {n_stored} to {n_frames}")
+
+        if seed is None:
+            seed = engine_seed()  # the same screens as atmp.on_the_fly
+
+        # the times are drawn the same way by the ScreenEngine, this is only for the debug plots
+        if debug and atmp.correlated_sampling:
+            state = np.random.get_state()
+            np.random.seed(seed)
+            try:
+                sample_times(n_frames, debug)
+            finally:
+                np.random.set_state(state)
+
+        if sp.verbose: dprint(f"atmos store = {filename}")
+        # the segments are written to temporary files so the store only ever holds complete timesteps
+        params = {name: dict(params.__dict__) for params, name in zip([sp, tp, atmp], ['sp', 'tp', 'atmp'])}
+        segments = np.array_split(np.arange(n_stored, n_frames), min(max(sp.num_processes, 1), n_frames - n_stored))
+        jobs = [(params, seed, segment[0], segment[-1] + 1, f'{filename}.{os.getpid()}.{iseg}.tmp')
+                for iseg, segment in enumerate(segments)]
+        if len(jobs) == 1:
+            _gen_segment(jobs[0])
+        else:
+            with multiprocessing.Pool(processes=len(jobs)) as pool:
+                pool.map(_gen_segment, jobs)
+
+        tmp = f'{filename}.{os.getpid()}.tmp' if n_stored == 0 else filename
+        with tables.open_file(tmp, mode='a', title='MEDIS Atmosphere Store') as h5file:
+            if n_stored == 0:
+                opd = h5file.create_earray(h5file.root, 'opd', atom=tables.Float32Atom(),
+                                           shape=(0, sp.grid_size, sp.grid_size),
+                                           chunkshape=(1, sp.grid_size, sp.grid_size), expectedrows=n_frames,
+                                           title='OPD [m] (timestep, x, y)')
+                h5file.root._v_attrs.pixsize = tp.entrance_d/sp.grid_size
+                h5file.root._v_attrs.sample_time = sp.sample_time
+                h5file.root._v_attrs.model = atmp.model
+                h5file.root._v_attrs.seed = seed
+            else:
+                opd = h5file.root.opd
+                opd.truncate(n_stored)  # drops the timesteps of an append that didn't finish
+
+            try:
+                for job in jobs:
+                    with tables.open_file(job[-1], mode='r') as segment:
+                        for it, screen in enumerate(segment.root.opd, job[2]):
+                            opd.append(screen[np.newaxis])
+
+                            if plot:
+                                import matplotlib.pyplot as plt
+                                from medis.twilight_colormaps import sunlight
+                                plt.figure()
+                                plt.title(f"Atmosphere OPD Map timestep {it}")
+                                plt.imshow(screen, cmap=sunlight)
+                                plt.colorbar()
+                                plt.show(block=True)
+            finally:
+                for job in jobs:
+                    if os.path.exists(job[-1]):
+                        os.remove(job[-1])
+            h5file.root._v_attrs.n_frames = n_frames
+        if n_stored == 0:
+            os.replace(tmp, filename)
+
+
+def stored_frames(filename):
+    """
+    number of complete timesteps in an atmosphere store and the seed it was made with
+
+    :param filename: the store, see get_store
+    :return: (n_frames, seed), or (0, None) if there is no store
+    """
+    if not os.path.exists(filename):
+        return 0, None
+    with tables.open_file(filename, mode='r') as h5file:
+        attrs = h5file.root._v_attrs
+        n_frames = attrs.n_frames if 'n_frames' in attrs else len(h5file.root.opd)
+        return int(n_frames), int(attrs.seed)
 
-        if sp.verbose: dprint("Making New Atmosphere Model")
-        # Saving Parameters
-        # np.savetxt(iop.atmosconfig, ['Grid Size', 'Wvl Range', 'Number of Frames', 'Layer Strength', 'Outer Scale', 'Velocity', 'Scale Height', cp.model])
-        # np.savetxt(iop.atmosconfig, ['ap.grid_size', 'ap.wvl_range', 'ap.numframes', 'atmp.cn_sq', 'atmp.L0', 'atmp.vel', 'atmp.h', 'cp.model'])
-        # np.savetxt(iop.atmosconfig, [ap.grid_size, ap.wvl_range, ap.numframes, atmp.cn_sq, atmp.L0, atmp.vel, atmp.h, cp.model], fmt='%s')
-
-        wsamples = np.linspace(ap.wvl_range[0], ap.wvl_range[1], ap.n_wvl_init)
-        wavefronts = []
-
-        ##################################
-        # Initiate HCIpy Atmosphere Type
-        ##################################
-        pupil_grid = hcipy.make_pupil_grid(sp.grid_size, tp.entrance_d)
-        if atmp.model == 'single':
-            layers = [hcipy.InfiniteAtmosphericLayer(pupil_grid, atmp.cn_sq, atmp.L0, atmp.vel, atmp.h, 2)]
-        elif atmp.model == 'hcipy_standard':
-            # Make multi-layer atmosphere
-            # layers = hcipy.make_standard_atmospheric_layers(pupil_grid, atmp.L0)
-            heights = np.array([500, 1000, 2000, 4000, 8000, 16000])
-            velocities = np.array([10, 10, 10, 10, 10, 10])
-            Cn_squared = np.array([0.2283, 0.0883, 0.0666, 0.1458, 0.3350, 0.1350]) * 3.5e-12
-
-            layers = []
-            for h, v, cn in zip(heights, velocities, Cn_squared):
-                layers.append(hcipy.InfiniteAtmosphericLayer(pupil_grid, cn, atmp.L0, v, h, 2))
-
-        elif atmp.model == 'evolving':
-            raise NotImplementedError
-        atmos = hcipy.MultiLayerAtmosphere(layers, scintilation=False)
-
-        for wavelength in wsamples:
-            wavefronts.append(hcipy.Wavefront(hcipy.Field(np.ones(pupil_grid.size), pupil_grid), wavelength))
 
+def _gen_segment(job):
+    """
+    makes the OPD maps of timesteps first to last-1 for gen_atmos and writes them to their own file
+
+    :param job: (params, seed, first, last, filename) where params holds the sp, tp and atmp dicts of the parent
+    """
+    params, seed, first, last, filename = job
+    for singleton, name in zip([sp, tp, atmp], ['sp', 'tp', 'atmp']):
+        singleton.__dict__.update(params[name])
+
+    engine = ScreenEngine(seed)
+    with tables.open_file(filename, mode='w', title='MEDIS Atmosphere Segment') as h5file:
+        opd = h5file.create_earray(h5file.root, 'opd', atom=tables.Float32Atom(),
+                                   shape=(0, sp.grid_size, sp.grid_size),
+                                   chunkshape=(1, sp.grid_size, sp.grid_size), expectedrows=last - first,
+                                   title='OPD [m] (timestep, x, y)')
+        for it in range(first, last):
+            opd.append(engine.opd(it)[np.newaxis])
+
+
+class ScreenEngine():
+    """
+    Frozen flow OPD screens of the atmp.model layers made in memory for any timestep, used by add_atmos in place of the
+    store when atmp.on_the_fly is set
+
+    Each layer is an endless strip along its direction of flow (x) made of square FFT screens (white noise filtered by
+    the von Karman spectrum of the OPD) of side block_size. Consecutive blocks overlap by a quarter of a block and are
+    cross faded with cos/sin weights so that the strip is continuous and keeps its variance. The frequencies below
+    those of a block are added as three levels of subharmonics (Lane et al. 1992). These are sums of sinusoids so
+    they are continuous along the whole strip. Each block is drawn from its own generator, seeded by the engine seed,
+    the layer and the block, so any timestep can be made without the ones before it, and only block_cache_size
+    blocks per layer are held. The pupil moves v t along each strip and is sampled with linear interpolation, so the
+    shift needn't be a whole number of pixels
+
+    gen_atmos writes the screens of the same seed to the store, so reading the store and making them on the fly
+    give the same maps
+
+    :param seed: int seed of the screens
+    """
+    block_cache_size = 4  # blocks held per layer
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.n = sp.grid_size
+        self.dx = tp.entrance_d / sp.grid_size
+        self.block_size = int(2**np.ceil(np.log2(self.n + 2)))
+        self.overlap = self.block_size // 4
+        self.stride = self.block_size - self.overlap
+
+        _, velocities, Cn_squared = layer_profile()
+        self.velocities = np.asarray(velocities, dtype=float)
+        self.Cn_squared = np.asarray(Cn_squared, dtype=float)
+        self.blocks = [{} for _ in self.velocities]
+        self.subharmonics = [self.make_subharmonics(il) for il in range(len(self.velocities))]
+
+        self.times = None
         if atmp.correlated_sampling:
-            # Damage Detection and Localization from Dense Network of Strain Sensors
-
-            # fancy sampling goes here
-            normal = corrsequence(sp.numframes, atmp.tau/sp.sample_time)[1] * atmp.std
-            uniform = (special.erf(normal / np.sqrt(2)) + 1)
-
-            times = np.cumsum(uniform) * sp.sample_time
-
-            if debug:
-                import matplotlib.pylab as plt
-                plt.plot(normal)
-                plt.figure()
-                plt.plot(uniform)
-                plt.figure()
-                plt.hist(uniform)
-                plt.figure()
-                plt.plot(np.arange(0, sp.numframes * sp.sample_time, sp.sample_time))
-                plt.plot(times)
-                plt.show()
-        else:
-            times = np.arange(0, sp.numframes * sp.sample_time, sp.sample_time)
-
-        ###########################################
-        # Evolving Wavefront using HCIpy tools
-        ###########################################
-        for it, t in enumerate(times):
-            atmos.evolve_until(t)
-            for iw, wf in enumerate(wavefronts):
-                wf2 = atmos.forward(wf)
-
-                filename = get_filename(it, wsamples[iw], (iop.atmosdir, sp.sample_time,
-                                                           atmp.model))
-                if sp.verbose: dprint(f"atmos file = {filename}")
-                hdu = fits.ImageHDU(wf2.phase.reshape(sp.grid_size, sp.grid_size))
-                hdu.header['PIXSIZE'] = tp.entrance_d/sp.grid_size
-                hdu.writeto(filename, overwrite=True)
-
-                if plot and iw == 0:
-                    import matplotlib.pyplot as plt
-                    from medis.twilight_colormaps import sunlight
-                    plt.figure()
-                    plt.title(f"Atmosphere Phase Map t={t} lambda={eformat(wsamples[iw], 3, 2)}")
-                    hcipy.imshow_field(wf2.phase, cmap=sunlight)
-                    plt.colorbar()
-                    plt.show(block=True)
+            self.extend_times(sp.startframe + sp.numframes)
+
+    def psd(self, f2, il):
+        """ von Karman power spectrum of the OPD of layer il [m^4] at squared spatial frequency f2 [m^-2] """
+        # the phase spectrum 0.023 r0^(-5/3) (f^2 + 1/L0^2)^(-11/6) over k^2, with r0^(-5/3) = 0.423 k^2 Cn^2
+        return 0.023 * 0.423 * self.Cn_squared[il] * (f2 + 1. / atmp.L0**2)**(-11 / 6)
+
+    def make_subharmonics(self, il):
+        """ frequencies (n, 2) [m^-1] and complex amplitudes (n,) [m] of the subharmonics of layer il """
+        rng = np.random.default_rng([self.seed, il, 0])
+        freqs, amps = [], []
+        for p in range(1, 4):
+            df = 1. / (3**p * self.block_size * self.dx)
+            for fx in [-1, 0, 1]:
+                for fy in [-1, 0, 1]:
+                    if fx == 0 and fy == 0:
+                        continue
+                    f = np.array([fx, fy]) * df
+                    freqs.append(f)
+                    amps.append(np.sqrt(self.psd(f @ f, il)) * df * (rng.standard_normal() +
+                                                                      1j * rng.standard_normal()))
+        return np.array(freqs), np.array(amps)
+
+    def block(self, il, ib):
+        """ the (block_size, block_size) FFT screen [m] of block ib of layer il """
+        cache = self.blocks[il]
+        if ib not in cache:
+            rng = np.random.default_rng([self.seed, il, 1, ib % 2**32])
+            m = self.block_size
+            f = np.fft.fftfreq(m, self.dx)
+            amplitude = np.sqrt(self.psd(f[:, np.newaxis]**2 + f[np.newaxis, :]**2, il)) / (m * self.dx)
+            amplitude[0, 0] = 0  # no piston
+            noise = rng.standard_normal((m, m)) + 1j * rng.standard_normal((m, m))
+            if len(cache) >= self.block_cache_size:
+                cache.pop(next(iter(cache)))
+            cache[ib] = (np.real(np.fft.ifft2(noise * amplitude)) * m**2).astype(np.float32)
+        return cache[ib]
+
+    def strip(self, il, first, last):
+        """ columns first to last-1 of the strip of layer il, cross fading the overlaps of consecutive blocks """
+        cols = np.arange(first, last)
+        blocks = cols // self.stride
+        q = cols - blocks * self.stride  # column within its block
+        out = np.empty((self.block_size, len(cols)), dtype=np.float32)
+        for ib in np.unique(blocks):
+            here = blocks == ib
+            out[:, here] = self.block(il, ib)[:, q[here]]
+            fade = here & (q < self.overlap)
+            if np.any(fade):
+                theta = np.pi / 2 * (q[fade] + 0.5) / self.overlap
+                out[:, fade] = self.block(il, ib - 1)[:, q[fade] + self.stride] * np.cos(theta) + \
+                               out[:, fade] * np.sin(theta)
+        return out
+
+    def extend_times(self, n_frames):
+        """
+        draws the correlated sample times of the first n_frames timesteps from the seed. The draws for fewer
+        timesteps are the start of those for more, so the times already used don't change. np.random is left as it was
+        """
+        state = np.random.get_state()
+        np.random.seed(self.seed)
+        try:
+            self.times = sample_times(n_frames)
+        finally:
+            np.random.set_state(state)
+
+    def time(self, it):
+        if self.times is None:
+            return it * sp.sample_time
+        if it >= len(self.times):
+            self.extend_times(max(it + 1, 2 * len(self.times)))
+        return self.times[it]
+
+    def opd(self, it):
+        """
+        the OPD [m] over the pupil at timestep it
+
+        :return: (sp.grid_size, sp.grid_size) float32 array
+        """
+        n = self.n
+        x = (np.arange(n) - n // 2) * self.dx
+        lo = self.block_size // 2 - n // 2
+        screen = np.zeros((n, n))
+        for il, velocity in enumerate(self.velocities):
+            shift = velocity * self.time(it) / self.dx  # pixels the layer has moved along x
+            whole = int(np.floor(shift))
+            frac = shift - whole
+            segment = self.strip(il, whole - n // 2, whole - n // 2 + n + 1)[lo:lo + n]
+            screen += segment[:, :n] * (1 - frac) + segment[:, 1:] * frac
+
+            freqs, amps = self.subharmonics[il]
+            along = np.exp(2j * np.pi * np.outer(freqs[:, 0], x + shift * self.dx))
+            across = np.exp(2j * np.pi * np.outer(freqs[:, 1], x))
+            screen += np.real((amps[:, np.newaxis] * across).T @ along)
+        return screen.astype(np.float32)
+
+
+def engine_seed():
+    """
+    seed of the ScreenEngine screens. atmp.seed, or when that is None a seed made from the store_key of the params,
+    so that every process (eg pool workers) makes the same screens without atmp.seed being changed
+
+    :return: int
+    """
+    if atmp.seed is not None:
+        return atmp.seed
+    return int(store_key(), 16) % (2**31 - 64)
+
+
+def get_engine():
+    """ the ScreenEngine of this process, remade if the atmosphere params have changed """
+    seed = engine_seed()
+    key = (seed, sp.grid_size, tp.entrance_d, sp.sample_time, atmp.model, atmp.cn_sq, atmp.L0, atmp.vel,
+           atmp.correlated_sampling, atmp.tau, atmp.std)
+    if _engine.get('key') != key:
+        _engine['engine'] = ScreenEngine(seed)
+        _engine['key'] = key
+    return _engine['engine']
+
+
+def load_step(it, param_tup=None):
+    """
+    the atmosphere at timestep it, read from the store (or made by the ScreenEngine when atmp.on_the_fly is set) once
+    and then kept in memory for the wavelengths and bodies of the timestep
+
+    :param it: timestep# in obs_sequence
+    :param param_tup: (atmosdir, sample_time, model) of the store. Defaults to iop, sp and atmp
+    :return: OPD [m] (x, y) float32 array
+    """
+    if atmp.on_the_fly:
+        with _engine_lock:
+            engine = get_engine()
+            key = ('engine', _engine['key'], it)  # a new engine (eg the params changed) makes new screens
+            if _step_cache['key'] != key:
+                _step_cache['opd'] = engine.opd(it)
+                _step_cache['key'] = key
+            return _step_cache['opd']
+
+    filename = get_store(param_tup)
+    with h5_lock:  # PyTables isn't thread safe, see utils.h5_lock
+        if _step_cache['key'] != (filename, it):
+            if not os.path.exists(filename):
+                # todo remove when all test scripts use the new format
+                print('atmospheres should be created at the beginng, not on the fly')
+                raise NotImplementedError
+            with tables.open_file(filename, mode='r') as h5file:
+                _step_cache['opd'] = h5file.root.opd[it]
+            _step_cache['key'] = (filename, it)
+        return _step_cache['opd']
 
 
 def add_atmos(wf, it, param_tup=None, spatial_zoom=False):
     """
     creates a phase offset matrix for each wavelength at each time step,
-    sampled from the atmosphere generated by hcipy
+    sampled from the atmosphere made by the ScreenEngine
 
-    HCIpy generates an atmosphere with given parameters. The returned field is in units of phase delay for each
-    wavelength. prop_add_phase wants the phase delay to be in units of meters for each wavelength, so we convert to
-    meters via the wavelength/np.pi
+    Without scintillation the optical path difference of the atmosphere is the same at every wavelength so gen_atmos
+    stores a single map in meters per timestep (see load_step), which is what prop_add_phase wants, and PROPER turns
+    it into the phase delay of each wavelength. With atmp.on_the_fly the map is made in memory by the ScreenEngine
+    instead
 
     :param wf: a single (2D) wfo.wf_collection[iw,ib] at one wavelength and object
     :param it: timestep# in obs_sequence. Comes from medis_main.gen_timeseries()
@@ -168,17 +442,7 @@ def add_atmos(wf, it, param_tup=None, spatial_zoom=False):
     else:
         wavelength = wf.lamda  # the .lamda comes from proper, not from Wavefronts class
 
-        # Check for Existing File)
-        atmos_map = get_filename(it, wavelength, param_tup)
-        if not os.path.exists(atmos_map):
-            # todo remove when all test scripts use the new format
-            # TODO check for new file name convention in addition to directory name
-            print('atmospheres should be created at the beginng, not on the fly')
-            raise NotImplementedError
-
-        atm_map = fits.open(atmos_map)[1].data
-        atm_map = unwrap_phase(atm_map)
-        atm_map *= wavelength/(2*np.pi)  # converts atmosphere in units of phase delay (rad) into distance (m)
+        atm_map = np.array(load_step(it, param_tup), dtype=np.float64)  # a copy so the cached map is left alone
 
         if spatial_zoom:
             scale = ap.wvl_range[0] / wavelength
@@ -199,36 +463,38 @@ def rotate_atmos(wf, it):
     wf.wfarr = proper.prop_shift_center(wf.wfarr)
 
 
-def eformat(wvl, prec, exp_digits):
+def store_key(sample_time=None, model=None):
     """
-    reformats wavelength into scientific notation in meters
-
-    :param wvl: wavelength float
-    :param prec: precision
-    :param exp_digits: number of digits in the exponent
-    :return:
+    hash of everything the atmosphere maps are made from: the grid, the pupil, the sample time, the layers of the
+    model, the outer scale, the correlated sampling, the seed and the generator. The number of timesteps isn't in it
+    since stores are appended to (see gen_atmos), and the seed is left out when atmp.seed is None so any store of these
+    params is used
+
+    :param sample_time: defaults to sp.sample_time
+    :param model: defaults to atmp.model
+    :return: str
     """
-    s = "%.*e" % (prec, wvl)
-    mantissa, exp = s.split('e')
-    # add 1 to digits as 1 is taken by sign +/-
-    return "%se%+0*d" % (mantissa, exp_digits + 1, int(exp))
+    sample_time = sp.sample_time if sample_time is None else sample_time
+    model = atmp.model if model is None else model
+    layers = [[float(value) for value in values] for values in layer_profile(model)]
+    sampling = [atmp.tau, atmp.std] if atmp.correlated_sampling else None
+    recipe = [sp.grid_size, float(tp.entrance_d), float(sample_time), model, layers, float(atmp.L0), sampling,
+              atmp.seed, 'ScreenEngine']  # stores made by stepping hcipy layers aren't appended to
+    return hashlib.sha1(pickle.dumps(recipe, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()[:16]
 
 
-def get_filename(it, lamda, param_tup=None):
+def get_store(param_tup=None):
     """
-    returns the atmosphere map names in the format location/atmos_t<time>_<model>_wvl<wavelength>
-    example output:
+    returns the name of the atmosphere store in the format location/atmos_<model>_<store_key>.h5, which holds
+    the OPD map of every timestep. iop.atmosdir is shared by every test so a store is reused by any run with the same
+    atmosphere
 
-    :param it: time index
-    :param lamda: wavelength, comes from metadata in proper wavefront object (ie wfo.wf_collection.lamda)
+    :param param_tup: (atmosdir, sample_time, model). Defaults to iop, sp and atmp
     :return:
     """
-    wave = eformat(lamda, 3, 2)
     if param_tup:
         atmosdir, sample_time, model = param_tup
     else:
         atmosdir, sample_time, model = iop.atmosdir, sp.sample_time, atmp.model
 
-    sigfig = int(np.abs(np.floor(np.log10(sp.sample_time))))
-
-    return f'{atmosdir}/atmos_t{sample_time*it:.6f}_{model}_wvl{wave}.fits'
\ No newline at end of file
+    return f'{atmosdir}/atmos_{model}_{store_key(sample_time, model)}.h5'
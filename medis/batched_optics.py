@@ -0,0 +1,262 @@
+"""
+batched_optics.py
+
+Vectorised versions of the PROPER operations used most by the prescriptions. They act on the contiguous
+(n_wavelengths, n_astro_bodies, grid_size, grid_size) stack that optics.Wavefronts holds when sp.batched_wavefronts is
+set, instead of calling PROPER once per wavelength and body.
+
+The wavefronts in wf_collection keep their wfarr as views into the stack so any function without a batched version
+still runs on them through loop_collection unchanged. The PROPER beam state (sampling, position, Gaussian beam
+parameters and reference surface) is the same for every body at a given wavelength. It is handled per wavelength
+here and copied onto every wavefront of that wavelength after each operation.
+
+Operations that multiply the field by a map depending only on the beam state (apertures, obscurations, lenses and
+phase maps) are applied by running the PROPER function once per wavelength on a probe wavefront of ones. The map
+it leaves behind is then multiplied onto all the bodies at once. The maps and the beam state they produce are cached
+between timesteps whenever the arguments are hashable. Propagation is reimplemented with the same near/far field
+selection as prop_propagate (prop_ptp, prop_wts and prop_stw) and FFTs over the whole stack, done by the
+sp.fft_engine backend (see fft_engine.py).
+"""
+
+import copy
+import inspect
+import numpy as np
+import proper
+
+import medis.fft_engine as fft_engine
+
+# beam attributes of proper.WaveFront shared by all the bodies at one wavelength
+state_attrs = ['lamda', 'dx', 'z', 'z_w0', 'w0', 'z_Rayleigh', 'beam_type_old', 'reference_surface',
+               'propagator_type', 'current_fratio']
+
+factor_cache_size = 32  # maximum number of probe maps kept between timesteps
+_factor_cache = {}
+
+batched_ops = {}  # {function called by loop_collection: batched version taking the Wavefronts instead}
+propagation_ops = set()  # functions routed here whenever sp.fft_engine is set, even without sp.batched_wavefronts
+
+
+def register(func, batched):
+    """ loop_collection will call batched(wfo, *args, **kwargs) on the stack in place of func """
+    batched_ops[func] = batched
+
+
+def supports(func, args, kwargs):
+    """ whether func has a batched version that accepts these arguments """
+    if func not in batched_ops:
+        return False
+    try:
+        inspect.signature(batched_ops[func]).bind(None, *args, **kwargs)
+    except TypeError:
+        return False
+    return True
+
+
+def get_state(wfo, iw):
+    """ beam state of wavelength iw as a dict """
+    wf = wfo.wf_collection[iw, 0]
+    return {attr: getattr(wf, attr) for attr in state_attrs if hasattr(wf, attr)}
+
+
+def set_state(wfo, iw, state):
+    """ copy a beam state onto every body at wavelength iw """
+    for wf in wfo.wf_collection[iw]:
+        for attr, value in state.items():
+            setattr(wf, attr, value)
+
+
+def state_array(wfo, attr):
+    """ one attribute of the beam state of every wavelength as an array """
+    return np.array([getattr(wfo.wf_collection[iw, 0], attr) for iw in range(wfo.stack.shape[0])])
+
+
+def set_state_array(wfo, attr, values):
+    for iw, value in enumerate(values):
+        for wf in wfo.wf_collection[iw]:
+            setattr(wf, attr, value.item() if isinstance(value, np.generic) else value)
+
+
+def _cache_key(func, args, kwargs, state, shape):
+    key = (func, args, tuple(sorted(kwargs.items())), tuple(sorted(state.items())), shape)
+    try:
+        hash(key)
+    except TypeError:  # eg a phase map passed as an array
+        return None
+    return key
+
+
+def multiplicative(func, cache=True):
+    """
+    batched version of a PROPER style function that only multiplies wfarr by a map set by its arguments and the beam
+    state, and possibly updates the beam state (eg prop_lens)
+
+    :param func: function(wf, *args, **kwargs)
+    :param cache: keep the maps between calls. Turn this off for functions that depend on anything other than their
+        arguments and the beam state
+    :return: function(wfo, *args, **kwargs)
+    """
+    def batched(wfo, *args, **kwargs):
+        n_wvl, _, nx, ny = wfo.stack.shape
+        factors = np.empty((n_wvl, nx, ny), dtype=wfo.stack.dtype)
+        for iw in range(n_wvl):
+            state = get_state(wfo, iw)
+            key = _cache_key(func, args, kwargs, state, (nx, ny)) if cache else None
+            if key is not None and key in _factor_cache:
+                factors[iw], new_state = _factor_cache[key]
+            else:
+                probe = copy.copy(wfo.wf_collection[iw, 0])
+                probe.wfarr = np.ones((nx, ny), dtype=wfo.stack.dtype)
+                func(probe, *args, **kwargs)
+                factors[iw] = probe.wfarr
+                new_state = {attr: getattr(probe, attr) for attr in state}
+                if key is not None:
+                    if len(_factor_cache) >= factor_cache_size:
+                        _factor_cache.pop(next(iter(_factor_cache)))
+                    _factor_cache[key] = (factors[iw].copy(), new_state)
+            set_state(wfo, iw, new_state)
+
+        wfo.stack *= factors[:, np.newaxis]
+
+    batched.__name__ = func.__name__
+    batched.__signature__ = inspect.signature(func)
+    return batched
+
+
+def define_entrance(wfo):
+    """ batched proper.prop_define_entrance: normalise each wavefront to a total intensity of 1 """
+    total = np.sum(np.abs(wfo.stack)**2, axis=(-2, -1))
+    proper.total_original_pupil = total[-1, -1]
+    wfo.stack /= np.sqrt(total)[..., np.newaxis, np.newaxis]
+
+
+def _shifted_coords(n):
+    """ pixel coordinates along one axis of a PROPER wfarr, which is stored with the beam centre at [0, 0] """
+    return np.fft.ifftshift(np.arange(n) - n // 2)
+
+
+def _rsqr(dx, n):
+    """ (n_wvl, n, n) squared radius of each pixel for each wavelength's sampling """
+    x = _shifted_coords(n)
+    r2 = x[:, np.newaxis]**2 + x[np.newaxis, :]**2
+    return np.asarray(dx)[:, np.newaxis, np.newaxis]**2 * r2
+
+
+def _fft(fields, sign):
+    """ forward FFT for propagation in +z and inverse for -z, normalised so the total intensity is kept """
+    if sign >= 0:
+        return fft_engine.fft2(fields, norm='ortho')
+    return fft_engine.ifft2(fields, norm='ortho')
+
+
+def _phase_offset(wfo, state, dz, active):
+    """ the phase of the propagation distance that PROPER adds when proper.phase_offset is set """
+    if getattr(proper, 'phase_offset', False):
+        offset = np.exp(2j * np.pi * dz[active] / state['lamda'][active])
+        wfo.stack[active] *= offset[:, np.newaxis, np.newaxis, np.newaxis]
+
+
+def _ptp(wfo, state, dz, active):
+    """ planar to planar (angular spectrum) propagation by dz of the wavelengths in active """
+    active = active & (np.abs(dz) >= 1e-12)
+    if not np.any(active):
+        return
+    n = wfo.stack.shape[-1]
+    f2 = _rsqr(1. / (n * state['dx'][active]), n)
+    transfer = np.exp(-1j * np.pi * (state['lamda'][active] * dz[active])[:, np.newaxis, np.newaxis] * f2)
+    wfo.stack[active] = fft_engine.ifft2(fft_engine.fft2(wfo.stack[active]) * transfer[:, np.newaxis])
+    _phase_offset(wfo, state, dz, active)
+    state['z'][active] += dz[active]
+
+
+def _wts(wfo, state, dz, active):
+    """ planar reference at the waist to spherical reference at dz """
+    state['reference_surface'][active] = 'SPHERI'  # as prop_wts, even when dz is 0
+    active = active & (np.abs(dz) >= 1e-12)
+    if not np.any(active):
+        return
+    n = wfo.stack.shape[-1]
+    rsqr = _rsqr(state['dx'][active], n)
+    quad = np.exp(1j * np.pi / (state['lamda'][active] * dz[active])[:, np.newaxis, np.newaxis] * rsqr)
+    fields = wfo.stack[active] * quad[:, np.newaxis]
+    for sign in [1, -1]:
+        direction = np.sign(dz[active]) == sign
+        fields[direction] = _fft(fields[direction], sign)
+    wfo.stack[active] = fields
+    _phase_offset(wfo, state, dz, active)
+    state['dx'][active] = state['lamda'][active] * np.abs(dz[active]) / (n * state['dx'][active])
+    state['z'][active] += dz[active]
+
+
+def _stw(wfo, state, dz, active):
+    """ spherical reference to planar reference at the waist dz away """
+    active = active & (np.abs(dz) >= 1e-12)
+    if not np.any(active):
+        return
+    n = wfo.stack.shape[-1]
+    fields = wfo.stack[active]
+    for sign in [1, -1]:
+        direction = np.sign(dz[active]) == sign
+        fields[direction] = _fft(fields[direction], sign)
+    state['dx'][active] = state['lamda'][active] * np.abs(dz[active]) / (n * state['dx'][active])
+    rsqr = _rsqr(state['dx'][active], n)
+    quad = np.exp(1j * np.pi / (state['lamda'][active] * dz[active])[:, np.newaxis, np.newaxis] * rsqr)
+    wfo.stack[active] = fields * quad[:, np.newaxis]
+    _phase_offset(wfo, state, dz, active)
+    state['z'][active] += dz[active]
+    state['reference_surface'][active] = 'PLANAR'
+
+
+def propagate(wfo, dz, surface_name=''):
+    """
+    batched proper.prop_propagate
+
+    As in PROPER the propagator is chosen per wavelength from whether the start and end are within
+    proper.rayleigh_factor Rayleigh distances of the beam waist (INSIDE_) or not (OUTSIDE)
+
+    :param wfo: optics.Wavefronts with a stack
+    :param dz: distance in m
+    :param surface_name: unused, kept for the PROPER signature
+    """
+    state = {attr: state_array(wfo, attr) for attr in ['lamda', 'dx', 'z', 'z_w0', 'z_Rayleigh', 'beam_type_old',
+                                                      'reference_surface']}
+    for attr in ['lamda', 'dx', 'z', 'z_w0', 'z_Rayleigh']:
+        state[attr] = state[attr].astype(float)  # prop_begin starts z at an int 0
+    state['reference_surface'] = state['reference_surface'].astype(object)
+    dz = np.full(len(state['z']), float(dz))
+
+    rayleigh_factor = getattr(proper, 'rayleigh_factor', 1.)
+    old_inside = state['beam_type_old'] == 'INSIDE_'
+    new_inside = np.abs(state['z_w0'] - (state['z'] + dz)) < rayleigh_factor * state['z_Rayleigh']
+    to_waist = state['z_w0'] - state['z']
+    from_waist = state['z'] + dz - state['z_w0']
+
+    _ptp(wfo, state, np.where(new_inside, dz, to_waist), old_inside)
+    _stw(wfo, state, to_waist, ~old_inside)
+    _ptp(wfo, state, from_waist, ~old_inside & new_inside)
+    _wts(wfo, state, from_waist, ~new_inside)
+
+    beam_type_new = np.where(new_inside, 'INSIDE_', 'OUTSIDE').astype(object)
+    set_state_array(wfo, 'propagator_type', state['beam_type_old'].astype(object) + '_to_' + beam_type_new)
+    set_state_array(wfo, 'beam_type_old', beam_type_new)
+    for attr in ['dx', 'z', 'reference_surface']:
+        set_state_array(wfo, attr, state[attr])
+
+
+def lens_then_propagate(lens):
+    """ batched optics.prop_pass_lens from the batched lens """
+    def pass_lens(wfo, fl_lens, dist):
+        lens(wfo, fl_lens)
+        propagate(wfo, dist)
+    return pass_lens
+
+
+lens = multiplicative(proper.prop_lens)
+
+register(proper.prop_circular_aperture, multiplicative(proper.prop_circular_aperture))
+register(proper.prop_circular_obscuration, multiplicative(proper.prop_circular_obscuration))
+register(proper.prop_rectangular_obscuration, multiplicative(proper.prop_rectangular_obscuration))
+register(proper.prop_add_phase, multiplicative(proper.prop_add_phase))
+register(proper.prop_lens, lens)
+register(proper.prop_define_entrance, define_entrance)
+register(proper.prop_propagate, propagate)
+propagation_ops.add(proper.prop_propagate)
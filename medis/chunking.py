@@ -0,0 +1,165 @@
+"""
+chunking.py
+
+Models the memory and file footprint of the fields and photon products so that Telescope and Camera can choose time
+chunks that use as much of sp.memory_limit as possible without running out of memory.
+
+The byte counts follow what the code actually allocates: the dtype of each array, the copies made along the way
+(wavelength interpolation, the background writer queue, the photon sampling temporaries), the propagation state held by
+each worker process and the largest block HDF5 will write in one go.
+"""
+
+import numpy as np
+
+import medis.optics as opx
+from medis.params import sp, ap
+
+h5_chunk_limit = 4 * 2**30  # [bytes] h5 won't let you save chunks larger than 4 GB
+
+# bytes held per photon at the peak of Camera.get_photons. Distribution.__call__ holds the uniform draws (8), the flat
+# indices (8), the unravelled indices (4x8), their vstack (4x8) and the float copy (4x8). The returned (4, n) float64
+# photon list (32) is what survives
+photon_peak_bytes = 8 + 8 + 32 + 32 + 32
+photon_bytes = 32
+
+# bytes per voxel of the datacube handed to Distribution: the float64 cube itself, the argsort indices, the sorted pdf
+# and the cumulative sum
+voxel_bytes = 8 + 8 + 8 + 8
+
+
+def n_wvl_final():
+    """ number of wavelengths the fields have once they are interpolated, in create_fields or when read """
+    if ap.interp_wvl and isinstance(ap.n_wvl_final, int) and 1 < ap.n_wvl_init < ap.n_wvl_final:
+        return ap.n_wvl_final
+    return ap.n_wvl_init
+
+
+def n_wvl_saved():
+    """ number of wavelengths in the fields after any interpolation in Telescope.create_fields """
+    return ap.n_wvl_init if ap.interp_on_read else n_wvl_final()
+
+
+def timestep_bytes(n_wvl, dtype=None, n_planes=None, n_bodies=None, grid_size=None):
+    """
+    bytes of a single timestep of the 6D fields tensor
+
+    :param n_wvl: number of wavelengths
+    :param dtype: dtype of the array. Defaults to the saved dtype from sp.save_specs
+    :param grid_size: side of the saved planes. Defaults to the saved size from sp.save_specs
+    :return: int
+    """
+    dtype = opx.saved_dtype() if dtype is None else dtype
+    n_planes = len(sp.save_list) if n_planes is None else n_planes
+    n_bodies = 1 + len(ap.contrast) if n_bodies is None else n_bodies
+    grid_size = opx.saved_size() if grid_size is None else grid_size
+    return n_planes * n_wvl * n_bodies * grid_size**2 * np.dtype(dtype).itemsize
+
+
+def upcast_dtype():
+    """ the double precision version of the saved dtype, as held by timestep dependent runs """
+    return np.result_type(opx.saved_dtype(), np.float64)
+
+
+def worker_bytes():
+    """
+    bytes a single process needs to propagate one timestep, independent of the chunk length
+
+    PROPER holds each wavefront as complex128 and its FFTs and phase/amplitude helpers need a couple of temporary
+    copies, the saved planes are built up in optics.Wavefronts after reduction by sp.save_specs
+    """
+    n_bodies = 1 if sp.quick_companions else 1 + len(ap.contrast)  # quick companions are shifted copies of the star
+    wavefronts = 3 * ap.n_wvl_init * n_bodies * sp.grid_size**2 * np.dtype(np.complex128).itemsize
+    planes = timestep_bytes(ap.n_wvl_init)
+    return wavefronts + planes
+
+
+def fields_plan(markov=True, num_processes=None, memory_limit=None, save_to_disk=None):
+    """
+    Plans the time chunking of Telescope.create_fields
+
+    :param markov: timesteps are independent (chunked, saved dtype) or dependent (whole sequence held in double
+        precision)
+    :param num_processes: number of processes propagating timesteps. Defaults to sp.num_processes
+    :param memory_limit: GB available. Defaults to sp.memory_limit
+    :param save_to_disk: whether the chunks are written to fields.h5. Defaults to sp.save_to_disk
+    :return: dict with
+        'timestep_size' bytes of one saved timestep (what ends up in fields.h5)
+        'step_bytes' bytes of memory needed per timestep of a chunk including the transient copies
+        'fixed_bytes' memory needed regardless of chunk length
+        'max_steps' largest chunk that fits in memory and in an h5 chunk
+    """
+    num_processes = sp.num_processes if num_processes is None else num_processes
+    memory_limit = sp.memory_limit if memory_limit is None else memory_limit
+    save_to_disk = sp.save_to_disk if save_to_disk is None else save_to_disk
+
+    n_wvl_final = n_wvl_saved()
+    interpolated = n_wvl_final != ap.n_wvl_init
+
+    if markov:
+        propagated = timestep_bytes(ap.n_wvl_init)
+        # the interpolation keeps the saved dtype but both arrays are alive at the same time
+        timestep_size = timestep_bytes(n_wvl_final) if interpolated else propagated
+        step_bytes = propagated + (timestep_size if interpolated else 0)
+        if save_to_disk and sp.save_queue > 0:
+            # chunks waiting in the FieldsWriter queue plus the one being written
+            step_bytes += (sp.save_queue + 1) * timestep_size
+        if save_to_disk and sp.fields_codec is not None:
+            # int16 real and imaginary residuals of the chunk being encoded
+            step_bytes += timestep_bytes(n_wvl_final, np.int32)
+    else:
+        timestep_size = timestep_bytes(ap.n_wvl_init, upcast_dtype())
+        step_bytes = timestep_size
+
+    fixed_bytes = max(num_processes, 1) * worker_bytes()
+
+    budget = memory_limit * 1e9 - fixed_bytes
+    max_steps = max(int(budget // step_bytes), 1)
+    if save_to_disk:
+        max_steps = min(max_steps, max(int(h5_chunk_limit // timestep_size), 1))
+
+    return {'timestep_size': timestep_size, 'step_bytes': step_bytes, 'fixed_bytes': fixed_bytes,
+            'max_steps': max_steps}
+
+
+def photons_plan(num_events, datacube_shape, memory_limit=None, extra_events=0):
+    """
+    Plans the time chunking of Camera.quantize from the photon density of the rebinned cube
+
+    :param num_events: number of photons the whole datacube will produce
+    :param datacube_shape: shape of the rebinned cube (n_timesteps, n_wavelengths, x, y)
+    :param memory_limit: GB available. Defaults to sp.memory_limit
+    :param extra_events: photons not drawn from the cube (dark and hot pixel counts). Camera.degrade_photons adds all of
+        these to every chunk so they are a fixed cost rather than a density
+    :return: dict with 'photons_size' bytes of the final photon list, 'step_bytes' peak bytes per timestep and
+        'max_steps' the largest number of timesteps that fit
+    """
+    memory_limit = sp.memory_limit if memory_limit is None else memory_limit
+    numframes = datacube_shape[0]
+
+    events_per_step = num_events / numframes
+    voxels_per_step = np.prod(datacube_shape[1:])
+    step_bytes = events_per_step * photon_peak_bytes + voxels_per_step * voxel_bytes
+
+    cube_bytes = np.prod(datacube_shape) * 8  # the full float64 cube stays in memory while it is sampled
+    budget = memory_limit * 1e9 - cube_bytes - extra_events * photon_peak_bytes
+    max_steps = int(min(max(budget // step_bytes, 1), numframes))
+
+    return {'photons_size': (num_events + extra_events) * photon_bytes, 'step_bytes': step_bytes,
+            'max_steps': max_steps}
+
+
+def nice_chunk(max_chunk):
+    """
+    rounds down to the nearest of [1, 2, 5, 10, 20, 50, 100, 200, ...]
+
+    :param max_chunk: int
+    :return: int
+    """
+    round_nums = [1, 2, 5]
+    nice_cut = 0
+    i = 0
+    while nice_cut <= max_chunk:
+        nice_cut = round_nums[i % len(round_nums)] * 10 ** (i // len(round_nums))  # [1,2,5,10,20,50,100,200,...]
+        i += 1
+
+    return round_nums[(i - 2) % len(round_nums)] * 10 ** ((i - 2) // len(round_nums))  # we want the nice value thats below max_chunk so go back 2
@@ -0,0 +1,132 @@
+"""
+fft_engine.py
+
+FFT backends for the propagation done by MEDIS, selected with sp.fft_engine
+
+    None      PROPER does its own propagation FFTs (numpy, or FFTW if proper.prop_use_fftw has been run)
+    'numpy'   numpy.fft
+    'scipy'   scipy.fft with sp.fft_workers threads
+    'pyfftw'  pyFFTW plans with sp.fft_workers threads. Plans are made once per (shape, dtype, direction, norm) and
+              reused every timestep. The wisdom gathered making them is kept in iop.fftw_wisdom so later runs on the
+              same machine and grid size skip the planning
+
+When sp.fft_engine is set, loop_collection hands proper.prop_propagate and optics.prop_pass_lens to the batched
+propagator in batched_optics, which does its FFTs through fft2 and ifft2 here. For 'pyfftw', PROPER is also switched
+to its own FFTW interface for this process (see configure_proper) for the FFTs done inside other PROPER routines.
+"""
+
+import os
+import pickle
+import inspect
+import numpy as np
+import proper
+
+from medis.params import sp, iop
+
+engines = [None, 'numpy', 'scipy', 'pyfftw']
+
+_plans = {}  # {(shape, dtype, direction, norm, threads): pyfftw.FFTW} reused between calls and timesteps
+_wisdom = {'loaded': False, 'n_plans': 0}  # n_plans made since the wisdom was last saved
+_proper_fftw = {}  # proper.use_fftw before configure_proper first changed it
+
+
+def fft2(fields, norm=None):
+    """ forward 2D FFT over the last two axes with the sp.fft_engine backend. norm follows numpy.fft """
+    return _transform(fields, 'FFTW_FORWARD', norm)
+
+
+def ifft2(fields, norm=None):
+    """ inverse 2D FFT over the last two axes with the sp.fft_engine backend. norm follows numpy.fft """
+    return _transform(fields, 'FFTW_BACKWARD', norm)
+
+
+def _transform(fields, direction, norm):
+    forward = direction == 'FFTW_FORWARD'
+    if sp.fft_engine is None or sp.fft_engine == 'numpy':
+        return np.fft.fft2(fields, norm=norm) if forward else np.fft.ifft2(fields, norm=norm)
+    elif sp.fft_engine == 'scipy':
+        import scipy.fft
+        transform = scipy.fft.fft2 if forward else scipy.fft.ifft2
+        return transform(fields, norm=norm, workers=sp.fft_workers)
+    elif sp.fft_engine == 'pyfftw':
+        plan = get_plan(fields.shape, fields.dtype, direction, norm)
+        # the plan's output array is reused by the next call so hand back a copy
+        return plan(fields).copy()
+    else:
+        raise ValueError(f'sp.fft_engine must be one of {engines}, not {sp.fft_engine}')
+
+
+def get_plan(shape, dtype, direction, norm=None):
+    """
+    the cached pyFFTW plan for this transform, made (and the wisdom saved) the first time it is asked for
+
+    :param shape: shape of the arrays transformed over their last two axes
+    :param dtype: complex dtype
+    :param direction: 'FFTW_FORWARD' or 'FFTW_BACKWARD'
+    :param norm: None or 'ortho' as in numpy.fft
+    :return: pyfftw.FFTW
+    """
+    key = (tuple(shape), np.dtype(dtype), direction, norm, sp.fft_workers)
+    if key not in _plans:
+        import pyfftw
+        load_wisdom()
+        builder = pyfftw.builders.fft2 if direction == 'FFTW_FORWARD' else pyfftw.builders.ifft2
+        template = pyfftw.empty_aligned(shape, dtype=dtype)
+        # pyFFTW 0.13 replaced the ortho and normalise_idft arguments with norm as in numpy.fft
+        if 'norm' in inspect.signature(builder).parameters:
+            scaling = {'norm': norm}
+        else:
+            scaling = {'ortho': norm == 'ortho', 'normalise_idft': norm != 'ortho'}
+        _plans[key] = builder(template, axes=(-2, -1), threads=sp.fft_workers, planner_effort='FFTW_MEASURE',
+                              **scaling)
+        _wisdom['n_plans'] += 1
+        save_wisdom()
+    return _plans[key]
+
+
+def load_wisdom():
+    """ import the FFTW wisdom in iop.fftw_wisdom, once per process """
+    if _wisdom['loaded']:
+        return
+    import pyfftw
+    if os.path.exists(iop.fftw_wisdom):
+        with open(iop.fftw_wisdom, 'rb') as handle:
+            pyfftw.import_wisdom(pickle.load(handle))
+    _wisdom['loaded'] = True
+
+
+def save_wisdom():
+    """ write out the FFTW wisdom if new plans have been made since it was last saved """
+    if _wisdom['n_plans'] == 0:
+        return
+    import pyfftw
+    os.makedirs(os.path.dirname(iop.fftw_wisdom), exist_ok=True)
+    # pool workers may save at the same time so write to a private file and swap it in
+    tmp = f'{iop.fftw_wisdom}.{os.getpid()}'
+    with open(tmp, 'wb') as handle:
+        pickle.dump(pyfftw.export_wisdom(), handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, iop.fftw_wisdom)
+    _wisdom['n_plans'] = 0
+
+
+def configure_proper():
+    """
+    point PROPER's own FFTs at FFTW when sp.fft_engine is 'pyfftw', and back to how the session started otherwise.
+    Called by Telescope and its pool workers
+
+    This only sets proper.use_fftw for this process. proper.prop_use_fftw isn't used since it writes
+    ~/.proper_use_fftw, which switches every later PROPER session on the machine to FFTW
+    """
+    if sp.fft_engine not in engines:
+        raise ValueError(f'sp.fft_engine must be one of {engines}, not {sp.fft_engine}')
+    if 'use_fftw' not in _proper_fftw:
+        _proper_fftw['use_fftw'] = getattr(proper, 'use_fftw', False)
+
+    use_fftw = _proper_fftw['use_fftw']
+    if sp.fft_engine == 'pyfftw':
+        try:
+            import pyfftw
+            use_fftw = True
+        except ImportError as err:
+            print(f'PROPER could not be switched to FFTW ({err}). Only the MEDIS propagation will use pyFFTW')
+    proper.use_fftw = use_fftw
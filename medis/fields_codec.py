@@ -0,0 +1,214 @@
+"""
+fields_codec.py
+
+Optional temporal delta codec for fields.h5, selected with sp.fields_codec.
+
+When sp.sample_time is short compared to the atmosphere and aberration timescales, consecutive timesteps of the fields
+differ only slightly. Instead of the complex64 frames, the codec stores a keyframe every keyframe_interval timesteps and,
+in between, the difference to the previous decoded frame quantised to int16. The quantisation step is chosen so that
+|E - E_decoded| <= error_bound for every element. The residuals are mostly tiny integers that blosc compresses far
+better than the raw floats, so the arrays are blosc compressed (default_filters) unless sp.fields_storage sets the
+filters. Fields saved as intensity (real, see sp.save_specs) are encoded in the real domain with one residual per
+element instead of two.
+
+Encoding is closed loop (each residual is taken against the decoded previous frame) so errors do not accumulate along
+the sequence. A frame is stored as a keyframe when a residual doesn't fit in int16, at the start of each keyframe
+interval, and whenever the encoder has no previous frame (eg after resuming a run).
+
+h5 layout
+    /codec/residuals       int16 EArray (n_timesteps, ..., x, y, 2) real and imaginary quantised residuals, or
+                           (n_timesteps, ..., x, y, 1) for real fields
+    /codec/keyframes       complex64 (or float32 for real fields) EArray (n_keyframes, ..., x, y)
+    /codec/keyframe_index  int64 EArray (n_timesteps,) row in keyframes or -1 for delta frames
+"""
+
+import numpy as np
+import tables
+
+int16_max = np.iinfo(np.int16).max
+default_filters = tables.Filters(complevel=5, complib='blosc:lz4', shuffle=True)  # when sp.fields_storage is None
+
+
+class DeltaCodec():
+    """
+    Keeps the encoder state between the chunks of a run
+
+    :param error_bound: maximum error on the complex field amplitude |E| of any element
+    :param keyframe_interval: maximum number of timesteps between keyframes
+    """
+    def __init__(self, error_bound, keyframe_interval=100):
+        self.error_bound = error_bound
+        self.keyframe_interval = keyframe_interval
+        self.previous = None
+        self.since_keyframe = 0
+
+    def step(self, real):
+        """
+        quantisation step. Rounding the real and imaginary parts with error_bound*sqrt(2) gives |error| <= step/sqrt(2)
+        = error_bound, and rounding a real field with 2*error_bound gives |error| <= step/2 = error_bound
+        """
+        return 2 * self.error_bound if real else self.error_bound * np.sqrt(2)
+
+    def encode(self, fields, n_keyframes=0):
+        """
+        :param fields: complex or real array (n_timesteps, ..., x, y)
+        :param n_keyframes: number of keyframes already stored, used to offset keyframe_index
+        :return: residuals, keyframes, keyframe_index ready to be appended to the h5 arrays
+        """
+        real = not np.iscomplexobj(fields)
+        step = self.step(real)
+        work_dtype, stored_dtype = (np.float64, np.float32) if real else (np.complex128, np.complex64)
+        residuals = np.zeros(fields.shape + (1 if real else 2,), dtype=np.int16)
+        keyframe_index = np.full(len(fields), -1, dtype=np.int64)
+        keyframes = []
+
+        for it, frame in enumerate(fields):
+            frame = frame.astype(work_dtype)
+            keyframe = self.previous is None or self.since_keyframe >= self.keyframe_interval
+            if not keyframe:
+                delta = (frame - self.previous) / step
+                quantised = to_parts(np.round(delta.real), None if real else np.round(delta.imag))
+                keyframe = np.max(np.abs(quantised)) > int16_max
+            if keyframe:
+                keyframes.append(frame.astype(stored_dtype))
+                keyframe_index[it] = n_keyframes + len(keyframes) - 1
+                self.previous = keyframes[-1].astype(work_dtype)
+                self.since_keyframe = 1
+            else:
+                residuals[it] = quantised
+                self.previous = self.previous + from_parts(quantised) * step
+                self.since_keyframe += 1
+
+        keyframes = np.array(keyframes, dtype=stored_dtype).reshape((len(keyframes),) + fields.shape[1:])
+        return residuals, keyframes, keyframe_index
+
+
+def to_parts(real, imag=None):
+    """ stacks the quantised real (and imaginary) parts along a trailing axis """
+    return np.stack((real,) if imag is None else (real, imag), axis=-1)
+
+
+def from_parts(quantised):
+    """ the quantised residuals as real or complex numbers, in units of the step """
+    if quantised.shape[-1] == 1:
+        return quantised[..., 0]
+    return quantised[..., 0] + 1j * quantised[..., 1]
+
+
+def append(h5file, fields, codec, filters=None, chunkshape=None):
+    """
+    encode fields and append them to the /codec group of an open h5 file, creating it if necessary
+
+    :param h5file: tables.File open for writing
+    :param fields: complex or real array (n_timesteps, ..., x, y)
+    :param codec: DeltaCodec holding the encoder state of this run
+    :param filters: tables.Filters for the arrays (see telescope.storage_layout). Defaults to default_filters
+    :param chunkshape: chunkshape of the fields. The residuals get an extra trailing axis for the real and
+        imaginary parts
+    """
+    if '/codec' not in h5file:
+        real = not np.iscomplexobj(fields)
+        n_parts = 1 if real else 2
+        filters = default_filters if filters is None else filters
+        group = h5file.create_group('/', 'codec', 'Keyframes and quantised residuals of the fields')
+        frame_shape = fields.shape[1:]
+        h5file.create_earray(group, 'residuals', atom=tables.Int16Atom(), shape=(0,) + frame_shape + (n_parts,),
+                             filters=filters,
+                             chunkshape=None if chunkshape is None else tuple(chunkshape) + (n_parts,))
+        keyframe_atom = tables.Float32Atom() if real else tables.ComplexAtom(itemsize=8)
+        h5file.create_earray(group, 'keyframes', atom=keyframe_atom, shape=(0,) + frame_shape,
+                             filters=filters, chunkshape=chunkshape)
+        h5file.create_earray(group, 'keyframe_index', atom=tables.Int64Atom(), shape=(0,))
+        group._v_attrs.step = codec.step(real)
+        group._v_attrs.error_bound = codec.error_bound
+        group._v_attrs.keyframe_interval = codec.keyframe_interval
+
+    group = h5file.root.codec
+    residuals, keyframes, keyframe_index = codec.encode(np.asarray(fields), n_keyframes=group.keyframes.nrows)
+    group.residuals.append(residuals)
+    if len(keyframes):
+        group.keyframes.append(keyframes)
+    group.keyframe_index.append(keyframe_index)
+
+
+def truncate(h5file, nrows):
+    """ drop every timestep after the first nrows, along with any keyframes they used """
+    group = h5file.root.codec
+    keyframe_index = group.keyframe_index[:nrows]
+    n_keyframes = int(keyframe_index.max()) + 1 if np.any(keyframe_index >= 0) else 0
+    group.residuals.truncate(nrows)
+    group.keyframe_index.truncate(nrows)
+    group.keyframes.truncate(n_keyframes)
+
+
+def fields_array(h5file):
+    """ the fields of an open h5 file, decoded on indexing if they were saved with the codec """
+    if '/codec' in h5file:
+        return CodecReader(h5file)
+    return h5file.root.data
+
+
+class CodecReader():
+    """
+    Decodes the /codec group of an open h5 file on indexing so it can be used in place of the /data EArray
+
+    Indexing along the time axis decodes from the keyframe before the first requested timestep. The remaining axes are
+    indexed after decoding
+    """
+    def __init__(self, h5file):
+        self.group = h5file.root.codec
+        self.step = self.group._v_attrs.step
+        self.keyframe_index = self.group.keyframe_index[:]
+        self.shape = (len(self.keyframe_index),) + tuple(self.group.keyframes.shape[1:])
+        self.dtype = np.dtype(self.group.keyframes.dtype)  # complex64, or float32 for fields saved as intensity
+        self.work_dtype = np.result_type(self.dtype, np.float64)
+
+    @property
+    def nrows(self):
+        return self.shape[0]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def decode(self, first, last):
+        """
+        :return: complex64 (or float32) array of timesteps [first, last)
+        """
+        fields = np.empty((last - first,) + self.shape[1:], dtype=self.dtype)
+        if last <= first:
+            return fields
+
+        keyframes = np.nonzero(self.keyframe_index[:first + 1] >= 0)[0]
+        start = keyframes[-1]  # the first timestep is always a keyframe
+        residuals = self.group.residuals[start:last]
+
+        previous = None
+        for it in range(start, last):
+            ik = self.keyframe_index[it]
+            if ik >= 0:
+                previous = self.group.keyframes[ik].astype(self.work_dtype)
+            else:
+                previous = previous + from_parts(residuals[it - start]) * self.step
+            if it >= first:
+                fields[it - first] = previous
+
+        return fields
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        time_key, rest = key[0], key[1:]
+
+        if isinstance(time_key, (int, np.integer)):
+            it = time_key + len(self) if time_key < 0 else time_key
+            if not 0 <= it < len(self):
+                raise IndexError(f'index {time_key} is out of bounds for axis 0 with size {len(self)}')
+            return self.decode(it, it + 1)[0][rest]
+
+        first, last, step = time_key.indices(len(self))
+        if step < 0:
+            return self.decode(last + 1, first + 1)[::-1][::-step][(slice(None),) + rest]
+        return self.decode(first, last)[::step][(slice(None),) + rest]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.decode(0, len(self)), dtype=dtype)
@@ -0,0 +1,337 @@
+"""
+fields_store.py
+
+Out-of-core access to the fields.h5 made by Telescope. FieldsStore behaves like a read only numpy array of the 6D
+complex fields (timesteps, save planes, wavelengths, astronomical bodies, x, y) but only reads the part of the file
+that is indexed, and its reductions stream through the file in time chunks so that field sets larger than the memory
+can still be analysed.
+
+>>> with FieldsStore(iop.fields) as store:
+...     detector = store.reduce(plane='detector', sum_bodies=True, sum_wavelengths=True, time_bin=10)
+"""
+
+import numpy as np
+import tables
+
+import medis.fields_codec as codec
+import medis.optics as opx
+from medis.params import sp, iop
+
+
+def stored_scaling(h5file):
+    """
+    body amplitudes an open fields.h5 was made with, from its body_scaling attr. Files made before this was recorded
+    have ap.contrast baked in so are taken to match the current contrast
+
+    :return: (n_bodies,) array
+    """
+    if 'body_scaling' in h5file.root._v_attrs:
+        return np.asarray(h5file.root._v_attrs.body_scaling)
+    return opx.body_scaling()
+
+
+def plane_intensity(h5file):
+    """ whether each saved plane of an open fields.h5 holds intensities, from its save_specs attr """
+    if 'save_specs' in h5file.root._v_attrs:
+        specs = h5file.root._v_attrs.save_specs
+        return [specs[plane]['intensity'] for plane in h5file.root._v_attrs.save_list]
+    return None
+
+
+def stored_n_wvl(h5file):
+    """
+    number of wavelengths the fields of an open fields.h5 are read at. Files saved with ap.interp_on_read hold the
+    propagated wavelengths and record the number to interpolate to in their n_wvl_final attr
+    """
+    if 'n_wvl_final' in h5file.root._v_attrs:
+        return int(h5file.root._v_attrs.n_wvl_final)
+    return codec.fields_array(h5file).shape[2]
+
+
+class InterpolatedFields():
+    """
+    Interpolates the fields to more wavelengths as they are read (see optics.interp_wavelength). Only the wavelengths
+    indexed are made and only the stored wavelengths they need are read
+
+    :param data: the /data EArray, a fields_codec.CodecReader or ScaledFields
+    :param n_wvl: number of wavelengths to interpolate to
+    """
+    def __init__(self, data, n_wvl):
+        self.data = data
+        self.shape = tuple(data.shape[:2]) + (n_wvl,) + tuple(data.shape[3:])
+        self.dtype = np.result_type(data.dtype, np.float32)
+        self.weights = opx.wavelength_weights(data.shape[2], n_wvl)
+
+    @property
+    def nrows(self):
+        return self.shape[0]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+        wanted = np.arange(self.shape[2])[key[2]]
+        lo, hi, w = [weight[wanted] for weight in self.weights]
+        first = int(np.min(lo))
+        block = self.data[key[:2] + (slice(first, int(np.max(hi)) + 1),) + key[3:]]
+        # ints on the time and plane axes remove them from the block
+        axis = 2 - sum(isinstance(k, (int, np.integer)) for k in key[:2])
+        return opx.interp_wavelength(block, axis, weights=(lo - first, hi - first, w))
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+class ScaledFields():
+    """
+    Applies the contrast factors (see optics.contrast_factors) to the planes and bodies of the fields as they are read
+
+    :param data: the /data EArray or a fields_codec.CodecReader
+    :param factors: (n_saved_planes, n_bodies) array
+    """
+    def __init__(self, data, factors):
+        self.data = data
+        self.factors = factors[np.newaxis, :, np.newaxis, :, np.newaxis, np.newaxis]
+        self.shape = tuple(data.shape)
+        self.dtype = data.dtype
+
+    @property
+    def nrows(self):
+        return self.shape[0]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+        # index the factors like the block, keeping only the plane and body axes of the key
+        factor_key = tuple(k if axis in [1, 3] else (slice(None) if isinstance(k, slice) else 0)
+                           for axis, k in enumerate(key))
+        return (self.data[key] * self.factors[factor_key]).astype(self.dtype)
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+class FieldsStore():
+    """
+    Lazy view of the /data EArray of a fields.h5 file, or of the decoded /codec group if it was saved with
+    sp.fields_codec. Companions stored at unit contrast (sp.unit_contrast) are scaled to the contrast as they are read
+    and fields saved with ap.interp_on_read are interpolated to the wavelengths in the file's n_wvl_final attr
+
+    Indexing follows numpy: ints, slices (with steps), Ellipsis, lists/arrays of ints and boolean masks can be used on
+    any axis. Only the bounding box of the selection is read from disk before any fancy indexing is applied in memory
+
+    :param filename: path to fields.h5. Defaults to iop.fields
+    :param chunk_bytes: upper bound on the bytes read from the file at once by the reductions. Defaults to a quarter
+        of sp.memory_limit to leave room for the intensity and reduced copies
+    :param contrast: contrasts the companions are scaled to as they are read. Defaults to ap.contrast
+    """
+    axes = ['timesteps', 'save planes', 'wavelengths', 'astronomical bodies', 'x', 'y']
+
+    def __init__(self, filename=None, chunk_bytes=None, contrast=None):
+        self.filename = iop.fields if filename is None else filename
+        self.chunk_bytes = sp.memory_limit * 1e9 / 4 if chunk_bytes is None else chunk_bytes
+
+        self.h5file = tables.open_file(self.filename, mode='r')
+        self.data = codec.fields_array(self.h5file)
+        factors = opx.contrast_factors(stored_scaling(self.h5file), contrast, plane_intensity(self.h5file))
+        if not np.all(factors == 1):
+            self.data = ScaledFields(self.data, factors)
+        attrs = self.h5file.root._v_attrs
+        self.save_list = list(attrs.save_list) if 'save_list' in attrs else list(sp.save_list)
+        # whether each plane was saved as intensity. Files without save_specs are intensity only if they are real
+        self.plane_intensity = plane_intensity(self.h5file) or \
+            [not np.iscomplexobj(np.empty(0, dtype=self.data.dtype))] * len(self.save_list)
+        self.sampling = self.h5file.root.sampling[:] if '/sampling' in self.h5file else None
+        n_wvl = stored_n_wvl(self.h5file)
+        if n_wvl != self.data.shape[2]:
+            self.data = InterpolatedFields(self.data, n_wvl)
+            if self.sampling is not None:
+                self.sampling = opx.interp_wavelength(self.sampling, ax=-1, weights=self.data.weights)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.h5file.close()
+
+    @property
+    def shape(self):
+        return tuple(self.data.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        delim = ', '
+        return f"FieldsStore({self.filename}, " \
+               f"{delim.join([axis + ':' + str(length) for axis, length in zip(self.axes, self.shape)])})"
+
+    def __getitem__(self, key):
+        h5_key, post_key = self._split_key(key)
+        block = self.data[h5_key]
+        if post_key is None:
+            return block
+        return block[post_key]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def _split_key(self, key):
+        """
+        Splits a numpy style key into a key PyTables can read (ints and slices only) and the fancy indexing left to be
+        applied to the block in memory
+
+        :return: (h5_key, post_key) where post_key is None if the h5 read already gives the result
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            ie = [ik for ik, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:ie] + (slice(None),) * (self.ndim - len(key) + 1) + key[ie + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # PyTables can't read negative steps so those slices are read forwards and reversed in memory
+        fancy = [not isinstance(k, (int, np.integer, slice)) or (isinstance(k, slice) and (k.step or 1) < 0)
+                 for k in key]
+        if not any(fancy):
+            return key, None
+
+        h5_key, post_key = [], []
+        for k, length in zip(key, self.shape):
+            if isinstance(k, slice) and (k.step or 1) < 0:
+                items = range(*k.indices(length))
+                h5_key.append(slice(items[-1], items[0] + 1, -k.step) if len(items) else slice(0, 0))
+                post_key.append(slice(None, None, -1))
+            elif isinstance(k, slice):
+                h5_key.append(k)
+                post_key.append(slice(None))
+            elif isinstance(k, (int, np.integer)):
+                # keep the axis in the read so numpy places the advanced indices as it would for the full array
+                k = k + length if k < 0 else k
+                h5_key.append(slice(k, k + 1))
+                post_key.append(0)
+            else:
+                k = np.asarray(k)
+                if k.dtype == bool:
+                    k = np.nonzero(k)[0]
+                k = np.where(k < 0, k + length, k)
+                lo, hi = int(k.min()), int(k.max()) + 1
+                h5_key.append(slice(lo, hi))
+                post_key.append(k - lo)
+
+        return tuple(h5_key), tuple(post_key)
+
+    def chunk_steps(self, multiple=1):
+        """
+        number of timesteps per read so that each block stays within chunk_bytes
+
+        :param multiple: round down to a multiple of this (eg the time bin)
+        :return: int
+        """
+        step_bytes = np.prod(self.shape[1:]) * self.dtype.itemsize
+        steps = max(int(self.chunk_bytes // step_bytes), 1)
+        return max(steps // multiple, 1) * multiple
+
+    def iter_chunks(self, multiple=1):
+        """
+        yields (first, last+1, block) through the file along the time axis
+
+        :param multiple: each block (except possibly the last) holds a multiple of this number of timesteps
+        """
+        steps = self.chunk_steps(multiple)
+        for first in range(0, len(self), steps):
+            last = min(first + steps, len(self))
+            yield first, last, self.data[first:last]
+
+    def reduce(self, plane=None, intensity=True, sum_bodies=False, sum_wavelengths=False, time_bin=1, out=None):
+        """
+        streams through the file applying the requested reductions to each time chunk
+
+        The operations are applied in this order: select plane, convert to intensity, sum over bodies, sum over
+        wavelength, sum over time bins of time_bin timesteps. As in optics.cpx_to_intensity, summing over bodies or
+        wavelengths is only valid after converting to intensity
+
+        :param plane: name of the plane in the file's save_list or its index. None keeps the plane axis
+        :param intensity: convert the complex fields to intensity. Planes saved as intensity (sp.save_specs) are left
+            as they are
+        :param sum_bodies: sum over the astronomical bodies
+        :param sum_wavelengths: collapse the wavelength axis
+        :param time_bin: number of timesteps summed into each output frame. A final partial bin is summed as it is
+        :param out: optional filename of an h5 file to append the result to instead of returning it (for results that
+            don't fit in memory)
+        :return: ndarray of the reduced fields, or None if out is given
+        """
+        if (sum_bodies or sum_wavelengths) and not intensity:
+            raise ValueError('Summing over bodies or wavelengths must be done after converting to intensity')
+        if isinstance(plane, str):
+            plane = self.save_list.index(plane)
+
+        h5out, results = None, []
+        if out is not None:
+            h5out = tables.open_file(out, mode='a', title='MEDIS Reduced Fields File')
+
+        try:
+            for first, last, block in self.iter_chunks(multiple=time_bin):
+                if plane is not None:
+                    block = block[:, plane]
+                    if intensity:
+                        block = block.real if self.plane_intensity[plane] else np.abs(block)**2
+                elif intensity:
+                    block = np.stack([block[:, ip].real if saved else np.abs(block[:, ip])**2
+                                      for ip, saved in enumerate(self.plane_intensity)], axis=1)
+                axis = 1 if plane is not None else 2  # position of the wavelength axis
+                if sum_bodies:
+                    block = np.sum(block, axis=axis + 1)
+                if sum_wavelengths:
+                    block = np.sum(block, axis=axis)
+                if time_bin > 1:
+                    nbins = int(np.ceil(len(block) / time_bin))
+                    block = np.add.reduceat(block, np.arange(nbins) * time_bin, axis=0)
+
+                if h5out is None:
+                    results.append(block)
+                elif '/data' not in h5out:
+                    h5out.create_earray(h5out.root, 'data', obj=block)
+                else:
+                    h5out.root.data.append(block)
+        finally:
+            if h5out is not None:
+                h5out.close()
+
+        if h5out is None and results:
+            return np.concatenate(results, axis=0)
+
+    def intensity(self, plane=None, out=None):
+        """ |E|^2 of the whole file. See reduce """
+        return self.reduce(plane=plane, out=out)
+
+    def sum_bodies(self, plane=None, out=None):
+        """ intensity summed over the astronomical bodies. See reduce """
+        return self.reduce(plane=plane, sum_bodies=True, out=out)
+
+    def collapse_wavelength(self, plane=None, sum_bodies=False, out=None):
+        """ broadband intensity. See reduce """
+        return self.reduce(plane=plane, sum_bodies=sum_bodies, sum_wavelengths=True, out=out)
+
+    def bin_time(self, time_bin, plane=None, sum_bodies=False, sum_wavelengths=False, out=None):
+        """ intensity summed in bins of time_bin timesteps. See reduce """
+        return self.reduce(plane=plane, sum_bodies=sum_bodies, sum_wavelengths=sum_wavelengths, time_bin=time_bin,
+                           out=out)
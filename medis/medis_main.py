@@ -46,6 +46,8 @@ class RunMedis():
     Upon creation the code checks if a testdir of this name already exists, if it does it then checks if the params
     match. If the params are identical and the desired products are not already created, if it will create them.
     If the params are different or the testdir does not already exist a new testdir and simulation is created.
+    If only ap.contrast differs and the companions were stored at unit contrast (sp.unit_contrast) the fields are
+    reused and rescaled to the new contrast.
 
     """
     def __init__(self, name='test', product='fields'):
@@ -89,7 +91,10 @@ class RunMedis():
         else:
             params_match = self.check_params()
             exact_match = all(params_match.values())
-            if exact_match:
+            if exact_match and self.contrast_changed:
+                print(f"Configuration files match apart from ap.contrast. Existing fields will be rescaled")
+                self.update_contrast()
+            elif exact_match:
                 print(f"Configuration files match. Initialization over")
             else:
                 print(f"Configuration files differ")
@@ -133,6 +138,7 @@ class RunMedis():
             loaded_params = pickle.load(handle)
 
         match_params = {}
+        self.contrast_changed = False
         print(f"\nChecking Matching Params Classes:")
         for p in ['ap','tp','atmp','iop','sp','mp','cp']:
             matches = []
@@ -143,6 +149,12 @@ class RunMedis():
                 except ValueError:
                     match = False
 
+                if not match and p == 'ap' and this_attr == 'contrast' and self.rescalable(loaded_params, load_val):
+                    print(f'\n\tap.contrast changed from {load_val} to {this_val}. The companions are stored at unit '
+                          f'contrast so the fields can be reused')
+                    self.contrast_changed = True
+                    match = True
+
                 if match == False:
                     print(f'\n\tmismatch found: this_attr= {this_attr}, load_attr= {load_attr}, this_val= {this_val}, '
                           f'load_val= {load_val}')
@@ -154,6 +166,25 @@ class RunMedis():
 
         return match_params
 
+    def rescalable(self, loaded_params, loaded_contrast):
+        """
+        whether fields made with the loaded params can be rescaled to the current ap.contrast rather than rerun. This
+        needs the companions stored at unit contrast (sp.unit_contrast) and the same number of companions
+        """
+        loaded_unit = getattr(loaded_params['sp'], 'unit_contrast', False)
+        return sp.unit_contrast and loaded_unit and len(loaded_contrast) == len(ap.contrast)
+
+    def update_contrast(self):
+        """
+        fields.h5 is kept but the products made from fields at the old contrast are removed so they are remade, and
+        params.pkl is updated to the new contrast
+        """
+        for product in [iop.photonlist, iop.rebinned_cube, iop.camera, iop.telescope]:
+            if os.path.exists(product):
+                print(f'Removing {product} made at the old contrast')
+                os.remove(product)
+        self.make_testdir()
+
     def __call__(self, *args, **kwargs):
         """ Get fields from Telescope and optionally then get photons from Camera. This looks complicated because of
          the possibility to chunk in both Telescope and Camera but simplifies a lot if both have num_chunk = 1"""
@@ -8,7 +8,9 @@ object used in most prescriptions.
 import numpy as np
 import proper
 import copy
-from scipy.interpolate import interp1d
+from contextlib import contextmanager
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from scipy.ndimage import gaussian_filter
 from skimage.restoration import unwrap_phase
 import matplotlib.pylab as plt
@@ -16,24 +18,147 @@ from matplotlib.colors import LogNorm
 from inspect import getframeinfo, stack
 
 from medis.twilight_colormaps import sunlight
-from medis.params import ap, tp, sp
+import medis.batched_optics as bopx
+import medis.fft_engine as fft_engine
+import medis.static_optics as static
+from medis.params import ap, tp, sp, mp, atmp, iop
 from medis.utils import dprint
 from medis.distribution import planck
 
 
-class Wavefront(proper.WaveFront):
-    """ Wrapper for proper.Wavefront that stores source and wavelength info """
+class Wavefront():
+    """
+    Wrapper for proper.Wavefront that stores source and wavelength info
+
+    Only the source info is held by the wrapper, in __slots__ so there is no per instance __dict__. Every other
+    attribute (wfarr, dx, z...) is read from and written to the wrapped PROPER wavefront, so making the wrappers for
+    every wavelength and body each timestep copies nothing and PROPER functions can be called on the wrapper directly.
+    See simulations/examples/benchmark_wavefronts.py
+    """
+    __slots__ = ('proper_wf', 'name', 'beam_ratio', 'iw', 'ib')
 
     def __init__(self, wavefront, lamda, name, beam_ratio, iw, ib):
+        object.__setattr__(self, 'proper_wf', wavefront)
         self.lamda = lamda
         self.name = name
         self.beam_ratio = beam_ratio
         self.iw = iw
         self.ib = ib
 
-        for attr in dir(wavefront):
-            if not hasattr(self, attr):
-                setattr(self, attr, getattr(wavefront, attr))
+    def __getattr__(self, attr):
+        # only called for attributes not in __slots__. Dunders are excluded so copy and pickle don't recurse before
+        # proper_wf is set
+        if attr == 'proper_wf' or (attr.startswith('__') and attr.endswith('__')):
+            raise AttributeError(attr)
+        return getattr(self.proper_wf, attr)
+
+    def __setattr__(self, attr, value):
+        if attr in Wavefront.__slots__:
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self.proper_wf, attr, value)
+
+    def __copy__(self):
+        # copy the PROPER wavefront too so that reassigning attributes of the copy leaves the original alone
+        return Wavefront(copy.copy(self.proper_wf), self.lamda, self.name, self.beam_ratio, self.iw, self.ib)
+
+    def __getstate__(self):
+        return {attr: getattr(self, attr) for attr in Wavefront.__slots__}
+
+    def __setstate__(self, state):
+        for attr, value in state.items():
+            object.__setattr__(self, attr, value)
+
+
+_collection_executor = {}  # the executor for parallel loop_collection and the (mode, workers) it was made for, kept
+                          # alive between calls and timesteps until shutdown_collection_executor
+
+
+def collection_executor():
+    """
+    Returns the executor used by Wavefronts.loop_collection to spread the (n_wavelengths x n_bodies) grid over cores
+
+    The mode and size are set by sp.collection_mode and sp.collection_workers. Process mode isn't possible inside the
+    daemonic workers of Telescope's timestep pool so threads are used there instead. Changing either shuts down the
+    executor made for the old values
+
+    :return: concurrent.futures executor or None if loop_collection should run serially
+    """
+    if sp.collection_mode is None or sp.collection_workers <= 1:
+        return None
+
+    mode = sp.collection_mode
+    if mode == 'process' and multiprocessing.current_process().daemon:
+        mode = 'thread'
+
+    key = (mode, sp.collection_workers)
+    if _collection_executor.get('key') != key:
+        if mode not in ['thread', 'process']:
+            raise ValueError(f"sp.collection_mode must be None, 'thread' or 'process', not {sp.collection_mode}")
+        shutdown_collection_executor()
+        if mode == 'thread':
+            _collection_executor['executor'] = ThreadPoolExecutor(max_workers=sp.collection_workers)
+        else:
+            _collection_executor['executor'] = ProcessPoolExecutor(max_workers=sp.collection_workers)
+        _collection_executor['key'] = key
+
+    return _collection_executor['executor']
+
+
+def shutdown_collection_executor():
+    """ shuts down the executor of collection_executor, eg when a run ends. The next parallel call makes a new one """
+    executor = _collection_executor.pop('executor', None)
+    _collection_executor.pop('key', None)
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def _params_singletons():
+    from medis.CDI import cdi  # CDI imports this module
+    return {'sp': sp, 'ap': ap, 'tp': tp, 'atmp': atmp, 'iop': iop, 'mp': mp, 'cdi': cdi}
+
+
+def params_snapshot():
+    """
+    the params singletons as dicts, sent with every process mode task of loop_collection. The process workers live
+    between runs so they would otherwise keep the params they were forked with, and miss any later change (eg the
+    companions set by psf_library.grid_companions or the toggling of sp.quick_companions)
+    """
+    return {name: dict(params.__dict__) for name, params in _params_singletons().items()}
+
+
+def apply_to_wavefront(func, wavefront, args, kwargs, params=None):
+    """
+    applies func to a single wavefront and returns the wavefront with the output of func
+
+    The wavefront is returned so that process workers can send the modified copy back to the parent
+
+    :param params: params_snapshot() of the parent, applied in the worker first. None (threads) leaves them alone
+    """
+    if params is not None:
+        for name, singleton in _params_singletons().items():
+            singleton.__dict__.update(params[name])
+    output = func(wavefront, *args, **kwargs)
+    return wavefront, output
+
+
+def scaled_beam_ratio(wavelength):
+    """
+    beam ratio of the wavefront at this wavelength
+
+    Scale beam ratio by wavelength for polychromatic imaging
+    see Proper manual pg 37
+    Proper is devised such that you get a Nyquist sampled image in the focal plane. If you optical system
+     goes directly from pupil plane to focal plane, then you need to scale the beam ratio such that sampling
+     in the focal plane is constant. You can check this with check_sampling, which returns the value from
+     prop_get_sampling. If the optical system does not go directly from pupil-to-object plane at each optical
+     plane, the beam ratio does not need to be scaled by wavelength, because of some optics wizardry that
+     I don't fully understand. KD 2019
+    """
+    if sp.focused_sys:
+        return sp.beam_ratio
+    else:
+        return sp.beam_ratio * ap.wvl_range[0] / wavelength
 
 
 class Wavefronts():
@@ -52,6 +177,8 @@ class Wavefronts():
         ...meaning its an array of arrays.
         thus, self.wf_collection[iw,ib] is itself a 2D array of complex data. Its size is [sp.grid_size, sp.grid_size]
         we will call each instance of the collection a single wavefront wf
+    self.stack: when sp.batched_wavefronts is set, the contiguous (n_wavelengths, n_astro_bodies, grid_sz, grid_sz)
+        complex array that every wfarr in wf_collection is a view of. See batched_optics
     self.save_E_fields: a matrix of E fields (proper.WaveFront.wfarr) at specified locations in the chain
     self.wsamples = array of the wavelengths run in this simulation
     self.num_bodies = number of astronomical objects in this simulation (including the main on-axis star)
@@ -60,21 +187,24 @@ class Wavefronts():
         # Using Proper to propagate wavefront from primary through optical system, loop over wavelength
         self.debug = debug
         self.wsamples = np.linspace(ap.wvl_range[0], ap.wvl_range[1], ap.n_wvl_init)  # units set in params (should be m)
-        self.num_bodies = 1 + len(ap.contrast) if ap.companion else 1
+        # with sp.quick_companions only the star is propagated. See add_quick_companions
+        self.num_bodies = 1 + len(ap.contrast) if ap.companion and not sp.quick_companions else 1
 
         ############################
         # Create Wavefront Array
         ############################
         self.wf_collection = np.empty((len(self.wsamples), self.num_bodies), dtype=object)
+        self.stack = None
+        self.segment = None  # static_optics.StaticSegment of the static_segment block being run
 
         # Init Locations of saved E-field
         self.saved_planes = []  # string of locations where fields have been saved (should match sp.save_list after run is completed)
-        self.Efield_planes = np.empty((0, np.shape(self.wf_collection)[0],  # array of saved complex field data at
-                                           np.shape(self.wf_collection)[1],    # specified locations of the optical train
-                                           sp.grid_size,
-                                           sp.grid_size), dtype=np.complex64)
-        # self.plane_sampling = np.empty((len(sp.save_list), ap.n_wvl_init))
-        self.plane_sampling = []
+        self.Efield_planes = np.zeros((len(sp.save_list),                  # array of saved complex field data at
+                                       np.shape(self.wf_collection)[0],    # specified locations of the optical train
+                                       np.shape(self.wf_collection)[1],    # filled in place by save_plane in the
+                                       saved_size(),                       # order of sp.save_list and reduced
+                                       saved_size()), dtype=saved_dtype())  # following sp.save_specs
+        self.plane_sampling = np.zeros((len(sp.save_list), ap.n_wvl_init))
 
         self.spectra = []
         for object_spectrum in ap.spectra:
@@ -95,45 +225,89 @@ class Wavefronts():
 
         returns wf_colllection attribute array of wavefronts
         """
+        batched = sp.batched_wavefronts
         for iw, wavelength in enumerate(self.wsamples):
-            # Scale beam ratio by wavelength for polychromatic imaging
-            # see Proper manual pg 37
-            # Proper is devised such that you get a Nyquist sampled image in the focal plane. If you optical system
-            #  goes directly from pupil plane to focal plane, then you need to scale the beam ratio such that sampling
-            #  in the focal plane is constant. You can check this with check_sampling, which returns the value from
-            #  prop_get_sampling. If the optical system does not go directly from pupil-to-object plane at each optical
-            #  plane, the beam ratio does not need to be scaled by wavelength, because of some optics wizardry that
-            #  I don't fully understand. KD 2019
-            if sp.focused_sys:
-                beam_ratio = sp.beam_ratio
-            else:
-                beam_ratio = sp.beam_ratio * ap.wvl_range[0] / wavelength
-                # dprint(f"iw={iw}, w={w}, beam ratio is {self.beam_ratios[iw]}")
+            beam_ratio = scaled_beam_ratio(wavelength)
 
             # Initialize the wavefront at entrance pupil
             wfp = proper.prop_begin(tp.entrance_d, wavelength, sp.grid_size, beam_ratio)
-            if set_up_beam:
+            if set_up_beam and not batched:
                 proper.prop_circular_aperture(wfp, radius = tp.entrance_d / 2)
                 proper.prop_define_entrance(wfp)  # normalizes the intensity
-            wfp.wfarr = np.multiply(wfp.wfarr, np.sqrt(self.spectra[0][iw]), out=wfp.wfarr, casting='unsafe')
+            if not batched:
+                wfp.wfarr = np.multiply(wfp.wfarr, np.sqrt(self.spectra[0][iw]), out=wfp.wfarr, casting='unsafe')
 
             wfs = [wfp]
             names = ['star']
 
             # Initiate wavefronts for companion(s)
             if ap.companion:
-                for ix in range(len(ap.contrast)):
+                for ix in range(self.num_bodies - 1):
                     wfc = proper.prop_begin(tp.entrance_d, wavelength, sp.grid_size, beam_ratio)
-                    if set_up_beam:
+                    if set_up_beam and not batched:
                         proper.prop_circular_aperture(wfc, radius=tp.entrance_d / 2)
                         proper.prop_define_entrance(wfc)  # normalizes the intensity
-                    wfc.wfarr = np.multiply(wfc.wfarr, np.sqrt(self.spectra[ix][iw]), out=wfc.wfarr, casting='unsafe')
+                    if not batched:
+                        wfc.wfarr = np.multiply(wfc.wfarr, np.sqrt(self.spectra[ix][iw]), out=wfc.wfarr,
+                                                casting='unsafe')
                     wfs.append(wfc)
                     names.append('companion_%i' % ix)
 
             for io, (name, wf) in enumerate(zip(names, wfs)):
                 self.wf_collection[iw, io] = Wavefront(wf, wavelength, name, beam_ratio, iw, io)
 
+        if batched:
+            self.build_stack()
+
+            if set_up_beam:
+                bopx.batched_ops[proper.prop_circular_aperture](self, radius=tp.entrance_d / 2)
+                bopx.define_entrance(self)  # normalizes the intensity
+
+            # same spectra as the unbatched loop above
+            spectra = np.array([self.spectra[0]] + [self.spectra[ix] for ix in range(self.num_bodies - 1)]).T
+            self.stack *= np.sqrt(spectra)[:, :, np.newaxis, np.newaxis]
+
+    def build_stack(self):
+        """
+        Moves every wfarr into one contiguous (n_wavelengths, n_astro_bodies, grid_sz, grid_sz) array, leaving views
+        in the wavefronts. From here on loop_collection applies the functions in batched_optics to the whole stack
+        """
+        self.stack = np.empty(self.wf_collection.shape + (sp.grid_size, sp.grid_size), dtype=np.complex128)
+        for (iw, io), wf in np.ndenumerate(self.wf_collection):
+            self.stack[iw, io] = wf.wfarr
+            wf.wfarr = self.stack[iw, io]
+
+    def sync_stack(self):
+        """
+        Points every wfarr in wf_collection back into the stack after functions that replaced the array instead of
+        changing it in place (or process workers that returned a copy of the wavefront)
+        """
+        for (iw, io), wf in np.ndenumerate(self.wf_collection):
+            view = self.stack[iw, io]
+            if wf.wfarr.base is not self.stack or wf.wfarr.ctypes.data != view.ctypes.data:
+                view[...] = wf.wfarr
+                wf.wfarr = view
+
+    @contextmanager
+    def static_segment(self, name):
+        """
+        marks a stretch of the prescription whose apertures, obscurations, lenses and aberration maps are the same
+        every timestep so they are applied as one cached screen per wavelength (see static_optics). Does nothing
+        unless sp.static_segments is set
+
+        :param name: name of the segment, unique within the prescription
+        """
+        if not sp.static_segments or self.segment is not None:
+            yield
+            return
+
+        self.segment = static.StaticSegment(self, name)
+        try:
+            yield
+            self.segment.close()
+        finally:
+            self.segment = None
+
     def loop_collection(self, func, *args, **kwargs):
         """
         For each wavelength and astronomical object apply a function to the wavefront.
@@ -148,6 +322,21 @@ class Wavefronts():
         If you are saving the plane at this location, keep in mind it is saved AFTER the function is applied. This
         is desirable for most functions but be careful when using it for prop_lens, etc
 
+        When sp.batched_wavefronts is set and func has a batched version (see batched_optics.batched_ops) it is
+        applied to the whole stack at once and its output isn't stored. Other functions run per wavefront as usual.
+        When sp.fft_engine is set the propagation functions are always batched so they use that FFT backend, and the
+        stack is built the first time one is called.
+
+        Inside a static_segment block the static functions are folded into the segment's screens instead of being
+        applied here. The screens are applied before any other function and before any plane is saved
+
+        When sp.collection_mode is 'thread' or 'process' the (n_wavelengths x n_astro_bodies) grid is spread over
+        sp.collection_workers cores (see collection_executor). This is the only parallelism available to timestep
+        dependent runs (sp.closed_loop or sp.ao_delay). In process mode func acts on a copy of the wavefront in the
+        worker, so any changes it makes to module state (e.g. saving CDI probes) are not seen by the parent. Every call
+        pickles each wavefront to the worker and back along with the params (see params_snapshot), so process mode
+        only pays off for functions that take much longer than copying a grid_size x grid_size array
+
         :param func: function to be applied e.g. ap.add_aber()
         :param args: args to be passed to the function
         :param kwargs: kwargs to be passed to the function
@@ -174,10 +363,34 @@ class Wavefronts():
         # also if we don't use it we can get rid of some of it
         # manipulator_output = np.empty(self.wf_collection.shape)
         manipulator_output = [[[] for _ in range(len(self.wsamples))] for _ in range(self.num_bodies)]
-        for iw, sources in enumerate(self.wf_collection):
-            for io, wavefront in enumerate(sources):
-                if not func.__name__ in sp.skip_functions:
+        executor = collection_executor()
+        folded = False
+        if self.segment is not None and func.__name__ not in sp.skip_functions:
+            folded = self.segment.fold(func, args, kwargs)
+            if not folded or plane_name in sp.save_list or self.debug:
+                self.segment.flush()
+
+        if func.__name__ in sp.skip_functions or folded:
+            pass
+        elif bopx.supports(func, args, kwargs) and (self.stack is not None or
+                                                   (sp.fft_engine is not None and func in bopx.propagation_ops)):
+            if self.stack is None:
+                self.build_stack()
+            bopx.batched_ops[func](self, *args, **kwargs)
+        elif executor is None:
+            for iw, sources in enumerate(self.wf_collection):
+                for io, wavefront in enumerate(sources):
                     manipulator_output[io][iw] = func(wavefront, *args, **kwargs)
+        else:
+            # wavelengths and bodies are independent here so every wavefront is submitted at once
+            params = params_snapshot() if isinstance(executor, ProcessPoolExecutor) else None
+            futures = {(iw, io): executor.submit(apply_to_wavefront, func, wavefront, args, kwargs, params)
+                       for (iw, io), wavefront in np.ndenumerate(self.wf_collection)}
+            for (iw, io), future in futures.items():
+                self.wf_collection[iw, io], manipulator_output[io][iw] = future.result()
+
+        if self.stack is not None:
+            self.sync_stack()
 
         # Show phase and amplitude of the plane during debugging
         if self.debug and not func.__name__ in sp.skip_functions:
@@ -197,8 +410,12 @@ class Wavefronts():
         Saves the complex field at a specified location in the optical system. If the function is called by
         wfo.loop_collection, the plane is saved AFTER the function is applied
 
-        Note that the complex planes saved are not summed by object, interpolated over wavelength, nor masked down
-        to the sp.maskd_size.
+        Note that the complex planes saved are not summed by object nor interpolated over wavelength. They are
+        cropped, binned, downsampled and converted to intensity as set for the plane in sp.save_specs (see
+        reduce_plane) and the sampling is scaled to match
+
+        The plane is written straight into its slot of the preallocated Efield_planes (see shift_to_plane) so no
+        shifted copies or growing arrays are made
 
         :param location: name of plane where field is being saved
         :return: self.save_E_fields
@@ -207,21 +424,19 @@ class Wavefronts():
             dprint(f"saving plane at {location}")
 
         if location is not None and location in sp.save_list:
-            E_field = np.zeros((1, np.shape(self.wf_collection)[0],
-                                       np.shape(self.wf_collection)[1],
-                                       sp.grid_size,
-                                       sp.grid_size), dtype=np.complex64)
-            samp_lambda = np.zeros(ap.n_wvl_init)
+            ip = sp.save_list.index(location)
+            spec = plane_spec(location)
 
             for iw, sources in enumerate(self.wf_collection):
-                samp_lambda[iw] = proper.prop_get_sampling(self.wf_collection[iw,0])
-                for io, wavefront in enumerate(sources):
-                    wf = proper.prop_shift_center(wavefront.wfarr)
-                    E_field[0, iw, io] = copy.copy(wf)
+                self.plane_sampling[ip, iw] = proper.prop_get_sampling(sources[0]) * spec['bin'] * spec['downsample']
+
+            if self.stack is not None:
+                shift_to_plane(self.stack, self.Efield_planes[ip], location)
+            else:
+                for (iw, io), wavefront in np.ndenumerate(self.wf_collection):
+                    shift_to_plane(wavefront.wfarr, self.Efield_planes[ip, iw, io], location)
 
-            self.Efield_planes = np.vstack((self.Efield_planes, E_field))
             self.saved_planes.append(location)
-            self.plane_sampling.append(samp_lambda)
 
     def focal_plane(self):
         """
@@ -229,11 +444,16 @@ class Wavefronts():
 
         :return:
         """
+        if sp.focal_mft:
+            raise ValueError('sp.focal_mft is set but this prescription ends with focal_plane. It needs to end with '
+                             'mft_focal_plane')
+
         # Saving Complex Data via save_plane
         self.save_plane(location='detector')           # shifting, etc already done in save_plane function
 
-        cpx_planes = np.array(self.Efield_planes)
-        sampling = np.array(self.plane_sampling)
+        # the buffers belong to this timestep's Wavefronts so they can be returned without copying
+        cpx_planes = self.Efield_planes
+        sampling = self.plane_sampling
 
         # Conex Mirror-- cirshift array for off-axis observing
         # if tp.pix_shift is not [0, 0]:
@@ -241,6 +461,59 @@ class Wavefronts():
 
         return cpx_planes, sampling
 
+    def mft_focal_plane(self, fl_lens):
+        """
+        passes the wavefront through the last lens and propagates it to the focus straight onto the detector grid with
+        a matrix Fourier transform (see mft), in place of prop_pass_lens(wf, fl_lens, focus) followed by focal_plane
+
+        Set sp.focal_mft to use it. PROPER would FFT the whole (padded) grid to its native focal sampling of
+        beam_ratio * lambda / D per pixel, and MKIDS.Camera would then interpolate that onto the MKID pixels. Here only
+        the pixels of the detector plane are computed, at the sp.mft_grid platescale (the MKID array by default), so
+        the cost is set by the detector and not the grid. The field is the same as the FFT's at those pixels,
+        including the quadratic phase of the propagation to the waist, and is scaled so each pixel holds the energy
+        falling on it.
+
+        The detector is placed at the beam waist, which is the focal point for the beam leaving the lens. The focus
+        has to be in the far field of the lens, as it always is for a resolved pupil
+
+        :param fl_lens: focal length of the lens in m
+        :return: cpx_planes, sampling as focal_plane
+        """
+        if not sp.focal_mft:
+            raise ValueError('mft_focal_plane needs sp.focal_mft so the detector plane is sized for the MFT grid')
+
+        self.loop_collection(proper.prop_lens, fl_lens)
+        if self.segment is not None:
+            self.segment.flush()
+
+        ip = sp.save_list.index('detector')
+        spec = plane_spec('detector')
+        n_out = mft_grid()[0] if spec['roi'] is None else spec['roi']
+        size = plane_size('detector')
+        lo = self.Efield_planes.shape[-1] // 2 - size // 2
+
+        for iw, sources in enumerate(self.wf_collection):
+            wf = sources[0]
+            if wf.beam_type_old == 'INSIDE_':
+                raise ValueError('The focus is in the near field of the beam so it cannot be reached with an MFT. '
+                                 'Use prop_pass_lens and focal_plane')
+            dz = wf.z_w0 - wf.z
+            dx_focus = wf.lamda * np.abs(dz) / (sp.grid_size * wf.dx)  # native sampling of the FFT at the waist
+            scale = mft_scale(wf)
+
+            fields = self.stack[iw] if self.stack is not None else np.array([source.wfarr for source in sources])
+            focal = mft(fields, n_out, scale, sign=-np.sign(dz), shifted=True) * scale
+            u = (np.arange(n_out) - n_out // 2) * scale * dx_focus
+            rsqr = u[:, np.newaxis]**2 + u[np.newaxis, :]**2
+            focal *= np.exp(1j * np.pi / (wf.lamda * dz) * rsqr)
+
+            self.Efield_planes[ip, iw, :, lo:lo + size, lo:lo + size] = _apply_spec(focal, spec)
+            self.plane_sampling[ip, iw] = dx_focus * scale * spec['bin'] * spec['downsample']
+
+        self.saved_planes.append('detector')
+
+        return self.Efield_planes, self.plane_sampling
+
     def quicklook(self, wf=None, logZ=True, show=True, title=None):
         """
         Produces a figure with an image of amplitude and one of phase as well as 1D slices through these images
@@ -299,36 +572,64 @@ class Wavefronts():
 ####################################################################################################
 # Functions Relating to Processing Complex Cubes
 ####################################################################################################
-def interp_wavelength(data_in, ax):
+def wavelength_weights(n_in, n_out):
+    """
+    linear interpolation weights from n_in to n_out evenly spaced wavelengths across ap.wvl_range, the same
+    interpolation interp1d did, so that out[k] = (1 - w[k]) * in[lo[k]] + w[k] * in[hi[k]]
+
+    :return: lo, hi (n_out,) int arrays and w (n_out,) float array
+    """
+    x = np.linspace(0, n_in - 1, n_out)
+    lo = np.clip(np.floor(x).astype(int), 0, max(n_in - 2, 0))
+    hi = np.minimum(lo + 1, n_in - 1)
+    return lo, hi, x - lo
+
+
+def interp_wavelength(data_in, ax, weights=None, out=None):
     """
     Interpolating spectral cube from ap.n_wvl_init discreet wavelengths to ap.n_wvl_final
 
+    The output is made one wavelength at a time from the precomputed weights of wavelength_weights so the only
+    memory needed besides the output is a single wavelength slice, and the output keeps the precision of the input (eg
+    complex64) rather than going to double precision as interp1d did
+
     :param data_in array where one axis contains the wavelength of the data
     :param ax  axis of wavelength
+    :param weights: (lo, hi, w) from wavelength_weights, or a selection of them. Defaults to ap.n_wvl_init to
+        ap.n_wvl_final, in which case data_in is returned as it is unless ap.interp_wvl is set and its wavelength axis
+        has ap.n_wvl_init samples. If lo, hi and w are scalars the single wavelength is returned without the axis
+    :param out: optional array to write the result into
     :return data_out array that has been interpolated over axis=ax
     """
-    # Interpolating spectral cube from ap.n_wvl_init discreet wavelengths to ap.n_wvl_final
-    if ap.interp_wvl and 1 < ap.n_wvl_init < ap.n_wvl_final:
-        wave_samps = np.linspace(0, 1, ap.n_wvl_init)
-        f_out = interp1d(wave_samps, data_in, axis=ax)
-        new_heights = np.linspace(0, 1, ap.n_wvl_final)
-        data_out = f_out(new_heights)
-    else:
-        data_out = data_in
-
-    return data_out
+    if weights is None:
+        if not (ap.interp_wvl and 1 < ap.n_wvl_init < ap.n_wvl_final and data_in.shape[ax] == ap.n_wvl_init):
+            return data_in
+        weights = wavelength_weights(ap.n_wvl_init, ap.n_wvl_final)
+
+    data_in = np.asarray(data_in)
+    single = np.ndim(weights[0]) == 0
+    lo, hi, w = [np.atleast_1d(weight) for weight in weights]
+    if out is None:
+        shape = list(data_in.shape)
+        shape[ax] = len(lo)
+        out = np.empty(shape, dtype=np.result_type(data_in.dtype, np.float32))
+
+    source = np.moveaxis(data_in, ax, 0)
+    target = np.moveaxis(out, ax, 0)
+    scratch = np.empty(source.shape[1:], dtype=out.dtype)
+    for k in range(len(lo)):
+        # [k, ...] keeps a (0d) array view when the wavelength axis is the only one, eg the sampling of one plane
+        np.multiply(source[lo[k], ...], 1 - float(w[k]), out=target[k, ...])
+        if w[k] != 0:
+            np.multiply(source[hi[k], ...], float(w[k]), out=scratch)
+            target[k, ...] += scratch
+
+    return target[0] if single else out
 
 
 def interp_sampling(sampling):
-    if ap.interp_wvl and 1 < ap.n_wvl_init < ap.n_wvl_final:
-        wave_samps = np.linspace(0, 1, ap.n_wvl_init)
-        f_out = interp1d(wave_samps, sampling, axis=1)  # axis 1 because sa
-        new_heights = np.linspace(0, 1, ap.n_wvl_final)
-        data_out = f_out(new_heights)
-    else:
-        data_out = sampling
-
-    return data_out
+    """ interpolates the (n_saved_planes, n_wavelengths) sampling like interp_wavelength """
+    return interp_wavelength(np.asarray(sampling), ax=1)
 
 
 def extract_plane(data_in, plane_name):
@@ -377,6 +678,216 @@ def extract_center(wf, new_size=sp.maskd_size):
     return smaller_wf
 
 
+def plane_spec(location):
+    """
+    the save spec of a plane with the defaults filled in and checked
+
+    :param location: name of a plane in sp.save_list
+    :return: dict with roi (None for the full grid), bin, downsample, intensity and dtype (numpy dtype)
+    """
+    spec = {'roi': None, 'bin': 1, 'downsample': 1, 'intensity': False, 'dtype': None}
+    unknown = set(sp.save_specs.get(location, {})) - set(spec)
+    if unknown:
+        raise ValueError(f'Unknown keys {unknown} in sp.save_specs[{location!r}]. Use {list(spec.keys())}')
+    spec.update(sp.save_specs.get(location, {}))
+
+    if spec['dtype'] is None:
+        spec['dtype'] = np.float32 if spec['intensity'] else np.complex64
+    spec['dtype'] = np.dtype(spec['dtype'])
+    if not spec['intensity'] and spec['dtype'].kind != 'c':
+        raise ValueError(f'Plane {location} saves the complex field so needs a complex dtype, not {spec["dtype"]}')
+
+    grid = plane_grid(location)
+    roi = grid if spec['roi'] is None else spec['roi']
+    if roi > grid or roi % (spec['bin'] * spec['downsample']) != 0:
+        raise ValueError(f'The roi of plane {location} ({roi}) must be no larger than its grid ({grid}) and a multiple '
+                         f'of bin x downsample')
+
+    return spec
+
+
+def plane_grid(location):
+    """ side length in pixels of a plane before its save spec is applied. The detector is on the MFT grid when
+    sp.focal_mft is set """
+    if sp.focal_mft and location == 'detector':
+        return mft_grid()[0]
+    return sp.grid_size
+
+
+def plane_size(location):
+    """ side length in pixels of a plane after its save spec is applied """
+    spec = plane_spec(location)
+    roi = plane_grid(location) if spec['roi'] is None else spec['roi']
+    return roi // (spec['bin'] * spec['downsample'])
+
+
+def mft_grid():
+    """ (n_pixels, platescale [arcsec/pix]) of the detector plane made by Wavefronts.mft_focal_plane """
+    if sp.mft_grid is not None:
+        return int(sp.mft_grid[0]), sp.mft_grid[1]
+    return int(np.max(mp.array_size)), mp.platescale
+
+
+def mft_scale(wf):
+    """
+    size of a pixel of the MFT detector grid in pixels of the FFT focal plane of wavefront wf, whose angular sampling
+    is beam_ratio * lambda / D (as assumed by MKIDS.Camera.rescale_cube)
+    """
+    native = wf.beam_ratio * wf.lamda / tp.entrance_d * 180 / np.pi * 3600  # [arcsec/pix]
+    return mft_grid()[1] / native
+
+
+def saved_size():
+    """ side length of the x and y axes of the saved fields. Smaller planes are zero padded to this size """
+    return max([plane_size(location) for location in sp.save_list], default=sp.grid_size)
+
+
+def saved_dtype():
+    """ dtype of the saved fields, the one all the plane dtypes in sp.save_specs can be stored as """
+    dtypes = [plane_spec(location)['dtype'] for location in sp.save_list]
+    return np.result_type(*dtypes) if dtypes else np.dtype(np.complex64)
+
+
+def saved_shape(n_wvl=None, n_bodies=None):
+    """
+    shape of one timestep of the saved fields (n_saved_planes, n_wavelengths, n_bodies, x, y)
+
+    :param n_wvl: defaults to ap.n_wvl_init
+    :param n_bodies: defaults to the star plus every ap.contrast companion
+    """
+    n_wvl = ap.n_wvl_init if n_wvl is None else n_wvl
+    n_bodies = 1 + len(ap.contrast) if n_bodies is None else n_bodies
+    return (len(sp.save_list), n_wvl, n_bodies, saved_size(), saved_size())
+
+
+def body_scaling(contrast=None):
+    """
+    amplitude of each astronomical body relative to the star
+
+    :param contrast: list of companion contrasts. Defaults to ap.contrast
+    :return: (1 + n_companions,) array
+    """
+    contrast = ap.contrast if contrast is None else contrast
+    return np.sqrt(np.concatenate(([1.], np.asarray(contrast, dtype=float))))
+
+
+def stored_body_scaling():
+    """ body amplitudes the fields are made with. Companions are left at unit contrast when sp.unit_contrast is set """
+    return np.ones(1 + len(ap.contrast)) if sp.unit_contrast else body_scaling()
+
+
+def contrast_factors(stored, contrast=None, intensity=None):
+    """
+    factors that take fields made with the body amplitudes stored to a new contrast
+
+    :param stored: (n_bodies,) body amplitudes of the fields (the body_scaling attr of fields.h5)
+    :param contrast: list of companion contrasts. Defaults to ap.contrast
+    :param intensity: whether each saved plane is an intensity, which scales with the square of the amplitude.
+        Defaults to sp.save_specs
+    :return: (n_saved_planes, n_bodies) array
+    """
+    target = body_scaling(contrast)
+    stored = np.asarray(stored, dtype=float)
+    if len(stored) != len(target):
+        raise ValueError(f'The fields have {len(stored)} bodies but the contrast needs {len(target)}. The number of '
+                         f'companions can only be changed by rerunning the simulation')
+    intensity = [plane_spec(plane)['intensity'] for plane in sp.save_list] if intensity is None else intensity
+    ratio = target / stored
+    return np.array([ratio**2 if plane_intensity else ratio for plane_intensity in intensity])
+
+
+def rescale_bodies(fields, stored, contrast=None, intensity=None):
+    """
+    rescales the companions of fields made with the body amplitudes stored to a new contrast. Companions are linear
+    in amplitude so this is the same as propagating them again at the new contrast
+
+    :param fields: (n_timesteps, n_saved_planes, n_wavelengths, n_bodies, x, y) array
+    :param stored: (n_bodies,) body amplitudes of the fields
+    :param contrast: list of companion contrasts. Defaults to ap.contrast
+    :param intensity: see contrast_factors
+    :return: fields, or a rescaled copy if the contrast changed
+    """
+    factors = contrast_factors(stored, contrast, intensity)
+    if np.all(factors == 1):
+        return fields
+    return (fields * factors[:, np.newaxis, :, np.newaxis, np.newaxis]).astype(fields.dtype)
+
+
+def reduce_plane(E_field, location):
+    """
+    applies the save spec of a plane to a centred complex field (as given by proper.prop_shift_center)
+
+    The field is cropped to the centred roi, converted to intensity if requested, binned (intensity is summed and the
+    complex field averaged over each bin x bin block), downsampled by keeping every nth pixel through the centre and
+    zero padded to saved_size()
+
+    :param E_field: (..., sp.grid_size, sp.grid_size) complex array
+    :param location: name of a plane in sp.save_list
+    :return: (..., saved_size(), saved_size()) array of the plane's dtype
+    """
+    spec = plane_spec(location)
+
+    if spec['roi'] is not None:
+        lo = sp.grid_size // 2 - spec['roi'] // 2
+        E_field = E_field[..., lo:lo + spec['roi'], lo:lo + spec['roi']]
+    E_field = _apply_spec(E_field, spec)
+
+    size = saved_size()
+    if E_field.shape[-1] < size:
+        lo = size // 2 - E_field.shape[-1] // 2
+        padded = np.zeros(E_field.shape[:-2] + (size, size), dtype=E_field.dtype)
+        padded[..., lo:lo + E_field.shape[-2], lo:lo + E_field.shape[-1]] = E_field
+        E_field = padded
+
+    return E_field.astype(spec['dtype'], copy=False)
+
+
+def shift_to_plane(wfarr, out, location):
+    """
+    writes PROPER wavefronts into their slot of the saved planes, centred as proper.prop_shift_center would and
+    reduced following the plane's save spec, without making a shifted copy of the full grid
+
+    PROPER stores wfarr with the beam centre at [0, 0]. When the plane is saved whole the four quadrants are copied to
+    their centred positions in out. Otherwise only the roi is gathered from the shifted array before the rest of the
+    spec is applied. Planes smaller than saved_size() are written into the centre of out, whose border is left as is
+
+    :param wfarr: (..., sp.grid_size, sp.grid_size) PROPER wavefront array(s)
+    :param out: (..., saved_size(), saved_size()) slot of Wavefronts.Efield_planes to write into
+    :param location: name of a plane in sp.save_list
+    """
+    spec = plane_spec(location)
+    n = wfarr.shape[-1]
+    size = plane_size(location)
+    lo = out.shape[-1] // 2 - size // 2
+    target = out[..., lo:lo + size, lo:lo + size]
+
+    if spec['roi'] is None and not spec['intensity'] and spec['bin'] == 1 and spec['downsample'] == 1:
+        # centred[c] = wfarr[(c - n//2) % n]
+        h = n // 2
+        target[..., :h, :h] = wfarr[..., n - h:, n - h:]
+        target[..., :h, h:] = wfarr[..., n - h:, :n - h]
+        target[..., h:, :h] = wfarr[..., :n - h, n - h:]
+        target[..., h:, h:] = wfarr[..., :n - h, :n - h]
+    else:
+        roi = n if spec['roi'] is None else spec['roi']
+        rows = (np.arange(n // 2 - roi // 2, n // 2 - roi // 2 + roi) - n // 2) % n
+        target[...] = _apply_spec(wfarr[..., rows[:, np.newaxis], rows], spec)
+
+
+def _apply_spec(E_field, spec):
+    """ intensity, binning and downsampling of a plane that has already been cropped to its roi """
+    if spec['intensity']:
+        E_field = np.abs(E_field)**2
+    if spec['bin'] > 1:
+        nbin = E_field.shape[-1] // spec['bin']
+        blocks = E_field.reshape(E_field.shape[:-2] + (nbin, spec['bin'], nbin, spec['bin']))
+        E_field = blocks.sum(axis=(-3, -1)) if spec['intensity'] else blocks.mean(axis=(-3, -1))
+    if spec['downsample'] > 1:
+        start = (E_field.shape[-1] // 2) % spec['downsample']
+        E_field = E_field[..., start::spec['downsample'], start::spec['downsample']]
+    return E_field
+
+
 ####################################################################################################
 # Functions Relating to Masking the Pupil Plane
 ####################################################################################################
@@ -464,6 +975,13 @@ def prop_pass_lens(wf, fl_lens, dist):
     proper.prop_propagate(wf, dist)
 
 
+# obscurations depend on tp.obscure as well as the arguments so their maps are not cached
+bopx.register(add_obscurations, bopx.multiplicative(add_obscurations, cache=False))
+bopx.register(prop_pass_lens, bopx.lens_then_propagate(bopx.lens))
+bopx.propagation_ops.add(prop_pass_lens)
+static.register(add_obscurations)
+
+
 def offset_companion(wf, step=0):
     """
     offsets the companion wavefront using the 2nd and 3rd order Zernike Polynomials (X,Y tilt)
@@ -493,35 +1011,176 @@ def offset_companion(wf, step=0):
         cont_scaling = np.linspace(1. / ap.C_spec, 1, ap.n_wvl_init)
 
         # Shifting the Array
-        if sp.focused_sys:
-            # Scaling into lambda/D AND scaling by wavelength
-            xloc = ap.companion_xy[wf.ib-1][0] * wf.lamda / tp.entrance_d \
-                   * ap.wvl_range[0] / wf.lamda # * (-1)**(iw%2)
-            yloc = ap.companion_xy[wf.ib-1][1] * wf.lamda / tp.entrance_d \
-                    *  ap.wvl_range[0] / wf.lamda  # / (2*np.pi)   * (-1)**(iw%2)
-        else:
-            # Scaling Happens Naturally!
-            xloc = ap.companion_xy[wf.ib-1][0]*1e-6
-            yloc = ap.companion_xy[wf.ib-1][1]*1e-6
-
-        if tp.rot_rate != 0 and step != 0:
-            angle = np.deg2rad(tp.rot_rate * step * sp.sample_time)
-            rot_matrix = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
-            xloc, yloc = np.dot(rot_matrix, np.array([xloc,yloc]))
-            dprint(tp.rot_rate, angle, rot_matrix, xloc, yloc)
-
-        proper.prop_zernikes(wf, [2, 3], np.array([xloc, yloc]))  # zernike[2,3] = x,y tilt
+        tilt = companion_tilt(rotate_position(ap.companion_xy[wf.ib-1], step), wf.lamda)
+        proper.prop_zernikes(wf, [2, 3], tilt)  # zernike[2,3] = x,y tilt
 
         ##############################################
         # Wavelength/Contrast  Scaling the Companion
         ##############################################
-        wf.wfarr *= np.sqrt(ap.contrast[wf.ib-1])
+        # with sp.unit_contrast the contrast is applied when the fields are read instead. See rescale_bodies
+        if not sp.unit_contrast:
+            wf.wfarr *= np.sqrt(ap.contrast[wf.ib-1])
 
         #TODO implement wavelength-dependant scaling
         # Wavelength-dependent scaling by cont_scaling
         # wf = wf * np.sqrt(ap.contrast[wf.ib-1] * cont_scaling[wf.iw])
 
 
+def rotate_position(position, step):
+    """
+    position of a companion after the field rotation (tp.rot_rate) at timestep step
+
+    :param position: (x, y) in the units of ap.companion_xy
+    :return: (2,) array
+    """
+    position = np.asarray(position, dtype=float)
+    if tp.rot_rate == 0 or step == 0:
+        return position
+    angle = np.deg2rad(tp.rot_rate * step * sp.sample_time)
+    rot_matrix = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    return np.dot(rot_matrix, position)
+
+
+def companion_tilt(position, wavelength):
+    """
+    the x and y tilt coefficients offset_companion passes to proper.prop_zernikes for a companion at position
+
+    :param position: (x, y) in the units of ap.companion_xy
+    :param wavelength: in m
+    :return: (2,) array
+    """
+    if sp.focused_sys:
+        # Scaling into lambda/D AND scaling by wavelength
+        return np.asarray(position, dtype=float) * wavelength / tp.entrance_d * ap.wvl_range[0] / wavelength
+    else:
+        # Scaling Happens Naturally!
+        return np.asarray(position, dtype=float) * 1e-6
+
+
+_tilt_cache = {}  # the pixel matrix and companion amplitudes of companion_offsets for the params in 'key'
+
+
+def companion_offsets(step=0):
+    """
+    the focal plane shift and amplitude of each companion relative to the star, as offset_companion makes them
+
+    The tilt is linear in the position of the companion so the shifts are found from a pixel matrix, made once for
+    the params by putting the tilt of a unit offset along x and along y on a blank wavefront and reading off the shift
+    in pixels it gives the FFT of the grid. The companions are rotated (rotate_position) before the matrix is applied.
+    The amplitude includes the companion spectrum relative to the star as applied by Wavefronts.initialize_proper
+
+    :param step: timestep, for the field rotation
+    :return: shifts (n_companions, n_wavelengths, 2) in pixels along the two grid axes,
+             amps (n_companions, n_wavelengths)
+    """
+    n_companions = len(ap.contrast) if ap.companion else 0
+    key = (sp.grid_size, sp.beam_ratio, sp.focused_sys, sp.unit_contrast, tp.entrance_d, ap.n_wvl_init,
+           tuple(ap.wvl_range), tuple(ap.contrast), repr(ap.spectra), n_companions)
+    if _tilt_cache.get('key') != key:
+        wfo = Wavefronts()
+        pixel_matrix = np.zeros((len(wfo.wsamples), 2, 2))
+        for iw, wavelength in enumerate(wfo.wsamples):
+            for ik, unit in enumerate(np.eye(2)):
+                wfp = proper.prop_begin(tp.entrance_d, wavelength, sp.grid_size, scaled_beam_ratio(wavelength))
+                proper.prop_zernikes(wfp, [2, 3], companion_tilt(unit, wavelength))
+                field = proper.prop_shift_center(wfp.wfarr)
+                for axis in [0, 1]:
+                    ahead = np.take(field, np.arange(1, sp.grid_size), axis=axis)
+                    behind = np.take(field, np.arange(sp.grid_size - 1), axis=axis)
+                    slope = np.angle(np.sum(ahead * np.conj(behind)))  # [rad/pixel] of the tilt
+                    pixel_matrix[iw, axis, ik] = slope * sp.grid_size / (2 * np.pi)
+
+        amps = np.zeros((n_companions, len(wfo.wsamples)))
+        for ix in range(n_companions):
+            contrast = 1 if sp.unit_contrast else ap.contrast[ix]
+            amps[ix] = np.sqrt(contrast * wfo.spectra[ix] / wfo.spectra[0])
+        _tilt_cache.update({'key': key, 'pixel_matrix': pixel_matrix, 'amps': amps})
+
+    positions = np.array([rotate_position(ap.companion_xy[ix], step) for ix in range(n_companions)]).reshape(-1, 2)
+    shifts = np.einsum('wpk,ck->cwp', _tilt_cache['pixel_matrix'], positions)
+    return shifts, _tilt_cache['amps']
+
+
+def add_quick_companions(fields, step=0, parity=1):
+    """
+    synthesise the companions of a star-only timestep (sp.quick_companions) by shifting and scaling the star
+
+    The shift is applied as a phase ramp on the FFT of each saved plane so it is accurate to a fraction of a pixel.
+    This is only valid for planes where the PSF is the same everywhere in the field, see
+    Telescope.check_quick_companions
+
+    :param fields: (n_saved_planes, n_wavelengths, 1, x, y) complex fields of the star from the prescription
+    :param step: timestep, for the field rotation
+    :param parity: 1 or -1, the direction of the focal plane shift relative to the tilt added by offset_companion
+    :return: (n_saved_planes, n_wavelengths, 1 + n_companions, x, y) fields in the same dtype
+    """
+    shifts, amps = companion_offsets(step)
+    out = np.zeros(fields.shape[:2] + (1 + len(amps),) + fields.shape[3:], dtype=fields.dtype)
+    out[:, :, 0] = fields[:, :, 0]
+
+    # the star is transformed once and each companion only needs its own ramp and inverse FFT
+    star = fft_engine.fft2(np.fft.ifftshift(fields[:, :, 0], axes=(-2, -1)))
+    for ix in range(len(amps)):
+        ramp = shift_ramp(parity * shifts[ix], fields.shape[-2:])
+        shifted = np.fft.fftshift(fft_engine.ifft2(star * ramp), axes=(-2, -1))
+        out[:, :, ix + 1] = amps[ix, :, np.newaxis, np.newaxis] * shifted
+
+    return out
+
+
+def shift_ramp(shifts, shape):
+    """
+    the phase ramps that shift the FFTs of 2D fields
+
+    :param shifts: (n_wavelengths, 2) shift in pixels along the two grid axes, positive towards higher indices
+    :param shape: (x, y) shape of the fields
+    :return: (n_wavelengths, x, y) complex array to multiply the FFTs by
+    """
+    freqs = [np.fft.fftfreq(n) for n in shape]
+    shifts = np.asarray(shifts)
+    return np.exp(-2j * np.pi * (shifts[:, 0, np.newaxis, np.newaxis] * freqs[0][:, np.newaxis] +
+                                 shifts[:, 1, np.newaxis, np.newaxis] * freqs[1][np.newaxis, :]))
+
+
+def mft(fields, n_out, scale, sign=-1, shifted=False):
+    """
+    matrix Fourier transform of fields onto a centred n_out x n_out grid of any sampling
+
+    With n_out equal to the grid size and a scale of 1 this is the centred, ortho normalised FFT (numpy.fft.fft2 for
+    a sign of -1, ifft2 for +1). Only the requested pixels are computed, as two matrix products per field, so it is
+    cheaper than the FFT whenever n_out is small compared to the grid
+
+    :param fields: (..., N, N) complex array
+    :param n_out: number of pixels along each side of the output
+    :param scale: size of an output pixel in pixels of the FFT (1/N cycles per input pixel)
+    :param sign: sign of the exponent of the transform
+    :param shifted: fields are stored with the centre at [0, 0] as PROPER does instead of at [N//2, N//2]
+    :return: (..., n_out, n_out) complex array with the centre at [n_out//2, n_out//2]
+    """
+    n = fields.shape[-1]
+    x = np.arange(n) - n // 2
+    if shifted:
+        x = np.fft.ifftshift(x)
+    u = (np.arange(n_out) - n_out // 2) * scale
+    kernel = np.exp(sign * 2j * np.pi * np.outer(u, x) / n) / np.sqrt(n)
+    return kernel @ fields @ kernel.T
+
+
+def fourier_shift(fields, shifts):
+    """
+    shifts centred 2D fields by a fraction of a pixel with a phase ramp on their FFT
+
+    :param fields: (..., n_wavelengths, x, y) complex or real array
+    :param shifts: (n_wavelengths, 2) shift in pixels along the two grid axes
+    :return: array of the same shape. Real fields (eg intensities) stay real
+    """
+    transform = fft_engine.fft2(np.fft.ifftshift(fields, axes=(-2, -1)))
+    shifted = np.fft.fftshift(fft_engine.ifft2(transform * shift_ramp(shifts, fields.shape[-2:])), axes=(-2, -1))
+    if not np.iscomplexobj(fields):
+        shifted = shifted.real
+    return shifted.astype(fields.dtype)
+
+
 ####################################################################################################
 # Check Sampling & Misc Tools
 ####################################################################################################
@@ -45,20 +45,23 @@ class IO_params:
         self.camera = os.path.join(self.testdir, 'camera.pkl')  # MKIDS.Camera instance save state
         self.telescope = os.path.join(self.testdir, 'telescope.pkl')  # a telecope.Telescope instance save state
 
+        # atmosphere and aberration maps, shared by every test and named by the params they are made from
+        self.map_cache = os.path.join(self.datadir, 'map_cache')
         self.atmosroot = 'atmos'
-        atmosdir = "gridsz{}_bmratio{}_tsteps{}"  # fill in variable names later
-        self.atmosdir = os.path.join(self.testdir, self.atmosroot, atmosdir)  # full path to FITS files
+        self.atmosdir = os.path.join(self.map_cache, self.atmosroot)  # atmosphere stores (see atmosphere.get_store)
 
         # Aberration Metadata
         self.aberroot = 'aberrations'
-        aberdir = "gridsz{}_bmratio{}_tsteps{}"
-        self.aberdir = os.path.join(self.testdir, self.aberroot, aberdir)  # full path to FITS files
+        aberdir = "gridsz{}_bmratio{}"  # fill in variable names later
+        self.aberdir = os.path.join(self.map_cache, self.aberroot, aberdir)  # FITS files (see aberrations.map_filename)
 
         self.prescopyroot = 'prescription'
         prescopydir = "{}"
         self.prescopydir = os.path.join(self.testdir, self.prescopyroot, prescopydir)  # copy of the prescription
 
         self.device = os.path.join(self.testdir, 'device.pkl')  # detector metadata
+        self.fftw_wisdom = os.path.join(self.datadir, 'fftw_wisdom.pkl')  # pyFFTW plans, shared by every test
+        self.psf_library = os.path.join(self.datadir, 'psf_library')  # off-axis PSF libraries, shared by every test
 
     def update_testname(self, new_name='example2'):
         self.__init__(datadir=self.datadir, testname=new_name)
@@ -90,7 +93,15 @@ class Simulation_params:
     """
     def __init__(self):
         self.timing = True  # True will print timing statements in run_medis()
-        self.num_processes = 1  # multiprocessing.cpu_count()
+        self.num_processes = 1  # multiprocessing.cpu_count(). Also makes the atmosphere store in parallel time
+                                # segments (see atmosphere.gen_atmos)
+        self.collection_mode = None  # None|'thread'|'process' parallelise Wavefronts.loop_collection over the
+                                     # wavelengths and bodies within a single timestep. 'process' pickles every
+                                     # wavefront both ways per call so only suits slow functions
+        self.collection_workers = 1  # number of threads/processes used when collection_mode is set
+        self.static_segments = False  # apply the optics in wfo.static_segment blocks of the prescription as cached
+                                      # screens (see static_optics.py). Their arguments are not compared between
+                                      # timesteps so only turn this on when the marked optics really are fixed
 
         # Grid Sizing/Sampling Params
         self.beam_ratio = 0.5  # parameter dealing with the sampling of the beam in the pupil/focal
@@ -104,6 +115,10 @@ class Simulation_params:
                         # turn on/off as necessary to ensure optics in focal plane have same sampling at each
                         # wavelength. Can check focal plane sampling in the proper perscription with opx.check_sampling
                         # see Proper manual pg 36 for more info
+        self.focal_mft = False  # propagate the final focus straight onto the detector grid with a matrix Fourier
+                                # transform instead of the FFT (see Wavefronts.mft_focal_plane)
+        self.mft_grid = None  # None | (n_pixels, platescale [arcsec/pix]) of the MFT detector plane. None uses the
+                              # MKID array (max of mp.array_size at mp.platescale) so MKIDS skips its resampling
 
         # Timing Params
         self.closed_loop = False  # if false (open loop), then initiate multiprocessing for individual timesteps
@@ -112,6 +127,9 @@ class Simulation_params:
         self.startframe = 0  # useful for things like RDI
         self.numframes = 1  # number of timesteps in the simulation
         self.quick_companions = False  # this bool determines if companions are generated by simple shift and scaling
+        self.unit_contrast = False  # store companions at unit contrast and apply ap.contrast when the fields are read
+                                    # so contrast sweeps reuse fields.h5. /data then no longer holds the contrast
+        self.quick_tolerance = 0.05  # largest relative error of the shifted companions allowed by check_quick_companions
         self.quick_detect = False  # generate mkid spectral cube sequence by spatial scaling and intensity scaling datacube (no photon quantization or arteacts)
 
         # Plotting Params
@@ -124,8 +142,24 @@ class Simulation_params:
         # Reading/Saving Params
         self.save_to_disk = False  # Saves observation sequence (timestep, wavelength, x, y)
         self.save_list = ['detector']  # list of locations in optics train to save
+        self.batched_wavefronts = False  # hold all wavelengths and bodies in one array and apply the common PROPER
+                                         # operations to it at once. See batched_optics.py
+        self.fft_engine = None  # None (PROPER's FFTs) | 'numpy' | 'scipy' | 'pyfftw' backend for the propagation FFTs.
+                                # See fft_engine.py
+        self.fft_workers = 1  # number of threads used by the scipy and pyfftw FFTs
+        self.save_specs = {}  # {plane name in save_list: dict} to reduce what is kept of a plane. Keys are roi (side of
+                              # the centred crop in pixels), bin (sums intensity/averages the complex field in bin x bin
+                              # blocks), downsample (keeps every nth pixel), intensity (save |E|^2) and dtype. Planes
+                              # fed back by sp.ao_delay must keep the full complex field
         self.skip_functions = []  # list of functions not to be applied universally by optics.Wavefronts.loop_over_function
         self.memory_limit = 10  # number of giga-bytes for sixcube of complex fields before chunking happens
+        self.fields_storage = None  # None (uncompressed, default chunks) | 'frame' | 'lightcurve' | 'archive' preset in
+                                    # telescope.storage_presets | dict of complib, complevel, shuffle, bitshuffle,
+                                    # chunks ('frame', 'lightcurve' or a 6D chunkshape tuple) for fields.h5
+        self.fields_codec = None  # None | dict of error_bound (max error on |E|) and keyframe_interval (timesteps)
+                                  # stores fields.h5 as keyframes plus quantised frame differences. See fields_codec.py
+        self.save_queue = 1  # number of finished chunks that can wait for the background fields.h5 writer while the
+                             # next chunk is propagated. 0 saves synchronously
         self.checkpointing = 500  # int or None number of timesteps before complex fields sixcube is saved
                                  # minimum of this and max allowed steps for memory reasons takes priority
         self.chunking = False  # chunking is neccessary if the full fields tensor does not fit in memory. RunMedis should set this automatically
@@ -164,6 +198,8 @@ class Astro_params:
         self.n_wvl_init = 3  # initial number of wavelength bins in spectral cube (later sampled by MKID detector)
         self.n_wvl_final = None  # final number of wavelength bins in spectral cube after interpolation (None sets equal to n_wvl_init)
         self.interp_wvl = True  # Set to interpolate wavelengths from ap.n_wvl_init to ap.n_wvl_final
+        self.interp_on_read = False  # keep the ap.n_wvl_init propagated wavelengths in fields.h5 and interpolate them
+                                     # when they are read back (FieldsStore/load_fields) or handed back by Telescope
         self.wvl_range = np.array([800, 1500]) / 1e9  # wavelength range in [m]
             # eg. DARKNESS band is [800, 1500], J band =  [1100,1400])
 
@@ -332,6 +368,10 @@ class Atmos_params():
         self.tau = 0.01 #0.1  # correlation time in seconds of atmopshere
         self.std = 2
         self.correlated_sampling = False
+        self.seed = None  # int seed of the atmosphere layers. None reuses any store of these params (see atmosphere.get_store)
+                          # and seeds the on the fly screens from the params (see atmosphere.engine_seed)
+        self.on_the_fly = False  # make each timestep's screen in memory when add_atmos needs it
+                                 # (atmosphere.ScreenEngine) instead of reading the store made by gen_atmos
 
     def __iter__(self):
         for attr, value in self.__dict__.items():
@@ -0,0 +1,304 @@
+"""
+psf_library.py
+
+Library of off-axis PSFs for injecting companions into star-only fields or intensity cubes after the simulation
+
+Behind a coronagraph the PSF of a companion depends on where it is in the field so it can't be made by shifting the
+star as with sp.quick_companions. Instead the prescription is propagated once for unit contrast companions on a polar
+grid of separations and position angles, and companions anywhere inside the grid are interpolated from the
+neighbouring grid PSFs. Each neighbour is shifted with a sub-pixel Fourier shift onto the companion position before
+they are blended, so the interpolated PSF doesn't have the doubled cores of a plain weighted sum.
+
+The libraries are saved in iop.psf_library and are keyed by a hash of the prescription and the params that set the
+optics, so any test using the same optics reuses them
+
+>>> tel = Telescope()  # imports the prescription and makes the atmosphere and aberration maps
+>>> star_only = tel()['fields']
+>>> with PSFLibrary(separations=np.linspace(2, 10, 9), n_angles=12) as library:
+...     fields = library.inject(star_only, positions=[[4, 1], [-6, 2]], contrasts=[1e-4, 1e-5])
+"""
+
+import os
+import glob
+import pickle
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+import tables
+import proper
+
+import medis.optics as opx
+import medis.atmosphere as atmos
+import medis.aberrations as aber
+from medis.params import sp, ap, tp, atmp, iop
+
+
+@contextmanager
+def grid_companions(positions):
+    """
+    temporarily replaces the companions in the params with unit contrast companions at positions that have the star's
+    spectrum, and only saves the detector plane
+
+    :param positions: list of (x, y) in the units of ap.companion_xy
+    """
+    saved = {'ap': {attr: getattr(ap, attr) for attr in ['companion', 'contrast', 'companion_xy', 'spectra']},
+             'sp': {attr: getattr(sp, attr) for attr in ['save_list', 'quick_companions']}}
+    ap.companion = True
+    ap.contrast = [1.] * len(positions)
+    ap.companion_xy = [list(position) for position in positions]
+    ap.spectra = [ap.spectra[0]] * (len(positions) + 1)
+    sp.save_list = ['detector']
+    sp.quick_companions = False
+    try:
+        yield
+    finally:
+        ap.__dict__.update(saved['ap'])
+        sp.__dict__.update(saved['sp'])
+
+
+def library_key(separations, n_angles, step):
+    """
+    hash of everything that changes the off-axis PSFs: the prescription source, the telescope params, the sampling,
+    the detector save spec, the grid, and the atmosphere and aberration maps used at step
+
+    :return: str
+    """
+    prescription = glob.glob(os.path.join(iop.prescriptions_root, '**', tp.prescription + '.py'), recursive=True)
+    source = tp.prescription
+    if len(prescription) == 1:
+        with open(prescription[0], 'rb') as handle:
+            source = handle.read()
+
+    # the map files are named by what they are made from, and appending timesteps to the atmosphere store leaves
+    # the stored ones as they are, so the names and the seed of the store identify the maps
+    maps = []
+    if tp.use_atmos:
+        maps.append(('engine_seed', atmos.engine_seed()) if atmp.on_the_fly else
+                    (os.path.basename(atmos.get_store()), atmos.stored_frames(atmos.get_store())[1]))
+    if tp.use_aber:
+        maps += [os.path.basename(aber.map_filename(lens['name'])) for lens in tp.lens_params or []]
+
+    optics = {'source': source,
+              'tp': tp.__dict__,
+              'atmp': atmp.__dict__ if tp.use_atmos else None,
+              'maps': maps,
+              'ap': [ap.wvl_range, ap.n_wvl_init, ap.spectra[0]],
+              'sp': [sp.grid_size, sp.beam_ratio, sp.focused_sys, sp.save_specs.get('detector', {}),
+                     opx.mft_grid() if sp.focal_mft else None],
+              'grid': [list(separations), n_angles, step]}
+    return hashlib.sha1(pickle.dumps(optics, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()[:16]
+
+
+def detector_pixel_matrix():
+    """
+    how far a companion moves on the detector per unit of ap.companion_xy
+
+    opx.companion_offsets gives the shift in pixels of the FFT focal plane, which are opx.mft_scale of them to a
+    pixel of the sp.focal_mft detector grid, and the detector save spec bins them further
+
+    :return: (n_wavelengths, 2, 2) pixels along the two grid axes per unit x and y
+    """
+    with grid_companions([[1, 0], [0, 1]]):
+        shifts, _ = opx.companion_offsets()
+    pixel_matrix = np.transpose(shifts, (1, 2, 0))
+    if sp.focal_mft:
+        wfo = opx.Wavefronts()
+        wfo.initialize_proper()
+        scales = [opx.mft_scale(wf) for wf in wfo.wf_collection[:, 0]]
+        pixel_matrix = pixel_matrix / np.array(scales)[:, np.newaxis, np.newaxis]
+    spec = opx.plane_spec('detector')
+    return pixel_matrix / (spec['bin'] * spec['downsample'])
+
+
+class PSFLibrary():
+    """
+    Off-axis detector PSFs of unit contrast companions on a polar grid, made on first use and loaded from
+    iop.psf_library after that
+
+    The library is made with the current params so make it after Telescope() has imported the prescription and made
+    the atmosphere and aberration maps. Time varying aberrations are frozen at timestep step
+
+    :param separations: increasing separations of the grid in the units of ap.companion_xy
+    :param n_angles: number of position angles of the grid, evenly spaced starting along +x
+    :param step: timestep the prescription is run at. Defaults to sp.startframe
+    """
+    def __init__(self, separations, n_angles=8, step=None):
+        self.separations = np.sort(np.asarray(separations, dtype=float))
+        self.angles = 2 * np.pi * np.arange(n_angles) / n_angles
+        self.step = sp.startframe if step is None else step
+
+        self.key = library_key(self.separations, n_angles, self.step)
+        self.filename = os.path.join(iop.psf_library, f'{tp.prescription}_{self.key}.h5')
+        if os.path.exists(self.filename):
+            print(f'Loading the off-axis PSF library {self.filename}')
+        else:
+            self.build()
+
+        self.h5file = tables.open_file(self.filename, mode='r')
+        self.pixel_matrix = self.h5file.root.pixel_matrix[:]
+        self.sampling = self.h5file.root.sampling[:]
+        self.parity = self.h5file.root._v_attrs.parity
+        self.intensity = not np.iscomplexobj(np.empty(0, dtype=self.h5file.root.psfs.dtype))
+        self._nodes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.h5file.close()
+
+    def node_position(self, isep, iangle):
+        """ (x, y) of a grid point """
+        return self.separations[isep] * np.array([np.cos(self.angles[iangle]), np.sin(self.angles[iangle])])
+
+    def node(self, isep, iangle):
+        """ (n_wavelengths, x, y) PSF at a grid point """
+        if (isep, iangle) not in self._nodes:
+            self._nodes[(isep, iangle)] = self.h5file.root.psfs[isep, iangle]
+        return self._nodes[(isep, iangle)]
+
+    def build(self):
+        """ propagates every separation of the grid with its position angles as the companions and saves the PSFs """
+        n_angles = len(self.angles)
+        print(f'Making the off-axis PSF library for {len(self.separations)} separations and {n_angles} angles')
+        size = opx.plane_size('detector')
+        dtype = opx.plane_spec('detector')['dtype']
+
+        os.makedirs(iop.psf_library, exist_ok=True)
+        tmp = f'{self.filename}.{os.getpid()}'
+        with tables.open_file(tmp, mode='w', title='MEDIS off-axis PSF library') as h5file:
+            psfs = h5file.create_earray(h5file.root, 'psfs', atom=tables.Atom.from_dtype(dtype),
+                                        shape=(0, n_angles, ap.n_wvl_init, size, size),
+                                        chunkshape=(1, 1, ap.n_wvl_init, size, size))
+            for isep in range(len(self.separations)):
+                positions = [self.node_position(isep, iangle) for iangle in range(n_angles)]
+                with grid_companions(positions):
+                    fields, sampling = proper.prop_run(tp.prescription, 1, sp.grid_size,
+                                                       PASSVALUE={'iter': self.step}, QUIET=True)
+                psfs.append(np.swapaxes(fields[0, :, 1:, :size, :size], 0, 1)[np.newaxis])
+
+            pixel_matrix = detector_pixel_matrix()
+            h5file.create_array(h5file.root, 'pixel_matrix', pixel_matrix)
+            h5file.create_array(h5file.root, 'sampling', np.asarray(sampling))
+            h5file.create_array(h5file.root, 'separations', self.separations)
+            h5file.root._v_attrs.n_angles = n_angles
+            h5file.root._v_attrs.step = self.step
+
+            self.pixel_matrix = pixel_matrix
+            self.h5file = h5file
+            self._nodes = {}
+            h5file.root._v_attrs.parity = self.calibrate_parity()
+        os.replace(tmp, self.filename)
+
+    def calibrate_parity(self):
+        """
+        the direction of the detector shift relative to the tilt, found by shifting one grid PSF onto its neighbour
+
+        :return: 1 or -1
+        """
+        isep = len(self.separations) // 2
+        if len(self.angles) > 1:
+            first, second = (isep, 0), (isep, 1)
+        else:
+            first, second = (max(isep - 1, 0), 0), (isep, 0)
+        if first == second:
+            return 1
+
+        offset = self.pixel_shifts(self.node_position(*second) - self.node_position(*first))
+        errors = {parity: np.linalg.norm(opx.fourier_shift(self.node(*first), parity * offset) - self.node(*second))
+                  for parity in [1, -1]}
+        return min(errors, key=errors.get)
+
+    def pixel_shifts(self, offset):
+        """ (n_wavelengths, 2) detector shift in pixels of an offset (x, y) in the units of ap.companion_xy """
+        return np.einsum('wpk,k->wp', self.pixel_matrix, np.asarray(offset, dtype=float))
+
+    def psf(self, position):
+        """
+        PSF of a unit contrast companion interpolated from the four grid points around it. Positions outside the
+        separations of the grid use the nearest separation
+
+        :param position: (x, y) in the units of ap.companion_xy
+        :return: (n_wavelengths, x, y)
+        """
+        position = np.asarray(position, dtype=float)
+        separation = np.hypot(*position)
+        if not self.separations[0] <= separation <= self.separations[-1]:
+            print(f'Separation {separation} is outside the PSF library ({self.separations[0]} to '
+                  f'{self.separations[-1]}). Using the nearest separation')
+
+        sep_index = np.interp(separation, self.separations, np.arange(len(self.separations)))
+        isep = int(np.floor(sep_index))
+        sep_weight = sep_index - isep
+        angle_index = np.arctan2(position[1], position[0]) % (2 * np.pi) / (2 * np.pi) * len(self.angles)
+        iangle = int(np.floor(angle_index))
+        angle_weight = angle_index - iangle
+
+        psf = 0
+        corners = [(0, 0, (1 - sep_weight) * (1 - angle_weight)), (1, 0, sep_weight * (1 - angle_weight)),
+                   (0, 1, (1 - sep_weight) * angle_weight), (1, 1, sep_weight * angle_weight)]
+        for dsep, dangle, weight in corners:
+            if weight == 0:
+                continue
+            node = (min(isep + dsep, len(self.separations) - 1), (iangle + dangle) % len(self.angles))
+            offset = self.pixel_shifts(position - self.node_position(*node))
+            psf = psf + weight * opx.fourier_shift(self.node(*node), self.parity * offset)
+
+        return psf
+
+    def inject(self, data, positions, contrasts, t0=None, plane='detector'):
+        """
+        adds companions to star-only fields or intensity cubes
+
+        Companions rotate with tp.rot_rate as they do in opx.offset_companion
+
+        :param data: fields (n_timesteps, n_saved_planes, n_wavelengths, n_bodies, x, y) or intensity cube
+            (n_timesteps, n_wavelengths, x, y)
+        :param positions: list of (x, y) of the companions in the units of ap.companion_xy
+        :param contrasts: list of the companion contrasts
+        :param t0: timestep of data[0]. Defaults to sp.startframe
+        :param plane: saved plane the PSFs are put in. Only used for fields
+        :return: the fields with a body appended for every companion, or the cube with the companions added
+        """
+        t0 = sp.startframe if t0 is None else t0
+        fields = np.ndim(data) == 6
+        if fields and self.intensity:
+            raise ValueError('This PSF library was made from intensities so it can only be injected into intensity '
+                             'cubes. Remove intensity from sp.save_specs["detector"] to inject into fields')
+        # fields have the bodies between the wavelengths and the grid
+        data_shape = (np.shape(data)[2],) + np.shape(data)[-2:] if fields else np.shape(data)[-3:]
+        if data_shape != self.h5file.root.psfs.shape[-3:]:
+            raise ValueError(f'The wavelengths and grid of the data {data_shape} must match the library '
+                             f'{self.h5file.root.psfs.shape[-3:]}')
+
+        if fields:
+            iplane = sp.save_list.index(plane)
+            n_bodies = np.shape(data)[3]
+            shape = list(np.shape(data))
+            shape[3] += len(positions)
+            out = np.zeros(shape, dtype=np.result_type(data, self.h5file.root.psfs.dtype))
+            out[:, :, :, :n_bodies] = data
+        else:
+            out = np.array(data, dtype=np.result_type(data, np.float32))
+
+        psfs = None
+        for it in range(len(out)):
+            if psfs is None or tp.rot_rate != 0:
+                psfs = [self.psf(self.rotate(position, t0 + it)) for position in positions]
+            for ic, (psf, contrast) in enumerate(zip(psfs, contrasts)):
+                if fields:
+                    out[it, iplane, :, n_bodies + ic] = np.sqrt(contrast) * psf
+                elif self.intensity:
+                    out[it] += contrast * psf
+                else:
+                    out[it] += contrast * np.abs(psf)**2
+
+        return out
+
+    @staticmethod
+    def rotate(position, step):
+        """ position after the field rotation at step, as in opx.offset_companion """
+        return opx.rotate_position(position, step)
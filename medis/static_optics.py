@@ -0,0 +1,129 @@
+"""
+static_optics.py
+
+Caching of the time invariant stretches of a prescription, selected with sp.static_segments
+
+A prescription marks a stretch of optics that doesn't change between timesteps with
+
+>>> with wfo.static_segment('post_ao'):
+...     wfo.loop_collection(aber.add_aber, iop.aberdir, PASSVALUE['iter'], lens_name='NCPA')
+...     wfo.loop_collection(proper.prop_circular_aperture, **{'radius': tp.entrance_d / 2})
+...     wfo.loop_collection(opx.prop_pass_lens, fl, dist)
+
+Inside the block the functions in static_ops (apertures, obscurations, lenses and fixed phase maps) only multiply the
+field by a map that depends on their arguments and the beam state. Consecutive static functions are folded into one
+screen per wavelength and applied to every body in a single multiply. This happens before the next function that isn't
+static (a propagation, or a time varying element such as the atmosphere, a DM or a CDI probe, which still run every
+timestep) and before any plane saved inside the block. On the first timestep the screens are made by running each
+static function once per wavelength on a probe wavefront of ones, as in batched_optics.multiplicative. After that they
+are replayed from the cache along with the beam state they leave behind.
+
+The arguments of the static functions are not compared between timesteps (eg add_aber is passed the timestep but
+always applies the same map) so only mark stretches whose static optics really are fixed. The cache is cleared by
+Telescope at the start of every run.
+"""
+
+import copy
+import numpy as np
+import proper
+
+import medis.batched_optics as bopx
+
+static_ops = set()  # functions that multiply the field by a map set only by their arguments and the beam state
+
+segment_cache_size = 32  # maximum number of segments kept
+_segments = {}  # {(name, entry beam state, grid shape): [(function names, screens, beam states), ...]}
+
+
+def register(func):
+    """ lets func be folded into the screens of a static segment """
+    static_ops.add(func)
+
+
+def clear_cache():
+    _segments.clear()
+
+
+class StaticSegment():
+    """
+    Records the static functions of one wfo.static_segment block on the first timestep and replays their screens on
+    the following ones
+
+    :param wfo: optics.Wavefronts the segment acts on
+    :param name: name of the segment, unique within the prescription
+    """
+    def __init__(self, wfo, name):
+        self.wfo = wfo
+        self.name = name
+        n_wvl, _ = wfo.wf_collection.shape
+        entry = tuple(tuple(sorted(bopx.get_state(wfo, iw).items())) for iw in range(n_wvl))
+        self.key = (name, entry, wfo.wf_collection[0, 0].wfarr.shape)
+        self.cached = _segments.get(self.key)
+        self.recorded = []
+        self.calls = []  # names of the static functions folded since the last flush
+        self.screens = None
+
+    def fold(self, func, args, kwargs):
+        """
+        folds a static function into the pending screens instead of applying it
+
+        :return: whether func was folded. Other functions have to be applied as usual after a flush
+        """
+        if func not in static_ops:
+            return False
+        self.calls.append(func.__name__)
+        if self.cached is None:
+            n_wvl, nx, ny = (len(self.wfo.wf_collection),) + self.wfo.wf_collection[0, 0].wfarr.shape
+            if self.screens is None:
+                self.screens = np.ones((n_wvl, nx, ny), dtype=np.complex128)
+            for iw in range(n_wvl):
+                probe = copy.copy(self.wfo.wf_collection[iw, 0])
+                probe.wfarr = np.ones((nx, ny), dtype=np.complex128)
+                func(probe, *args, **kwargs)
+                self.screens[iw] *= probe.wfarr
+                bopx.set_state(self.wfo, iw, {attr: getattr(probe, attr) for attr in bopx.get_state(self.wfo, iw)})
+        return True
+
+    def flush(self):
+        """ applies the screens of the static functions folded since the last flush to every body """
+        if not self.calls:
+            return
+        if self.cached is None:
+            states = [bopx.get_state(self.wfo, iw) for iw in range(len(self.wfo.wf_collection))]
+            self.recorded.append((tuple(self.calls), self.screens, states))
+            screens = self.screens
+        else:
+            index = len(self.recorded)
+            if index >= len(self.cached) or self.cached[index][0] != tuple(self.calls):
+                raise ValueError(f'Static segment {self.name} has changed since it was cached. Only mark optics that '
+                                 f'are the same every timestep')
+            self.recorded.append(self.cached[index])
+            _, screens, states = self.cached[index]
+            for iw, state in enumerate(states):
+                bopx.set_state(self.wfo, iw, state)
+
+        if self.wfo.stack is not None:
+            self.wfo.stack *= screens[:, np.newaxis]
+        else:
+            for (iw, io), wavefront in np.ndenumerate(self.wfo.wf_collection):
+                wavefront.wfarr = wavefront.wfarr * screens[iw]
+        self.calls = []
+        self.screens = None
+
+    def close(self):
+        """ flushes the end of the segment and caches it if this was the first time it was run """
+        self.flush()
+        if self.cached is None:
+            if len(_segments) >= segment_cache_size:
+                _segments.pop(next(iter(_segments)))
+            _segments[self.key] = self.recorded
+        elif len(self.recorded) != len(self.cached):
+            raise ValueError(f'Static segment {self.name} has changed since it was cached. Only mark optics that '
+                             f'are the same every timestep')
+
+
+register(proper.prop_circular_aperture)
+register(proper.prop_circular_obscuration)
+register(proper.prop_rectangular_obscuration)
+register(proper.prop_add_phase)
+register(proper.prop_lens)
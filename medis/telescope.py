@@ -1,6 +1,7 @@
 """
-todo h5 won't let you save chunks>4GB. Add that check to max_chunk function (in addition to one users specific memory check)
+The Telescope class propagates the prescription over time to create the 6D complex fields tensor
 
+Chunk sizes are planned in chunking.py, which also enforces the 4 GB limit on h5 chunks
 """
 
 import os
@@ -12,6 +13,8 @@ import time
 import glob
 import pickle
 import shutil
+import queue
+import threading
 import tables
 
 import proper
@@ -21,9 +24,156 @@ import medis.CDI as cdi
 import medis.utils as mu
 import medis.optics as opx
 import medis.aberrations as aber
-from medis.params import sp, ap, tp, iop
+import medis.chunking as chunking
+import medis.fft_engine as fft_engine
+import medis.static_optics as static
+import medis.fields_codec as codec
+from medis.fields_store import FieldsStore, stored_scaling, plane_intensity, stored_n_wvl
+from medis.params import sp, ap, tp, iop, atmp
 from medis.CDI import cdi
 
+_worker_fields = {}  # per-process view onto the shared fields buffer, populated by _init_worker
+
+
+def _init_worker(state, buffer, shape, dtype):
+    """
+    Pool initializer run once per worker of the persistent pool
+
+    The prescription module is imported, the params singletons are updated with the parent's values, the preloaded
+    aberration maps are installed and a numpy view onto the shared-memory chunk of cpx_sequence is made. After this
+    the workers only receive timestep indices
+
+    :param state: dict returned by Telescope.worker_state()
+    :param buffer: multiprocessing.RawArray allocated by the parent process
+    :param shape: 6D shape of the chunk (n_timesteps, n_saved_planes, n_wavelengths, n_bodies, x, y)
+    :param dtype: dtype of the saved fields
+    """
+    if state['prescription_dir'] not in sys.path:
+        sys.path.insert(0, state['prescription_dir'])
+    importlib.import_module(state['params']['tp']['prescription'])  # the import can overwrite tp so update after
+
+    for params, name in zip([sp, ap, tp, atmp, iop, cdi], ['sp', 'ap', 'tp', 'atmp', 'iop', 'cdi']):
+        params.__dict__.update(state['params'][name])
+
+    aber.loaded_maps.update(state['maps'])
+    static.clear_cache()
+    fft_engine.configure_proper()
+    _worker_fields['quick_parity'] = state['quick_parity']
+    _worker_fields['cpx_sequence'] = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def _run_shared_timestep(it_t):
+    """
+    Propagate one timestep in a worker and write the fields straight into the shared chunk
+
+    Only the sampling is sent back through the pool pipe
+
+    :param it_t: tuple (index in the chunk, absolute timestep)
+    :return: sampling of the saved planes
+    """
+    it, t = it_t
+    fields, sampling = proper.prop_run(tp.prescription, 1, sp.grid_size, PASSVALUE={'iter': t}, QUIET=True)
+    if sp.quick_companions:
+        fields = opx.add_quick_companions(fields, t, _worker_fields['quick_parity'])
+    _worker_fields['cpx_sequence'][it] = fields
+    return sampling
+
+
+# compression and chunk layouts for fields.h5 selected with sp.fields_storage.
+#   'frame'       fast lz4 with one (x, y) frame per chunk, for reading images and time chunks
+#   'lightcurve'  chunks that are long in time and small in x/y so pixel timeseries (eg Stats_Visualiser lightcurves)
+#                 read a few chunks instead of striding through every frame
+#   'archive'     slower, smaller zstd with bitshuffle for long term storage
+storage_presets = {'frame': {'complib': 'blosc:lz4', 'complevel': 5, 'shuffle': True, 'bitshuffle': False,
+                             'chunks': 'frame'},
+                   'lightcurve': {'complib': 'blosc:lz4', 'complevel': 5, 'shuffle': True, 'bitshuffle': False,
+                                  'chunks': 'lightcurve'},
+                   'archive': {'complib': 'blosc:zstd', 'complevel': 9, 'shuffle': False, 'bitshuffle': True,
+                               'chunks': 'frame'}}
+
+lightcurve_chunk_bytes = 2**20  # target size of a 'lightcurve' chunk
+lightcurve_chunk_steps = 256  # maximum number of timesteps in a 'lightcurve' chunk
+
+
+def storage_layout(shape, dtype, storage=None, max_steps=None):
+    """
+    filters and chunkshape to create the fields.h5 EArray with
+
+    :param shape: shape of the first chunk of fields to be saved (n_timesteps, ..., x, y)
+    :param dtype: dtype of the fields
+    :param storage: preset name, dict (see storage_presets) or None. Defaults to sp.fields_storage
+    :param max_steps: upper bound on the timesteps in a chunk (eg the number saved at once)
+    :return: (tables.Filters or None, chunkshape tuple or None)
+    """
+    storage = sp.fields_storage if storage is None else storage
+    if storage is None:
+        return None, None
+    if isinstance(storage, str):
+        if storage not in storage_presets:
+            raise ValueError(f'sp.fields_storage must be one of {list(storage_presets)}, a dict or None')
+        storage = storage_presets[storage]
+
+    filters = None
+    if storage.get('complib') is not None:
+        filters = tables.Filters(complevel=storage.get('complevel', 5), complib=storage['complib'],
+                                 shuffle=storage.get('shuffle', True), bitshuffle=storage.get('bitshuffle', False))
+
+    chunks = storage.get('chunks')
+    itemsize = np.dtype(dtype).itemsize
+    if chunks == 'frame':
+        chunkshape = (1,) * (len(shape) - 2) + tuple(shape[-2:])
+    elif chunks == 'lightcurve':
+        steps = min(lightcurve_chunk_steps, max_steps or shape[0])
+        tile = int(np.sqrt(lightcurve_chunk_bytes / (steps * itemsize)))
+        tile = int(np.clip(tile, 1, shape[-1]))
+        chunkshape = (steps,) + (1,) * (len(shape) - 3) + (tile, tile)
+    else:
+        chunkshape = None if chunks is None else tuple(chunks)
+
+    return filters, chunkshape
+
+
+class FieldsWriter(threading.Thread):
+    """
+    Background stage that appends finished chunks to fields.h5 while the next chunk is being propagated
+
+    Chunks wait in a bounded queue of size sp.save_queue so at most that many extra chunks are held in memory. close()
+    drains everything already queued before returning, including when the run is stopped by an error. Each chunk is
+    written holding utils.h5_lock since the main thread reads the atmosphere store with PyTables meanwhile
+    """
+    sentinel = None
+
+    def __init__(self, telescope, maxsize=1):
+        super().__init__(name='FieldsWriter', daemon=True)
+        self.telescope = telescope
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is self.sentinel:
+                break
+            if self.error is None:  # stop writing after a failure but keep draining so put() never blocks
+                try:
+                    with mu.h5_lock:
+                        self.telescope.save_fields(*item)
+                except Exception as e:
+                    self.error = e
+
+    def put(self, fields, span=None):
+        """ queue a chunk for writing, blocking if the writer is sp.save_queue chunks behind """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((fields, span))
+
+    def close(self):
+        """ flush the queued chunks to disk and stop the thread """
+        self.queue.put(self.sentinel)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
 
 class Telescope:
     """
@@ -34,19 +184,19 @@ class Telescope:
 
     Resulting file structure:
     datadir
+        map_cache                          <--- shared by every test
+            aberrations
+                gridsz{}_bmratio{}         <--- iop.aberdir
+                    {lensname}_{key}.fits  <--- new if missing (see aberrations.map_filename)
+                    ...
+            atmos                          <--- iop.atmosdir
+                atmos_{model}_{key}.h5     <--- new, or appended to (see atmosphere.get_store)
+                ...
         testdir
             params.pkl                     <--- input
             prescription                   <--- new
                 {prescriptionname}         <--- new
                     {prescriptionname}.py  <--- new
-            aberrations                    <--- new
-                {aberationparams}          <--- new
-                    {lensname}0.fits       <--- new
-                    ...                    <--- new
-            atmosphere                     <--- new
-                {atmosphereparams}         <--- new
-                    {atmos}0.fits          <--- new
-                    ...                    <--- new
             fields.h5                      <--- output
 
 
@@ -97,44 +247,48 @@ class Telescope:
                     os.makedirs(iop.prescopydir, exist_ok=True)
                 shutil.copyfile(fullprescription, self.target)
 
-            sys.path.insert(0, os.path.dirname(fullprescription))  # load from the original prescription incase user is editting
+            self.prescription_dir = os.path.dirname(fullprescription)
+            sys.path.insert(0, self.prescription_dir)  # load from the original prescription incase user is editting
             pres_module = importlib.import_module(tp.prescription)
             tp.__dict__.update(pres_module.tp.__dict__)  #  update tp with the contents of the prescription
+            fft_engine.configure_proper()
+            static.clear_cache()  # the static segments of a previous run may have had different optics
 
             # initialize atmosphere
-            iop.atmosdir = iop.atmosdir.format(sp.grid_size, sp.beam_ratio, sp.numframes)
-            if glob.glob(iop.atmosdir+'/*.fits') and sp.verbose:
-                print(f"Atmosphere maps already exist at \n\t{iop.atmosdir}"
-                      f" \n... skipping generation\n\n")
+            if atmp.on_the_fly:
+                pass  # the screens are made by each process's ScreenEngine as add_atmos needs them
+            elif atmos.stored_frames(atmos.get_store())[0] >= sp.startframe + sp.numframes:
+                if sp.verbose:
+                    print(f"Atmosphere maps already exist at \n\t{atmos.get_store()}"
+                          f" \n... skipping generation\n\n")
             else:
                 if not os.path.isdir(iop.atmosdir):
                     os.makedirs(iop.atmosdir, exist_ok=True)
-                atmos.gen_atmos()
+                atmos.gen_atmos()  # makes the store or appends the missing timesteps to it
 
             # initialize aberrations
-            iop.aberdir = iop.aberdir.format(sp.grid_size, sp.beam_ratio, sp.numframes)
-            if glob.glob(iop.aberdir + '/*.fits') and sp.verbose:
+            iop.aberdir = iop.aberdir.format(sp.grid_size, sp.beam_ratio)
+            missing = [lens for lens in tp.lens_params if not os.path.exists(aber.map_filename(lens['name']))]
+            if not missing and sp.verbose:
                 print(f"Aberration maps already exist at \n\t{iop.aberdir} "
                       f"\n... skipping generation\n\n")
             else:
                 if not os.path.isdir(iop.aberdir):
                     os.makedirs(iop.aberdir, exist_ok=True)
-                for lens in tp.lens_params:
+                for lens in missing:
                     aber.generate_maps(lens['aber_vals'], lens['diam'], lens['name'])
 
             # check if can do parrallel
             if sp.closed_loop or sp.ao_delay:
                 print(f"closed loop or ao delay means sim can't be parrallelized in time domain. Forcing serial mode")
+                if sp.num_processes > 1 and sp.collection_mode is None:
+                    print(f"Set sp.collection_mode and sp.collection_workers to parallelise over wavelengths and "
+                          f"bodies instead")
                 self.parrallel = False
             else:
                 self.parrallel = sp.num_processes > 1
 
             # ensure contrast is set properly
-            if sp.quick_companions:
-                # purpose of this code to add option to shift and scale an unocculed star and use that for several sources vastly decreasing compute time
-                raise NotImplementedError
-                ap.contrast = range(2)  # give it length two since all the planets will be collapsed into one slice
-
             if ap.companion is False:
                 ap.contrast = []
 
@@ -185,6 +339,21 @@ class Telescope:
             if not tp.use_ao and 'tweeter' in sp.save_list:
                 sp.save_list.remove('tweeter')
 
+            # pick up from the last checkpoint of a run that died part way through writing fields.h5
+            self.resume_step = 0
+            if self.fields_exists:
+                self.resume_step = self.completed_steps()
+                if self.resume_step < sp.numframes:
+                    self.fields_exists = False
+                    if self.resume_step > 0 and not self.markov:
+                        print(f'Timesteps are dependent so the partial fields at {iop.fields} cannot be resumed. '
+                              f'Starting again')
+                        os.remove(iop.fields)
+                        self.resume_step = 0
+                    elif self.resume_step > 0:
+                        print(f'Resuming the partial fields at {iop.fields} from timestep '
+                              f'{sp.startframe + self.resume_step}')
+
     def __call__(self, *args, **kwargs):
         """ Take the observation (generate the fields sequence) """
         if self.fields_exists:
@@ -193,7 +362,18 @@ class Telescope:
             print('\n\n\tBeginning Telescope Simulation with MEDIS\n\n')
             start = time.time()
 
-            self.create_fields()
+            try:
+                self.create_fields()
+            finally:
+                opx.shutdown_collection_executor()  # the loop_collection workers aren't needed until the next run
+            if getattr(self, 'resume_step', 0) > 0 and self.num_chunks == 1:
+                # create_fields only made the timesteps after the checkpoint, so the whole observation is read back
+                self.load_fields()
+            elif chunking.n_wvl_saved() != chunking.n_wvl_final():
+                # fields.h5 was left at ap.n_wvl_init by ap.interp_on_read but, as when it is loaded, the fields
+                # handed back are at ap.n_wvl_final
+                self.cpx_sequence = opx.interp_wavelength(self.cpx_sequence, ax=2)
+                self.sampling = opx.interp_sampling(self.sampling)
 
             print('\n\n\tMEDIS Telescope Run Completed\n')
             finish = time.time()
@@ -217,14 +397,19 @@ class Telescope:
         """
         Determines the maximum duration each chunk can be to fit within the memory limit
 
+        See chunking.fields_plan for what is included in the estimate
+
         :return: integer
         """
-        self.timestep_size = len(sp.save_list) * ap.n_wvl_final * \
-                        (1 + len(ap.contrast)) * sp.grid_size**2 * 32 / 8  # in Bytes
+        markov = not (sp.ao_delay != 0 or sp.closed_loop)
+        num_processes = sp.num_processes if self.parrallel else 1
+        plan = chunking.fields_plan(markov=markov, num_processes=num_processes)
+        self.timestep_size = plan['timestep_size']  # in Bytes
 
-        max_chunk = sp.memory_limit*1e9 // self.timestep_size
-        print(f'Each timestep is predicted to be {self.timestep_size/1.e6} MB, meaning no more than {max_chunk} time '
-              f'steps can fit in the memory at one time')
+        max_chunk = plan['max_steps']
+        print(f'Each timestep is predicted to be {self.timestep_size/1.e6} MB and needs {plan["step_bytes"]/1.e6} MB '
+              f'of memory while it is made, with {plan["fixed_bytes"]/1.e6} MB for {num_processes} worker(s), meaning '
+              f'no more than {max_chunk} time steps can fit in the memory at one time')
 
         return max_chunk
 
@@ -234,41 +419,76 @@ class Telescope:
         t0 = sp.startframe
         self.kwargs = {}
         self.cpx_sequence = None
+        self.quick_parity = self.check_quick_companions() if sp.quick_companions else 1
 
         if self.markov:  # time steps are independent
-            ceil_num_chunks = int(np.ceil(self.num_chunks))
+            resume_step = getattr(self, 'resume_step', 0)  # timesteps already safely in fields.h5
+            remaining = sp.numframes - resume_step
+            ceil_num_chunks = int(np.ceil(remaining / self.chunk_steps))
             if ceil_num_chunks > 1:
                 print('Only partial observation will be in memory at one time')
-            final_chunk_size = sp.numframes-int(np.floor(self.num_chunks))*self.chunk_steps
-            for ichunk in range(ceil_num_chunks):
-                fractional_step = final_chunk_size != 0 and ichunk == ceil_num_chunks-1
-                chunk_steps = final_chunk_size if fractional_step else self.chunk_steps
-
-                cpx_sequence = np.empty((chunk_steps, len(sp.save_list),
-                                        ap.n_wvl_init, 1 + len(ap.contrast),
-                                        sp.grid_size, sp.grid_size),
-                                        dtype=np.complex64)
-                chunk_range = ichunk * self.chunk_steps + t0 + np.arange(chunk_steps)
-                if sp.num_processes == 1:
-                    seq_samp_list = [self.run_timestep(t) for t in chunk_range]
-                else:
-                    print(f'Using multiprocessing of timesteps {chunk_range}')
-                    # it appears as though the with statement is neccesssary when recreating Pools like this
-                    with multiprocessing.Pool(processes=sp.num_processes) as p:
-                        seq_samp_list = p.map(self.run_timestep, chunk_range)
-                self.cpx_sequence = np.array([tup[0] for tup in seq_samp_list])
-                self.sampling = seq_samp_list[0][1]
+            final_chunk_size = remaining - (ceil_num_chunks-1)*self.chunk_steps
 
-                if ap.n_wvl_init < ap.n_wvl_final:
-                    self.cpx_sequence = opx.interp_wavelength(self.cpx_sequence, ax=2)
-                    self.sampling = opx.interp_sampling(self.sampling)
-
-                if sp.save_to_disk: self.save_fields(self.cpx_sequence)
+            shape = (self.chunk_steps,) + opx.saved_shape()
+            dtype = opx.saved_dtype()
+            if sp.num_processes == 1:
+                pool = None
+            else:
+                # one pool for all the chunks. Workers are initialised with the params and maps once and write their
+                # timestep directly into this buffer so only indices and sampling go through the pool pipes
+                buffer = multiprocessing.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+                shared_sequence = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+                pool = multiprocessing.Pool(processes=sp.num_processes, initializer=_init_worker,
+                                            initargs=(self.worker_state(), buffer, shape, dtype))
+
+            writer = FieldsWriter(self, maxsize=sp.save_queue) if sp.save_to_disk and sp.save_queue > 0 else None
+            if writer is not None:
+                writer.start()
+
+            try:
+                for ichunk in range(ceil_num_chunks):
+                    chunk_steps = final_chunk_size if ichunk == ceil_num_chunks-1 else self.chunk_steps
+
+                    chunk_range = resume_step + ichunk * self.chunk_steps + t0 + np.arange(chunk_steps)
+                    span = (chunk_range[0], chunk_range[-1] + 1)
+                    if pool is None:
+                        cpx_sequence = np.empty((chunk_steps,) + shape[1:], dtype=dtype)
+                        for it, t in enumerate(chunk_range):
+                            cpx_sequence[it], sampling = self.run_timestep(t)
+                            if it == 0:
+                                self.sampling = sampling
+                    else:
+                        print(f'Using multiprocessing of timesteps {chunk_range}')
+                        samplings = pool.map(_run_shared_timestep, enumerate(chunk_range))
+                        self.sampling = samplings[0]
+                        cpx_sequence = shared_sequence[:chunk_steps]
+                    self.cpx_sequence = cpx_sequence
+
+                    if chunking.n_wvl_saved() != ap.n_wvl_init:  # otherwise left to the reader (ap.interp_on_read)
+                        self.cpx_sequence = opx.interp_wavelength(self.cpx_sequence, ax=2)
+                        self.sampling = opx.interp_sampling(self.sampling)
+
+                    if writer is not None:
+                        # the shared pool buffer is overwritten by the next chunk so the writer needs its own copy
+                        if pool is not None and np.shares_memory(self.cpx_sequence, shared_sequence):
+                            writer.put(np.array(self.cpx_sequence), span)
+                        else:
+                            writer.put(self.cpx_sequence, span)
+                    elif sp.save_to_disk:
+                        self.save_fields(self.cpx_sequence, span)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+                    # the shared buffer is reused by every chunk so detach the final chunk from it
+                    if isinstance(self.cpx_sequence, np.ndarray) and np.shares_memory(self.cpx_sequence,
+                                                                                      shared_sequence):
+                        self.cpx_sequence = np.array(self.cpx_sequence)
+                if writer is not None:
+                    writer.close()
 
         else:
-            self.cpx_sequence = np.zeros((sp.numframes, len(sp.save_list),
-                                          ap.n_wvl_init, 1 + len(ap.contrast),
-                                          sp.grid_size, sp.grid_size), dtype=np.complex)
+            self.cpx_sequence = np.zeros((sp.numframes,) + opx.saved_shape(), dtype=chunking.upcast_dtype())
             self.sampling = np.zeros((len(sp.save_list), ap.n_wvl_init))
 
             for it, t in enumerate(range(t0, sp.numframes + t0)):
@@ -284,13 +504,94 @@ class Telescope:
                 self.cpx_sequence[it], self.sampling = self.run_timestep(t)
 
             print('************************')
-            if sp.save_to_disk: self.save_fields(self.cpx_sequence)
+            if sp.save_to_disk: self.save_fields(self.cpx_sequence, (t0, sp.numframes + t0))
+
+        # fields.h5 keeps the companions at unit contrast (sp.unit_contrast) but the fields handed back are at ap.contrast
+        if self.cpx_sequence is not None:
+            self.cpx_sequence = opx.rescale_bodies(self.cpx_sequence, opx.stored_body_scaling())
 
         # return {'fields': np.array(self.cpx_sequence), 'sampling': self.sampling}
 
+    def worker_state(self):
+        """
+        Everything a pool worker needs to run the prescription, shipped once when the pool is started
+
+        :return: dict of the params singletons, the prescription location and the preloaded aberration maps
+        """
+        params = {name: dict(params.__dict__) for params, name in zip([sp, ap, tp, atmp, iop, cdi],
+                                                                     ['sp', 'ap', 'tp', 'atmp', 'iop', 'cdi'])}
+        maps = aber.load_maps() if tp.use_aber else {}
+
+        return {'params': params, 'prescription_dir': self.prescription_dir, 'maps': maps,
+                'quick_parity': getattr(self, 'quick_parity', 1)}
+
+    def check_quick_companions(self):
+        """
+        Checks the companions can be made by shifting the star (sp.quick_companions) and finds the direction of the shift
+
+        Shifting the star is only valid where the PSF is the same everywhere in the field, so the detector has to be the
+        only saved plane, saved as the full complex grid, and there can't be a coronagraph in the beam. The first
+        timestep is then propagated twice, with the companions as full bodies and with the star alone as the quick
+        run does, and the star alone plus its shifted copies is compared to the full run body by body. This also
+        catches prescriptions whose star changes when it is propagated alone (eg optics only applied when there are
+        companions)
+
+        :return: parity for opx.add_quick_companions
+        """
+        problems = []
+        if tp.cg_type is not None:
+            problems.append(f'tp.cg_type is {tp.cg_type}. The coronagraph makes the PSF depend on the position in the '
+                            f'field')
+        if sp.save_list != ['detector']:
+            problems.append(f'sp.save_list is {sp.save_list}. Companions can only be synthesised at the detector')
+        elif opx.plane_spec('detector') != opx.plane_spec(None):
+            problems.append(f'sp.save_specs["detector"] is {sp.save_specs["detector"]}. The detector needs to be saved '
+                            f'as the full complex grid to shift it')
+        if sp.focal_mft:
+            problems.append('sp.focal_mft is set. The companions are shifted in pixels of the FFT focal plane')
+        if problems:
+            raise ValueError('sp.quick_companions is not valid for this run:\n\t' + '\n\t'.join(problems))
+
+        if not ap.companion or len(ap.contrast) == 0:
+            return 1
+
+        if sp.closed_loop or sp.ao_delay:
+            self.kwargs['WFS_field'] = np.zeros((ap.n_wvl_init, sp.grid_size, sp.grid_size), dtype=np.complex128)
+            self.kwargs['AO_field'] = np.zeros((ap.n_wvl_init, sp.grid_size, sp.grid_size), dtype=np.complex128)
+        self.kwargs['iter'] = sp.startframe
+        # the reference with every companion propagated in full
+        sp.quick_companions = False
+        try:
+            fields, _ = proper.prop_run(tp.prescription, 1, sp.grid_size, PASSVALUE=self.kwargs, QUIET=True)
+        finally:
+            sp.quick_companions = True
+        # the star propagated alone, as it is in the quick run
+        star, _ = proper.prop_run(tp.prescription, 1, sp.grid_size, PASSVALUE=self.kwargs, QUIET=True)
+
+        def error(quick, ib):
+            return np.linalg.norm(quick[:, :, ib] - fields[:, :, ib]) / np.linalg.norm(fields[:, :, ib])
+
+        errors = {}
+        for parity in [1, -1]:
+            quick = opx.add_quick_companions(star, sp.startframe, parity)
+            errors[parity] = [error(quick, ib) for ib in range(fields.shape[2])]
+        parity = min(errors, key=lambda p: max(errors[p][1:]))
+        if max(errors[parity]) > sp.quick_tolerance:
+            raise ValueError(f'The star propagated alone and shifted differs from the full propagation by '
+                             f'{errors[parity][0]:.3g} for the star and up to {max(errors[parity][1:]):.3g} for the '
+                             f'companions (sp.quick_tolerance is {sp.quick_tolerance}). sp.quick_companions is not '
+                             f'valid for this prescription')
+
+        print(f'Companions will be made by shifting the star. Relative error at timestep {sp.startframe} is '
+              f'{max(errors[parity]):.3g}')
+        return parity
+
     def run_timestep(self, t):
         self.kwargs['iter'] = t
-        return proper.prop_run(tp.prescription, 1, sp.grid_size, PASSVALUE=self.kwargs, QUIET=True)
+        fields, sampling = proper.prop_run(tp.prescription, 1, sp.grid_size, PASSVALUE=self.kwargs, QUIET=True)
+        if sp.quick_companions:
+            fields = opx.add_quick_companions(fields, t, self.quick_parity)
+        return fields, sampling
         # return np.zeros((1, len(sp.save_list), ap.n_wvl_init, 1 + len(ap.contrast),
         #                  sp.grid_size, sp.grid_size), dtype=np.complex64), 0
 
@@ -312,48 +613,151 @@ class Telescope:
             print(f'Warning cpx_sequence is not 6D as intended by this function. Shape of tensor ='
                   f' {self.cpx_sequence.shape}')
 
-    def save_fields(self, fields):
+    def save_fields(self, fields, span=None):
         """
         Option to save fields separately from the class pickle save since fields can be huge if the user requests
 
+        The absolute timestep range of each chunk is recorded in /completed only once its data has been flushed, so a
+        run that dies part way through can be validated and resumed by completed_steps()
+
         :param fields:
             dtype ndarray of complex or float
             fields can be any shape but the h5 dataset can only extended along axis 0
+        :param span: (first, last+1) timesteps contained in fields
         :return:
 
         todo convert to pytables for pipeline conda integration
         """
 
-        fields = np.array(fields)
+        fields = np.asarray(fields)
         print(f'Saving fields dims with dimensions {fields.shape} and type {fields.dtype}')
         h5file = tables.open_file(iop.fields, mode="a", title="MEDIS Electric Fields File")
-        if "/data" not in h5file:
-            ds = h5file.create_earray(h5file.root, 'data', obj=fields)
+        use_codec = sp.fields_codec is not None  # real (intensity) fields are encoded in the real domain
+        if "/sampling" not in h5file:
+            filters, chunkshape = storage_layout(fields.shape, fields.dtype,
+                                                 max_steps=getattr(self, 'chunk_steps', None))
+            if use_codec:
+                codec.append(h5file, fields, self.fields_encoder(), filters=filters, chunkshape=chunkshape)
+            else:
+                ds = h5file.create_earray(h5file.root, 'data', obj=fields, filters=filters, chunkshape=chunkshape)
             ss = h5file.create_earray(h5file.root, 'sampling', obj=self.sampling)
+            h5file.root._v_attrs.save_list = list(sp.save_list)
+            specs = {plane: opx.plane_spec(plane) for plane in sp.save_list}
+            h5file.root._v_attrs.save_specs = {plane: dict(spec, dtype=str(spec["dtype"]))
+                                              for plane, spec in specs.items()}
+            h5file.root._v_attrs.body_scaling = opx.stored_body_scaling()  # see opx.rescale_bodies
+            h5file.root._v_attrs.contrast = list(ap.contrast)
+            if fields.shape[2] != chunking.n_wvl_final():
+                h5file.root._v_attrs.n_wvl_final = chunking.n_wvl_final()  # interpolated on read, see FieldsStore
+            cs = h5file.create_earray(h5file.root, 'completed', atom=tables.Int64Atom(), shape=(0, 2),
+                                      title='Completed timestep ranges [first, last+1)')
         else:
-            ds = h5file.root.data
-            ds.append(fields)
+            if "/codec" in h5file:
+                codec.append(h5file, fields, self.fields_encoder())
+            else:
+                ds = h5file.root.data
+                ds.append(fields)
+            cs = h5file.root.completed if "/completed" in h5file else None
+        h5file.flush()
+
+        if span is not None and cs is not None:
+            cs.append(np.array([span], dtype=np.int64))
+            h5file.flush()
+
+        h5file.close()
+
+    def fields_encoder(self):
+        """
+        the DeltaCodec carrying the encoder state from one saved chunk to the next. A new encoder (eg after resuming a
+        run) starts with a keyframe
+        """
+        if getattr(self, 'encoder', None) is None:
+            self.encoder = codec.DeltaCodec(**sp.fields_codec)
+        return self.encoder
+
+    def completed_steps(self):
+        """
+        Validate the timestep ranges recorded in an existing fields.h5 and return how many timesteps are complete
 
+        Ranges must be contiguous from sp.startframe and backed by rows in /data. Anything after the last valid range
+        (eg a chunk that was being appended when the run died) is truncated so create_fields can append from there.
+        Files written before ranges were recorded are assumed to be complete
+
+        :return: int number of timesteps from sp.startframe already in fields.h5
+        """
+        h5file = tables.open_file(iop.fields, mode="a")
+        if "/data" not in h5file and "/codec" not in h5file:
+            n_done = 0
+        elif "/completed" not in h5file:
+            n_done = sp.numframes
+        else:
+            ds = codec.fields_array(h5file)
+            cs = h5file.root.completed
+            expected_shape = opx.saved_shape(n_wvl=chunking.n_wvl_saved())
+            if ds.shape[1:] != expected_shape:
+                h5file.close()
+                raise ValueError(f'Fields in {iop.fields} have timestep shape {ds.shape[1:]} but this simulation '
+                                 f'expects {expected_shape}. Move or remove the file to start a new run')
+
+            n_done, n_ranges = 0, 0
+            for first, last in cs[:]:
+                if first != sp.startframe + n_done or last - sp.startframe > ds.nrows:
+                    break
+                n_done = last - sp.startframe
+                n_ranges += 1
+
+            if cs.nrows > n_ranges:
+                cs.truncate(n_ranges)
+            if ds.nrows > n_done:
+                print(f'Discarding {ds.nrows - n_done} incomplete timesteps from {iop.fields}')
+                if "/codec" in h5file:
+                    codec.truncate(h5file, n_done)
+                else:
+                    ds.truncate(n_done)
         h5file.close()
 
-    def load_fields(self, span=(0,-1)):
+        if n_done == 0:
+            os.remove(iop.fields)  # nothing usable so start the file again
+
+        return int(min(n_done, sp.numframes))
+
+    def load_fields(self, span=(0,-1), lazy=False):
         """ load fields h5
 
          warning sampling is not currently stored in h5. It is stored in telescope.pkl however
+
+        :param span: (first, last) timesteps to read into memory. last=-1 reads to the end
+        :param lazy: return a FieldsStore over the whole file instead of reading span into memory. Use this for fields
+            that don't fit in memory
+        Fields saved with sp.fields_codec are decoded as they are read, companions are scaled to ap.contrast and
+        fields saved with ap.interp_on_read are interpolated to ap.n_wvl_final
          """
         print(f"Loading fields from {iop.fields}")
+        if lazy:
+            store = FieldsStore(iop.fields)
+            self.sampling = store.sampling[0]
+            return {'fields': store, 'sampling': self.sampling}
+
         h5file = tables.open_file(iop.fields, mode="r", title="MEDIS Electric Fields File")
+        ds = codec.fields_array(h5file)
         if span[1] == -1:
-            self.cpx_sequence = h5file.root.data[span[0]:]
+            self.cpx_sequence = ds[span[0]:]
         else:
-            self.cpx_sequence = h5file.root.data[span[0]:span[1]]
+            self.cpx_sequence = ds[span[0]:span[1]]
+        self.sampling = h5file.root.sampling[0]
+        # companions stored at unit contrast are scaled to ap.contrast
+        self.cpx_sequence = opx.rescale_bodies(self.cpx_sequence, stored_scaling(h5file),
+                                               intensity=plane_intensity(h5file))
+        n_wvl = stored_n_wvl(h5file)
+        if n_wvl != self.cpx_sequence.shape[2]:
+            weights = opx.wavelength_weights(self.cpx_sequence.shape[2], n_wvl)
+            self.cpx_sequence = opx.interp_wavelength(self.cpx_sequence, ax=2, weights=weights)
+            self.sampling = opx.interp_wavelength(self.sampling, ax=-1, weights=weights)
         h5file.close()
         self.pretty_sequence_shape()
-        self.sampling = h5file.root.sampling[0]
 
         return {'fields': self.cpx_sequence, 'sampling': self.sampling}
 
-
 if __name__ == '__main__':
     iop.update_testname('telescope_module_test')
 
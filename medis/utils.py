@@ -8,11 +8,16 @@ miscellaneous tools helpful to work in and with MEDIS products
 import numpy as np
 from inspect import getframeinfo, stack
 import pickle
+import threading
 import tables as pt
 import astropy.io.fits as afits
 
 from medis.params import sp, ap, tp, iop
 
+# PyTables (and the HDF5 library under it) isn't thread safe. Every PyTables call that can run while another thread of
+# this process uses it (the telescope.FieldsWriter thread, or the threads of sp.collection_mode) holds this lock
+h5_lock = threading.RLock()
+
 
 def dprint(*message, path_display=-3):
     """
@@ -85,11 +90,24 @@ def open_obs_sequence(obs_seq_file='params.pkl'):
     return obs_sequence
 
 
-def open_obs_sequence_hdf5(obs_seq_file='fields.h5'):
-    """opens existing obs sequence .h5 file and returns it"""
+def open_obs_sequence_hdf5(obs_seq_file='fields.h5', lazy=False):
+    """opens existing obs sequence .h5 file and returns it
+
+    Companions stored at unit contrast (sp.unit_contrast) are scaled to ap.contrast as FieldsStore does
+
+    :param lazy: return a fields_store.FieldsStore that reads from the file on indexing instead of loading it all
+    """
+    from medis.fields_store import FieldsStore, stored_scaling, plane_intensity
+    if lazy:
+        return FieldsStore(obs_seq_file)
+
+    import medis.optics as opx
+    import medis.fields_codec as codec
     read_hdf5_file = pt.open_file(obs_seq_file, mode='r')
     # Here we slice [:] all the data back into memory, then operate on it
-    obs_sequence = read_hdf5_file.root.data[:]
+    obs_sequence = codec.fields_array(read_hdf5_file)[:]
+    obs_sequence = opx.rescale_bodies(obs_sequence, stored_scaling(read_hdf5_file),
+                                      intensity=plane_intensity(read_hdf5_file))
     # hdf5_clusters = read_hdf5_file.root.clusters[:]
     read_hdf5_file.close()
     return obs_sequence
@@ -138,9 +138,10 @@ def Subaru_frontend(empty_lamda, grid_size, PASSVALUE):
 
     # Defines aperture (baffle-before primary)
     # Obscurations (Secondary and Spiders)
-    wfo.loop_collection(opx.add_obscurations, d_primary=tp.d_nsmyth, d_secondary=tp.d_secondary, legs_frac=0.05)
-    wfo.loop_collection(proper.prop_circular_aperture,
-                           **{'radius': tp.entrance_d / 2})  # clear inside, dark outside
+    with wfo.static_segment('pupil'):
+        wfo.loop_collection(opx.add_obscurations, d_primary=tp.d_nsmyth, d_secondary=tp.d_secondary, legs_frac=0.05)
+        wfo.loop_collection(proper.prop_circular_aperture,
+                               **{'radius': tp.entrance_d / 2})  # clear inside, dark outside
     wfo.loop_collection(proper.prop_define_entrance, plane_name='entrance_pupil')  # normalizes abs intensity
 
     if ap.companion:
@@ -160,17 +161,18 @@ def Subaru_frontend(empty_lamda, grid_size, PASSVALUE):
     #######################################
     # Effective Primary
     # CPA from Effective Primary
-    wfo.loop_collection(aber.add_aber, step=PASSVALUE['iter'], lens_name='ao188-OAP1')
-    # Zernike Aberrations- Low Order
-    # wfo.loop_collection(aber.add_zern_ab, tp.zernike_orders, aber.randomize_zern_values(tp.zernike_orders))
-    wfo.loop_collection(opx.prop_pass_lens, tp.flen_nsmyth, tp.dist_nsmyth_ao1)
-
-    ########################################
-    # AO188 Propagation
-    ########################################
-    # # AO188-OAP1
-    wfo.loop_collection(aber.add_aber, step=PASSVALUE['iter'], lens_name='ao188-OAP1')
-    wfo.loop_collection(opx.prop_pass_lens, tp.fl_ao1, tp.dist_ao1_dm)
+    with wfo.static_segment('primary_to_dm'):
+        wfo.loop_collection(aber.add_aber, step=PASSVALUE['iter'], lens_name='ao188-OAP1')
+        # Zernike Aberrations- Low Order
+        # wfo.loop_collection(aber.add_zern_ab, tp.zernike_orders, aber.randomize_zern_values(tp.zernike_orders))
+        wfo.loop_collection(opx.prop_pass_lens, tp.flen_nsmyth, tp.dist_nsmyth_ao1)
+
+        ########################################
+        # AO188 Propagation
+        ########################################
+        # # AO188-OAP1
+        wfo.loop_collection(aber.add_aber, step=PASSVALUE['iter'], lens_name='ao188-OAP1')
+        wfo.loop_collection(opx.prop_pass_lens, tp.fl_ao1, tp.dist_ao1_dm)
 
     # AO System
     if tp.use_ao:
@@ -178,23 +180,29 @@ def Subaru_frontend(empty_lamda, grid_size, PASSVALUE):
         wfo.loop_collection(ao.deformable_mirror, WFS_map, PASSVALUE['iter'], plane_name='woofer',
                             debug=sp.debug)  # don't use PASSVALUE['WFS_map'] here because open loop
     # ------------------------------------------------
-    wfo.loop_collection(proper.prop_propagate, tp.dist_dm_ao2)
-
-    # AO188-OAP2
-    wfo.loop_collection(aber.add_aber, step=PASSVALUE['iter'], lens_name='ao188-OAP2')
-    # wfo.loop_collection(aber.add_zern_ab, tp.zernike_orders, aber.randomize_zern_values(tp.zernike_orders)/2)
-    wfo.loop_collection(opx.prop_pass_lens, tp.fl_ao2, tp.dist_oap2_focus)
-
-    ########################################
-    # Focal Plane
-    # #######################################
-    # Check Sampling in focal plane
-    if sp.verbose:
-        wfo.loop_collection(opx.check_sampling, PASSVALUE['iter'], "focal plane",
-                            getframeinfo(stack()[0][0]), units='nm')
-
-    # wfo.focal_plane fft-shifts wfo from Fourier Space (origin==lower left corner) to object space (origin==center)
-    cpx_planes, sampling = wfo.focal_plane()
+    with wfo.static_segment('dm_to_focus'):
+        wfo.loop_collection(proper.prop_propagate, tp.dist_dm_ao2)
+
+        # AO188-OAP2
+        wfo.loop_collection(aber.add_aber, step=PASSVALUE['iter'], lens_name='ao188-OAP2')
+        # wfo.loop_collection(aber.add_zern_ab, tp.zernike_orders, aber.randomize_zern_values(tp.zernike_orders)/2)
+        if sp.focal_mft:
+            # the detector is placed at the focus of OAP2 rather than tp.dist_oap2_focus
+            cpx_planes, sampling = wfo.mft_focal_plane(tp.fl_ao2)
+        else:
+            wfo.loop_collection(opx.prop_pass_lens, tp.fl_ao2, tp.dist_oap2_focus)
+
+    if not sp.focal_mft:
+        ########################################
+        # Focal Plane
+        # #######################################
+        # Check Sampling in focal plane
+        if sp.verbose:
+            wfo.loop_collection(opx.check_sampling, PASSVALUE['iter'], "focal plane",
+                                getframeinfo(stack()[0][0]), units='nm')
+
+        # wfo.focal_plane fft-shifts wfo from Fourier Space (origin==lower left corner) to object space (origin==center)
+        cpx_planes, sampling = wfo.focal_plane()
 
     print(f"Finished datacube at timestep = {PASSVALUE['iter']}")
 
@@ -0,0 +1,69 @@
+"""
+benchmark_wavefronts.py
+
+times the construction of the wavefronts at the start of each timestep (see optics.Wavefront)
+"""
+
+import time
+import cProfile
+import pstats
+import proper
+
+import medis.optics as opx
+from medis.params import sp
+
+
+def benchmark_wavefronts(n_trials=100, profile=False):
+    """
+    times the construction of the wavefronts at the start of each timestep
+
+    Wavefronts.initialize_proper is timed along with the Wavefront wrappers on their own, compared with the previous
+    wrapper that copied every attribute of the PROPER wavefront onto itself
+
+    :param n_trials: number of timesteps worth of wavefronts to make
+    :param profile: print the cProfile stats of initialize_proper
+    :return: dict of the mean time per timestep in seconds for 'initialize_proper', 'wrappers' and 'copied_wrappers'
+    """
+    class CopiedWavefront(proper.WaveFront):
+        def __init__(self, wavefront):
+            for attr in dir(wavefront):
+                if not hasattr(self, attr):
+                    setattr(self, attr, getattr(wavefront, attr))
+
+    wfo = opx.Wavefronts()
+    wfo.initialize_proper()
+    proper_wfs = [wf.proper_wf for wf in wfo.wf_collection.flatten()]
+
+    timings = {}
+    start = time.perf_counter()
+    for _ in range(n_trials):
+        opx.Wavefronts().initialize_proper()
+    timings['initialize_proper'] = (time.perf_counter() - start) / n_trials
+
+    start = time.perf_counter()
+    for _ in range(n_trials):
+        [opx.Wavefront(wf, wf.lamda, 'star', sp.beam_ratio, 0, 0) for wf in proper_wfs]
+    timings['wrappers'] = (time.perf_counter() - start) / n_trials
+
+    start = time.perf_counter()
+    for _ in range(n_trials):
+        [CopiedWavefront(wf) for wf in proper_wfs]
+    timings['copied_wrappers'] = (time.perf_counter() - start) / n_trials
+
+    print(f"Per timestep of {len(proper_wfs)} wavefronts: initialize_proper {timings['initialize_proper']*1e3:.3f} ms, "
+          f"wrappers {timings['wrappers']*1e6:.1f} us, attribute copying wrappers "
+          f"{timings['copied_wrappers']*1e6:.1f} us")
+
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        for _ in range(n_trials):
+            opx.Wavefronts().initialize_proper()
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+
+    return timings
+
+
+if __name__ == '__main__':
+    benchmark_wavefronts(profile=True)
@@ -63,8 +63,9 @@ def general_telescope(empty_lamda, grid_size, PASSVALUE):
     # Both offsets and scales the companion wavefront
     if wfo.wf_collection.shape[1] > 1:
         wfo.loop_collection(opx.offset_companion, step=PASSVALUE['iter'])
-        wfo.loop_collection(proper.prop_circular_aperture,
-                            **{'radius': tp.entrance_d / 2})  # clear inside, dark outside
+    # applied to the star whether or not there are companions so the star is the same with sp.quick_companions
+    wfo.loop_collection(proper.prop_circular_aperture,
+                        **{'radius': tp.entrance_d / 2})  # clear inside, dark outside
 
     # TODO rotate atmos not yet implementid in 2.0
     # if tp.rotate_sky:
@@ -75,7 +76,8 @@ def general_telescope(empty_lamda, grid_size, PASSVALUE):
     #######################################
     # Abberations before AO
 
-    wfo.loop_collection(aber.add_aber, iop.aberdir, PASSVALUE['iter'], lens_name='CPA')
+    with wfo.static_segment('CPA'):
+        wfo.loop_collection(aber.add_aber, iop.aberdir, PASSVALUE['iter'], lens_name='CPA')
 
     # wfo.loop_collection(proper.prop_circular_aperture, **{'radius': tp.entrance_d / 2})
     # wfo.wf_collection = aber.abs_zeros(wfo.wf_collection)
@@ -98,37 +100,43 @@ def general_telescope(empty_lamda, grid_size, PASSVALUE):
             wfo.loop_collection(ao.deformable_mirror, WFS_map, iter=PASSVALUE['iter'], previous_output=None,
                                 plane_name='deformable mirror')
 
-    # Obscure Baffle
-    if tp.obscure:
-        wfo.loop_collection(opx.add_obscurations, M2_frac=1/8, d_primary=tp.entrance_d,
-                            legs_frac=tp.legs_frac)
-
-   ########################################
-    # Post-AO Telescope Distortions
-    # #######################################
-    # Abberations after the AO Loop
-
-    wfo.loop_collection(aber.add_aber, iop.aberdir, PASSVALUE['iter'], lens_name='NCPA')
-    wfo.loop_collection(proper.prop_circular_aperture, **{'radius': tp.entrance_d / 2})
-    # TODO does this need to be here?
-    # wfo.loop_collection(opx.add_obscurations, tp.entrance_d/4, legs=False)
-    # wfo.wf_collection = aber.abs_zeros(wfo.wf_collection)
-
-    wfo.loop_collection(opx.prop_pass_lens, tp.lens_params[0]['focal_length'],
-                        tp.lens_params[0]['focal_length'], plane_name='pre_coron')
-
+    # everything from here to the coronagraph is the same every timestep
+    with wfo.static_segment('post_ao'):
+        # Obscure Baffle
+        if tp.obscure:
+            wfo.loop_collection(opx.add_obscurations, M2_frac=1/8, d_primary=tp.entrance_d,
+                                legs_frac=tp.legs_frac)
+
+        ########################################
+        # Post-AO Telescope Distortions
+        # #######################################
+        # Abberations after the AO Loop
+
+        wfo.loop_collection(aber.add_aber, iop.aberdir, PASSVALUE['iter'], lens_name='NCPA')
+        wfo.loop_collection(proper.prop_circular_aperture, **{'radius': tp.entrance_d / 2})
+        # TODO does this need to be here?
+        # wfo.loop_collection(opx.add_obscurations, tp.entrance_d/4, legs=False)
+        # wfo.wf_collection = aber.abs_zeros(wfo.wf_collection)
+
+        if sp.focal_mft and tp.cg_type is None:
+            # without a coronagraph this lens focuses straight onto the detector
+            cpx_planes, sampling = wfo.mft_focal_plane(tp.lens_params[0]['focal_length'])
+        else:
+            wfo.loop_collection(opx.prop_pass_lens, tp.lens_params[0]['focal_length'],
+                                tp.lens_params[0]['focal_length'], plane_name='pre_coron')
 
-    ########################################
-    # Coronagraph
-    ########################################
-    # there are additional un-aberated optics in the coronagraph module
+    if not (sp.focal_mft and tp.cg_type is None):
+        ########################################
+        # Coronagraph
+        ########################################
+        # there are additional un-aberated optics in the coronagraph module
 
-    wfo.loop_collection(coronagraph, occulter_mode=tp.cg_type, plane_name='coronagraph')
+        wfo.loop_collection(coronagraph, occulter_mode=tp.cg_type, plane_name='coronagraph')
 
-    ########################################
-    # Focal Plane
-    ########################################
-    cpx_planes, sampling = wfo.focal_plane()
+        ########################################
+        # Focal Plane
+        ########################################
+        cpx_planes, sampling = wfo.focal_plane()
 
     print(f"Finished datacube at timestep = {PASSVALUE['iter']}")
 
@@ -0,0 +1,57 @@
+"""
+Shared fixtures. The params are singletons, so every test starts from the same small, quiet simulation with the
+optional features switched off and only sets what it is about (override params in the test file, requesting it)
+"""
+
+import proper
+import pytest
+
+import medis.atmosphere as atmos
+import medis.optics as opx
+from medis.params import ap, sp, tp
+
+
+@pytest.fixture
+def params(monkeypatch):
+    """ two wavelengths of a star alone on a 32 pixel grid, propagated by PROPER one wavefront at a time """
+    monkeypatch.setattr(ap, 'n_wvl_init', 2)
+    monkeypatch.setattr(ap, 'companion', False)
+    monkeypatch.setattr(ap, 'contrast', [])
+    monkeypatch.setattr(ap, 'spectra', [None])
+    monkeypatch.setattr(sp, 'grid_size', 32)
+    monkeypatch.setattr(sp, 'focused_sys', False)
+    monkeypatch.setattr(sp, 'save_list', [])
+    monkeypatch.setattr(sp, 'save_specs', {})
+    monkeypatch.setattr(sp, 'skip_functions', [])
+    monkeypatch.setattr(sp, 'verbose', False)
+    monkeypatch.setattr(sp, 'debug', False)
+
+    # the optional features
+    monkeypatch.setattr(sp, 'batched_wavefronts', False)
+    monkeypatch.setattr(sp, 'fft_engine', None)
+    monkeypatch.setattr(sp, 'collection_mode', None)
+    monkeypatch.setattr(sp, 'collection_workers', 1)
+    monkeypatch.setattr(sp, 'static_segments', False)
+    monkeypatch.setattr(sp, 'quick_companions', False)
+    monkeypatch.setattr(sp, 'unit_contrast', False)
+    monkeypatch.setattr(sp, 'focal_mft', False)
+    monkeypatch.setattr(tp, 'rot_rate', 0)
+    monkeypatch.setattr(proper, 'phase_offset', False)
+
+    # caches made from the params
+    monkeypatch.setattr(opx, '_tilt_cache', {})
+    monkeypatch.setattr(atmos, '_engine', {})
+    yield
+    opx.shutdown_collection_executor()
+
+
+@pytest.fixture
+def companions(monkeypatch):
+    """ sets the companions of ap at contrasts (and positions), with the star's spectrum """
+    def set_companions(contrasts, positions=None):
+        monkeypatch.setattr(ap, 'companion', True)
+        monkeypatch.setattr(ap, 'contrast', list(contrasts))
+        monkeypatch.setattr(ap, 'spectra', [None] * (len(contrasts) + 1))
+        if positions is not None:
+            monkeypatch.setattr(ap, 'companion_xy', [list(position) for position in positions])
+    return set_companions
@@ -0,0 +1,73 @@
+"""
+The batched PROPER operations on the Wavefronts stack (sp.batched_wavefronts) against PROPER itself
+"""
+
+import numpy as np
+import proper
+import pytest
+
+import medis.optics as opx
+from medis.params import ap, sp
+
+fl = 10.  # focal length of the lens [m]
+# to the focus (outside to inside), within the Rayleigh distance, out past it, then further out
+distances = [fl, 1e-7 * fl, 3 * fl, fl]
+state_attrs = ['dx', 'z', 'z_w0', 'reference_surface', 'beam_type_old', 'propagator_type']
+
+
+@pytest.fixture
+def params(params, monkeypatch, companions):
+    monkeypatch.setattr(ap, 'n_wvl_init', 3)
+    companions([1e-2])
+
+
+def propagated(batched, monkeypatch):
+    """ fields and beam state of every wavefront after a lens and each of the distances """
+    monkeypatch.setattr(sp, 'batched_wavefronts', batched)
+    wfo = opx.Wavefronts()
+    wfo.initialize_proper(set_up_beam=True)
+    wfo.loop_collection(opx.offset_companion)
+    wfo.loop_collection(proper.prop_lens, fl)
+    steps = []
+    for dist in distances:
+        wfo.loop_collection(proper.prop_propagate, dist)
+        steps.append((np.array([[wf.wfarr for wf in sources] for sources in wfo.wf_collection]),
+                      [[{attr: getattr(wf, attr) for attr in state_attrs} for wf in sources]
+                       for sources in wfo.wf_collection]))
+    return steps
+
+
+@pytest.mark.parametrize('phase_offset', [False, True])
+def test_propagation_matches_proper(params, monkeypatch, phase_offset):
+    monkeypatch.setattr(proper, 'phase_offset', phase_offset)
+    expected = propagated(False, monkeypatch)
+    batched = propagated(True, monkeypatch)
+
+    for (fields, states), (expected_fields, expected_states) in zip(batched, expected):
+        assert np.allclose(fields, expected_fields, atol=1e-12 * np.abs(expected_fields).max())
+        for state, expected_state in zip(np.ravel(states), np.ravel(expected_states)):
+            assert state.keys() == expected_state.keys()
+            for attr in state_attrs:
+                if isinstance(expected_state[attr], str):
+                    assert state[attr] == expected_state[attr]
+                else:
+                    assert np.isclose(state[attr], expected_state[attr], rtol=1e-12)
+
+    # the distances go through every propagator
+    types = [states[0][0]['propagator_type'] for _, states in expected]
+    assert types == ['OUTSIDE_to_INSIDE_', 'INSIDE__to_INSIDE_', 'INSIDE__to_OUTSIDE', 'OUTSIDE_to_OUTSIDE']
+
+
+def test_wts_at_zero_distance(params, monkeypatch):
+    """ prop_wts marks the reference surface spherical before it returns for dz = 0 """
+    import medis.batched_optics as bopx
+    monkeypatch.setattr(sp, 'batched_wavefronts', True)
+    wfo = opx.Wavefronts()
+    wfo.initialize_proper()
+    before = wfo.stack.copy()
+    state = {attr: bopx.state_array(wfo, attr) for attr in ['lamda', 'dx', 'z', 'reference_surface']}
+    state['reference_surface'] = state['reference_surface'].astype(object)
+
+    bopx._wts(wfo, state, np.zeros(ap.n_wvl_init), np.ones(ap.n_wvl_init, dtype=bool))
+    assert list(state['reference_surface']) == ['SPHERI'] * ap.n_wvl_init
+    assert np.array_equal(wfo.stack, before)
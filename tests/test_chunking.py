@@ -0,0 +1,71 @@
+"""
+The time chunks planned in chunking.py stay inside sp.memory_limit and the h5 chunk limit
+"""
+
+import numpy as np
+import pytest
+
+import medis.chunking as chunking
+from medis.params import ap, sp
+
+
+@pytest.fixture
+def params(params, monkeypatch, companions):
+    monkeypatch.setattr(ap, 'n_wvl_init', 4)
+    monkeypatch.setattr(ap, 'n_wvl_final', 8)
+    monkeypatch.setattr(ap, 'interp_wvl', True)
+    monkeypatch.setattr(ap, 'interp_on_read', False)
+    companions([1e-2, 1e-3])
+    monkeypatch.setattr(sp, 'grid_size', 512)
+    monkeypatch.setattr(sp, 'save_list', ['atmosphere', 'detector'])
+    monkeypatch.setattr(sp, 'save_queue', 2)
+    monkeypatch.setattr(sp, 'fields_codec', None)
+
+
+def test_nice_chunk():
+    nice = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+    for max_chunk in range(1, 1500):
+        chunk = chunking.nice_chunk(max_chunk)
+        assert chunk in nice and chunk <= max_chunk
+        assert [n for n in nice if chunk < n <= max_chunk] == []  # the largest one below
+
+
+@pytest.mark.parametrize('markov', [True, False])
+@pytest.mark.parametrize('codec', [None, {'error_bound': 1e-3, 'keyframe_interval': 10}])
+@pytest.mark.parametrize('memory_limit', [0.5, 2, 20, 1e4])
+def test_fields_plan(params, monkeypatch, markov, codec, memory_limit):
+    monkeypatch.setattr(sp, 'fields_codec', codec)
+    plan = chunking.fields_plan(markov, num_processes=4, memory_limit=memory_limit, save_to_disk=True)
+    max_steps = plan['max_steps']
+    assert plan['timestep_size'] == chunking.timestep_bytes(8 if markov else 4, None if markov else np.complex128)
+
+    fits_memory = lambda steps: plan['fixed_bytes'] + steps * plan['step_bytes'] <= memory_limit * 1e9
+    fits_h5 = lambda steps: steps * plan['timestep_size'] <= chunking.h5_chunk_limit
+    assert max_steps >= 1
+    if max_steps > 1:
+        assert fits_memory(max_steps) and fits_h5(max_steps)
+    assert not (fits_memory(max_steps + 1) and fits_h5(max_steps + 1))  # the largest chunk that fits
+
+    if memory_limit == 1e4:
+        # only the h5 limit is left
+        assert max_steps == chunking.h5_chunk_limit // plan['timestep_size']
+        unsaved = chunking.fields_plan(markov, num_processes=4, memory_limit=memory_limit, save_to_disk=False)
+        assert unsaved['max_steps'] > max_steps
+
+
+def test_photons_plan(params):
+    shape = (1000, 8, 140, 146)
+    for memory_limit in [0.1, 1, 10, 100]:
+        for extra_events in [0, 10**6]:
+            num_events = 10**9
+            plan = chunking.photons_plan(num_events, shape, memory_limit=memory_limit, extra_events=extra_events)
+            max_steps = plan['max_steps']
+
+            fixed = np.prod(shape) * 8 + extra_events * chunking.photon_peak_bytes
+            fits = lambda steps: fixed + steps * plan['step_bytes'] <= memory_limit * 1e9
+            assert 1 <= max_steps <= shape[0]
+            if max_steps > 1:
+                assert fits(max_steps)
+            if max_steps < shape[0]:
+                assert not fits(max_steps + 1)
+            assert plan['photons_size'] == (num_events + extra_events) * chunking.photon_bytes
@@ -0,0 +1,57 @@
+"""
+Wavefronts.loop_collection spread over threads or processes (sp.collection_mode) against the serial loop
+"""
+
+import numpy as np
+import proper
+import pytest
+
+import medis.optics as opx
+from medis.params import ap, sp
+
+@pytest.fixture
+def params(params, monkeypatch, companions):
+    monkeypatch.setattr(ap, 'n_wvl_init', 3)
+    companions([1e-2, 1e-3], [[2., -1.], [-3., 4.]])
+
+
+def propagated():
+    """ fields of every wavefront after the companion tilts, an aperture and some defocus """
+    wfo = opx.Wavefronts()
+    wfo.initialize_proper(set_up_beam=True)
+    wfo.loop_collection(opx.offset_companion)
+    wfo.loop_collection(proper.prop_circular_aperture, radius=0.4)
+    wfo.loop_collection(proper.prop_zernikes, [4], [5e-8])
+    return np.array([[wf.wfarr for wf in sources] for sources in wfo.wf_collection])
+
+
+@pytest.mark.parametrize('mode', ['thread', 'process'])
+def test_parallel_matches_serial(params, monkeypatch, mode):
+    expected = propagated()
+    monkeypatch.setattr(sp, 'collection_mode', mode)
+    monkeypatch.setattr(sp, 'collection_workers', 2)
+    assert np.array_equal(propagated(), expected)
+
+    # the workers see params changed after they started
+    monkeypatch.setattr(ap, 'companion_xy', [[1., 1.], [-1., 2.]])
+    parallel = propagated()
+    monkeypatch.setattr(sp, 'collection_mode', None)
+    assert np.array_equal(parallel, propagated())
+
+
+def test_stale_executor_is_shut_down(params, monkeypatch):
+    monkeypatch.setattr(sp, 'collection_mode', 'thread')
+    monkeypatch.setattr(sp, 'collection_workers', 2)
+    first = opx.collection_executor()
+    assert opx.collection_executor() is first
+
+    monkeypatch.setattr(sp, 'collection_workers', 3)
+    second = opx.collection_executor()
+    assert second is not first
+    with pytest.raises(RuntimeError):
+        first.submit(print)  # shut down
+
+    opx.shutdown_collection_executor()
+    with pytest.raises(RuntimeError):
+        second.submit(print)
+    assert opx.collection_executor() not in [first, second]
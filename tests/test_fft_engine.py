@@ -0,0 +1,60 @@
+"""
+The sp.fft_engine backends against PROPER's own propagation, and switching PROPER to FFTW only for the process
+"""
+
+import os
+
+import numpy as np
+import proper
+import pytest
+
+import medis.fft_engine as fft_engine
+import medis.optics as opx
+from medis.params import sp
+
+fl = 10.  # focal length of the lens [m]
+
+
+@pytest.fixture
+def params(params, monkeypatch):
+    monkeypatch.setattr(proper, 'use_fftw', False)
+    monkeypatch.setattr(fft_engine, '_proper_fftw', {})
+
+
+def propagated(engine, monkeypatch):
+    """ fields and samplings after a lens, the focus and a distance well outside the Rayleigh range """
+    monkeypatch.setattr(sp, 'fft_engine', engine)
+    wfo = opx.Wavefronts()
+    wfo.initialize_proper(set_up_beam=True)
+    wfo.loop_collection(proper.prop_lens, fl)
+    fields, dx = [], []
+    for dist in [fl, 1e-3 * fl, fl]:
+        wfo.loop_collection(proper.prop_propagate, dist)
+        fields.append(np.array([wf.wfarr for wf in wfo.wf_collection[:, 0]]))
+        dx.append([wf.dx for wf in wfo.wf_collection[:, 0]])
+    return np.array(fields), np.array(dx)
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'scipy', 'pyfftw'])
+def test_engine_matches_proper(params, monkeypatch, engine):
+    if engine == 'pyfftw':
+        pytest.importorskip('pyfftw')
+    expected, expected_dx = propagated(None, monkeypatch)
+    fields, dx = propagated(engine, monkeypatch)
+
+    assert np.allclose(dx, expected_dx, rtol=1e-12)
+    assert np.allclose(fields, expected, atol=1e-10 * np.abs(expected).max())
+
+
+def test_configure_proper_is_per_process(params, monkeypatch, tmp_path):
+    pytest.importorskip('pyfftw')
+    monkeypatch.setenv('HOME', str(tmp_path))
+
+    monkeypatch.setattr(sp, 'fft_engine', 'pyfftw')
+    fft_engine.configure_proper()
+    assert proper.use_fftw
+    assert not os.path.exists(tmp_path / '.proper_use_fftw')
+
+    monkeypatch.setattr(sp, 'fft_engine', None)
+    fft_engine.configure_proper()
+    assert not proper.use_fftw  # back to how the session started
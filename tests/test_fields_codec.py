@@ -0,0 +1,87 @@
+"""
+The temporal delta codec of fields.h5 (sp.fields_codec)
+"""
+
+import numpy as np
+import pytest
+import tables
+
+import medis.fields_codec as codec
+
+error_bound = 1e-3
+shape = (12, 2, 3, 8, 8)  # (t, plane, wvl, x, y)
+
+
+def slowly_varying(real=False, seed=0):
+    """ fields that drift a little every timestep, as for a short sp.sample_time """
+    rng = np.random.default_rng(seed)
+    steps = rng.standard_normal(shape) if real else rng.standard_normal(shape) + 1j * rng.standard_normal(shape)
+    fields = steps[0] + 0.01 * np.cumsum(steps, axis=0)
+    return (fields.real if real else fields).astype(np.float32 if real else np.complex64)
+
+
+def write(filename, chunks, keyframe_interval=5):
+    with tables.open_file(filename, mode='w') as h5file:
+        encoder = codec.DeltaCodec(error_bound, keyframe_interval)
+        for chunk in chunks:
+            codec.append(h5file, chunk, encoder)
+
+
+def read(filename, key=slice(None)):
+    with tables.open_file(filename, mode='r') as h5file:
+        return codec.fields_array(h5file)[key], h5file.root.codec.keyframe_index[:]
+
+
+@pytest.mark.parametrize('real', [False, True])
+def test_error_bound(tmp_path, real):
+    fields = slowly_varying(real)
+    write(str(tmp_path / 'fields.h5'), np.array_split(fields, 3))
+    decoded, keyframe_index = read(str(tmp_path / 'fields.h5'))
+
+    assert decoded.dtype == fields.dtype and decoded.shape == fields.shape
+    assert np.max(np.abs(decoded - fields)) <= error_bound * (1 + 1e-3)
+    assert list(np.nonzero(keyframe_index >= 0)[0]) == [0, 5, 10]  # only at the start of the keyframe intervals
+
+
+def test_keyframe_on_overflow(tmp_path):
+    fields = slowly_varying()
+    fields[7] += 1e3 * error_bound * codec.int16_max  # a jump no int16 residual can hold
+    write(str(tmp_path / 'fields.h5'), [fields], keyframe_interval=100)
+    decoded, keyframe_index = read(str(tmp_path / 'fields.h5'))
+
+    assert list(np.nonzero(keyframe_index >= 0)[0]) == [0, 7, 8]
+    assert np.allclose(decoded[7], fields[7])
+    assert np.max(np.abs(decoded - fields) / np.maximum(1, np.abs(fields))) <= error_bound * (1 + 1e-3)
+
+
+@pytest.mark.parametrize('key', [3, -1, 0, slice(None), slice(2, 9), slice(1, 11, 3), slice(None, None, -1),
+                                 slice(10, 2, -3), slice(7, 7), (4, 1), (slice(6, 12), 0, slice(1, 3)),
+                                 (slice(None, None, -2), Ellipsis, 4)])
+def test_reader_indexing(tmp_path, key):
+    write(str(tmp_path / 'fields.h5'), [slowly_varying()])
+    decoded, _ = read(str(tmp_path / 'fields.h5'))
+    assert np.array_equal(read(str(tmp_path / 'fields.h5'), key)[0], decoded[key])
+
+
+def test_reader_index_error(tmp_path):
+    write(str(tmp_path / 'fields.h5'), [slowly_varying()])
+    with pytest.raises(IndexError):
+        read(str(tmp_path / 'fields.h5'), shape[0])
+
+
+def test_truncate_and_resume(tmp_path):
+    filename = str(tmp_path / 'fields.h5')
+    fields = slowly_varying()
+    write(filename, [fields[:4], fields[4:9]])
+
+    with tables.open_file(filename, mode='a') as h5file:
+        codec.truncate(h5file, 7)  # keeps the keyframe at 5 and two deltas after it
+        assert h5file.root.codec.keyframes.nrows == 2
+        # a resumed run has a new encoder with no previous frame
+        codec.append(h5file, fields[7:], codec.DeltaCodec(error_bound, keyframe_interval=5))
+
+    decoded, keyframe_index = read(filename)
+    assert decoded.shape == fields.shape
+    assert list(np.nonzero(keyframe_index >= 0)[0]) == [0, 5, 7]
+    assert list(keyframe_index[keyframe_index >= 0]) == [0, 1, 2]
+    assert np.max(np.abs(decoded - fields)) <= error_bound * (1 + 1e-3)
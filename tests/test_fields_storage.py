@@ -0,0 +1,131 @@
+"""
+fields.h5 written with the compression and chunk layouts of sp.fields_storage, and through the background
+FieldsWriter
+"""
+
+import numpy as np
+import pytest
+import tables
+
+import medis.telescope as telescope_module
+from medis.fields_store import FieldsStore
+from medis.params import ap, sp, iop
+from medis.telescope import Telescope
+
+n_wvl, grid_size, chunk_steps, n_chunks = 2, 8, 3, 2
+
+
+@pytest.fixture
+def telescope(params, tmp_path, monkeypatch, companions):
+    """ a Telescope that can only save and load fields """
+    companions([1e-2])
+    monkeypatch.setattr(ap, 'n_wvl_init', n_wvl)
+    monkeypatch.setattr(ap, 'n_wvl_final', n_wvl)
+    monkeypatch.setattr(ap, 'interp_on_read', False)
+    monkeypatch.setattr(sp, 'grid_size', grid_size)
+    monkeypatch.setattr(sp, 'save_list', ['detector'])
+    monkeypatch.setattr(sp, 'startframe', 0)
+    monkeypatch.setattr(sp, 'numframes', chunk_steps * n_chunks)
+    monkeypatch.setattr(sp, 'fields_storage', None)
+    monkeypatch.setattr(sp, 'fields_codec', None)
+    monkeypatch.setattr(iop, 'fields', str(tmp_path / 'fields.h5'))
+
+    telescope = Telescope.__new__(Telescope)  # skip the prescription set up
+    telescope.sampling = np.full((1, n_wvl), 1e-3)
+    telescope.chunk_steps = chunk_steps
+    return telescope
+
+
+def chunks():
+    """ the (span, fields) of each chunk create_fields would save """
+    rng = np.random.default_rng(0)
+    shape = (chunk_steps, 1, n_wvl, 2, grid_size, grid_size)
+    for ichunk in range(n_chunks):
+        fields = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+        yield (ichunk * chunk_steps, (ichunk + 1) * chunk_steps), fields
+
+
+@pytest.mark.parametrize('storage', ['frame', 'lightcurve', 'archive'])
+def test_storage_round_trip(telescope, monkeypatch, storage):
+    monkeypatch.setattr(sp, 'fields_storage', storage)
+    expected = []
+    for span, fields in chunks():
+        telescope.save_fields(fields, span)
+        expected.append(fields)
+    expected = np.concatenate(expected)
+
+    preset = telescope_module.storage_presets[storage]
+    with tables.open_file(iop.fields, mode='r') as h5file:
+        data = h5file.root.data
+        assert data.filters.complib == preset['complib']
+        assert data.filters.bitshuffle == preset['bitshuffle']
+        if preset['chunks'] == 'lightcurve':
+            assert data.chunkshape == (chunk_steps, 1, 1, 1, grid_size, grid_size)  # a pixel timeseries is one chunk
+        else:
+            assert data.chunkshape == (1, 1, 1, 1, grid_size, grid_size)
+
+    assert telescope.completed_steps() == sp.numframes
+    loaded = telescope.load_fields()
+    assert np.array_equal(loaded['fields'], expected)
+    assert np.array_equal(loaded['sampling'], np.full(n_wvl, 1e-3))
+    with FieldsStore(iop.fields) as store:
+        assert np.array_equal(store[:], expected)
+        assert np.array_equal(store[:, 0, 1, 1, 2], expected[:, 0, 1, 1, 2])  # a lightcurve
+
+
+def test_writer_reraises(telescope, monkeypatch):
+    saved = []
+
+    def save_fields(fields, span=None):
+        if saved:
+            raise OSError('disk full')
+        saved.append(span)
+    monkeypatch.setattr(telescope, 'save_fields', save_fields)
+
+    writer = telescope_module.FieldsWriter(telescope, maxsize=1)
+    writer.start()
+    for span, fields in chunks():
+        writer.put(fields, span)
+    with pytest.raises(OSError, match='disk full'):
+        writer.close()
+    assert not writer.is_alive()
+    assert saved == [(0, chunk_steps)]
+    with pytest.raises(OSError):
+        writer.put(fields, span)  # nothing more is queued after a failure
+
+
+def file_contents(filename):
+    """ every array and attribute of an h5 file """
+    with tables.open_file(filename, mode='r') as h5file:
+        arrays = {node._v_pathname: node.read() for node in h5file.walk_nodes('/', classname='Leaf')}
+        attrs = {name: h5file.root._v_attrs[name] for name in h5file.root._v_attrs._f_list()}
+    return arrays, attrs
+
+
+@pytest.mark.parametrize('fields_codec', [None, {'error_bound': 1e-3, 'keyframe_interval': 2}])
+def test_writer_matches_direct_write(telescope, monkeypatch, tmp_path, fields_codec):
+    """ create_fields writes the same fields.h5 through the FieldsWriter thread and with sp.save_queue = 0 """
+    monkeypatch.setattr(sp, 'fields_codec', fields_codec)
+    monkeypatch.setattr(sp, 'save_to_disk', True)
+    monkeypatch.setattr(sp, 'num_processes', 1)
+    monkeypatch.setattr(sp, 'fields_storage', 'archive')
+    expected = np.concatenate([fields for _, fields in chunks()])
+    monkeypatch.setattr(telescope, 'run_timestep', lambda t: (expected[t], telescope.sampling))
+    telescope.markov = True
+    telescope.resume_step = 0
+
+    contents = []
+    for save_queue in [0, 2]:
+        monkeypatch.setattr(sp, 'save_queue', save_queue)
+        monkeypatch.setattr(iop, 'fields', str(tmp_path / f'fields_{save_queue}.h5'))
+        telescope.encoder = None
+        telescope.create_fields()
+        contents.append(file_contents(iop.fields))
+
+    (direct, direct_attrs), (threaded, threaded_attrs) = contents
+    assert direct.keys() == threaded.keys()
+    assert len(threaded['/completed']) == n_chunks
+    for name in direct:
+        assert np.array_equal(direct[name], threaded[name])
+    assert direct_attrs.keys() == threaded_attrs.keys()
+    assert all(repr(direct_attrs[name]) == repr(threaded_attrs[name]) for name in direct_attrs)
@@ -0,0 +1,86 @@
+"""
+Lazy indexing and chunked reductions of FieldsStore against numpy on the whole fields, for plain, codec and
+interpolated on read fields.h5 files
+"""
+
+import numpy as np
+import pytest
+import tables
+
+import medis.fields_codec as codec
+import medis.optics as opx
+from medis.params import ap
+from medis.fields_store import FieldsStore
+
+n_steps, n_wvl, n_wvl_final, n_bodies, size = 7, 3, 5, 2, 4
+save_list = ['atmosphere', 'detector']
+
+
+def make_fields():
+    """ (t, plane, wvl, body, x, y) fields whose detector is saved as intensity """
+    rng = np.random.default_rng(0)
+    shape = (n_steps, len(save_list), n_wvl, n_bodies, size, size)
+    fields = rng.standard_normal(shape) + 1j * rng.standard_normal(shape)
+    fields[:, 1] = np.abs(fields[:, 1])**2
+    return fields.astype(np.complex64)
+
+
+@pytest.fixture(params=['data', 'codec', 'interp_on_read'])
+def store(request, tmp_path, monkeypatch):
+    """ a FieldsStore reading a few timesteps at a time and the fields numpy would give for the whole file """
+    monkeypatch.setattr(ap, 'contrast', [1e-2])
+    filename = str(tmp_path / 'fields.h5')
+    fields = make_fields()
+    with tables.open_file(filename, mode='w') as h5file:
+        if request.param == 'codec':
+            codec.append(h5file, fields, codec.DeltaCodec(1e-3, keyframe_interval=3))
+            fields = codec.fields_array(h5file)[:]
+        else:
+            h5file.create_earray(h5file.root, 'data', obj=fields)
+        h5file.root._v_attrs.save_list = save_list
+        h5file.root._v_attrs.save_specs = {'atmosphere': {'intensity': False}, 'detector': {'intensity': True}}
+        h5file.root._v_attrs.body_scaling = opx.body_scaling()
+        if request.param == 'interp_on_read':
+            h5file.root._v_attrs.n_wvl_final = n_wvl_final
+            fields = opx.interp_wavelength(fields, 2, weights=opx.wavelength_weights(n_wvl, n_wvl_final))
+
+    step_bytes = np.prod(fields.shape[1:]) * np.dtype(np.complex64).itemsize
+    with FieldsStore(filename, chunk_bytes=2 * step_bytes) as store:
+        yield store, fields
+
+
+def intensity(fields):
+    """ |E|^2 of the complex planes, the real part of the detector saved as intensity """
+    return np.stack([np.abs(fields[:, 0])**2, fields[:, 1].real], axis=1)
+
+
+@pytest.mark.parametrize('key', [2, -1, slice(None), slice(1, 6, 2), slice(None, None, -1), (Ellipsis, 1),
+                                 (slice(0, 4), 1, slice(None), 0), ([5, 0, 3],), (slice(None), [1, 0]),
+                                 (np.array([True, False, True, False, False, True, True]), 1),
+                                 (slice(5, 0, -2), 0, slice(None, None, -1)), slice(2, 5, -1),
+                                 (3, slice(None), [-1, 0], 1, slice(1, 3))])
+def test_indexing(store, key):
+    store, fields = store
+    assert np.allclose(store[key], fields[key])
+
+
+def test_reductions(store, tmp_path):
+    store, fields = store
+    eager = intensity(fields)
+    assert store.chunk_steps() == 2  # the reductions go through the file in several reads
+
+    assert np.allclose(store.intensity(), eager)
+    assert np.allclose(store.intensity(plane='detector'), eager[:, 1])
+    assert np.allclose(store.intensity(plane=0), eager[:, 0])
+    assert np.allclose(store.sum_bodies(), eager.sum(axis=3))
+    assert np.allclose(store.collapse_wavelength(plane='atmosphere', sum_bodies=True), eager[:, 0].sum(axis=(1, 2)))
+    binned = np.array([eager[first:first + 3].sum(axis=0) for first in range(0, n_steps, 3)])
+    assert np.allclose(store.bin_time(3), binned)
+    assert np.allclose(store.bin_time(3, plane='detector', sum_wavelengths=True), binned[:, 1].sum(axis=1))
+
+    store.sum_bodies(plane='detector', out=str(tmp_path / 'reduced.h5'))
+    with tables.open_file(str(tmp_path / 'reduced.h5'), mode='r') as h5file:
+        assert np.allclose(h5file.root.data[:], eager[:, 1].sum(axis=2))
+
+    with pytest.raises(ValueError):
+        store.reduce(intensity=False, sum_bodies=True)
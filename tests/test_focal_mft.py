@@ -0,0 +1,65 @@
+"""
+The detector plane propagated with a matrix Fourier transform (sp.focal_mft) against the FFT focus, and the MKID
+camera using it without interpolation
+"""
+
+import numpy as np
+import proper
+import pytest
+
+import medis.MKIDS as MKIDS
+import medis.optics as opx
+from medis.params import ap, sp, tp
+
+fl = 20.  # focal length of the lens [m]
+n_out = 16  # side of the MFT detector grid
+
+
+@pytest.fixture
+def params(params, monkeypatch):
+    monkeypatch.setattr(sp, 'grid_size', 64)
+    monkeypatch.setattr(sp, 'save_list', ['detector'])
+    # the native platescale of the FFT focus, which is the same at every wavelength when focused_sys is off
+    native = sp.beam_ratio * ap.wvl_range[0] / tp.entrance_d * 180 / np.pi * 3600
+    monkeypatch.setattr(sp, 'mft_grid', (n_out, native))
+
+
+def pupil():
+    wfo = opx.Wavefronts()
+    wfo.initialize_proper(set_up_beam=True)
+    proper.prop_zernikes(wfo.wf_collection[0, 0], [4, 5], [5e-8, -3e-8])  # so the focus isn't symmetric
+    return wfo
+
+
+def to_waist(wf):
+    proper.prop_propagate(wf, wf.z_w0 - wf.z)
+
+
+def test_mft_matches_fft(params, monkeypatch):
+    wfo = pupil()
+    wfo.loop_collection(proper.prop_lens, fl)
+    wfo.loop_collection(to_waist)
+    fft, fft_sampling = wfo.focal_plane()
+    lo = sp.grid_size // 2 - n_out // 2
+    fft = fft[..., lo:lo + n_out, lo:lo + n_out]
+
+    monkeypatch.setattr(sp, 'focal_mft', True)
+    mft, mft_sampling = pupil().mft_focal_plane(fl)
+
+    assert mft.shape[-1] == n_out
+    assert np.allclose(mft_sampling, fft_sampling)
+    assert np.allclose(mft, fft, atol=1e-5 * np.abs(fft).max())
+
+
+def test_rescale_cube_skips_interpolation(params, monkeypatch):
+    monkeypatch.setattr(sp, 'focal_mft', True)
+    monkeypatch.setattr(sp, 'mft_grid', (12, 0.1))
+    monkeypatch.setattr(sp, 'save_specs', {'detector': {'bin': 3, 'intensity': True}})
+    monkeypatch.setattr(MKIDS.interpolate, 'interp2d', None)  # fails if the cube is interpolated
+
+    camera = MKIDS.Camera.__new__(MKIDS.Camera)
+    camera.platescale = 0.3  # not exactly 0.1 * 3 in floating point
+    camera.array_size = np.array([2, 4])
+    cube = np.random.default_rng(0).random((2, 3, 4, 4))
+
+    assert np.array_equal(camera.rescale_cube(cube), cube[..., 1:3, :])
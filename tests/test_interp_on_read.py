@@ -0,0 +1,63 @@
+"""
+Reloading fields.h5 files saved with ap.interp_on_read, which hold ap.n_wvl_init wavelengths and are interpolated to
+their n_wvl_final attr as they are read
+"""
+
+import numpy as np
+import pytest
+import tables
+
+import medis.optics as opx
+from medis.params import ap, iop
+from medis.fields_store import FieldsStore
+from medis.telescope import Telescope
+
+n_wvl_init, n_wvl_final = 3, 5
+
+
+@pytest.fixture
+def interp_on_read_fields(tmp_path, monkeypatch):
+    """ a fields.h5 laid out as Telescope.save_fields writes it with ap.interp_on_read """
+    monkeypatch.setattr(ap, 'n_wvl_init', n_wvl_init)
+    monkeypatch.setattr(ap, 'n_wvl_final', n_wvl_final)
+    monkeypatch.setattr(ap, 'contrast', [])
+    filename = str(tmp_path / 'fields.h5')
+    monkeypatch.setattr(iop, 'fields', filename)
+
+    rng = np.random.default_rng(0)
+    fields = (rng.standard_normal((2, 1, n_wvl_init, 1, 4, 4)) +
+              1j * rng.standard_normal((2, 1, n_wvl_init, 1, 4, 4))).astype(np.complex64)
+    sampling = np.linspace(1e-3, 2e-3, n_wvl_init)[np.newaxis]
+    with tables.open_file(filename, mode='w') as h5file:
+        h5file.create_earray(h5file.root, 'data', obj=fields)
+        h5file.create_earray(h5file.root, 'sampling', obj=sampling)
+        h5file.root._v_attrs.save_list = ['detector']
+        h5file.root._v_attrs.save_specs = {'detector': {'intensity': False}}
+        h5file.root._v_attrs.body_scaling = opx.body_scaling([])
+        h5file.root._v_attrs.n_wvl_final = n_wvl_final
+    return fields, sampling
+
+
+def test_interp_wavelength_1d():
+    weights = opx.wavelength_weights(3, 5)
+    assert np.allclose(opx.interp_wavelength(np.array([1., 2., 3.]), ax=-1, weights=weights),
+                       np.linspace(1, 3, 5))
+
+
+def test_load_fields(interp_on_read_fields):
+    fields, sampling = interp_on_read_fields
+    telescope = Telescope.__new__(Telescope)  # only load_fields is needed, not the prescription set up
+    observation = telescope.load_fields()
+
+    assert observation['fields'].shape == (2, 1, n_wvl_final, 1, 4, 4)
+    assert observation['fields'].dtype == np.complex64
+    assert np.allclose(observation['fields'][:, :, [0, -1]], fields[:, :, [0, -1]])
+    assert np.allclose(observation['sampling'], np.linspace(1e-3, 2e-3, n_wvl_final))
+
+
+def test_fields_store(interp_on_read_fields):
+    fields, sampling = interp_on_read_fields
+    with FieldsStore(iop.fields) as store:
+        assert store.shape == (2, 1, n_wvl_final, 1, 4, 4)
+        assert np.allclose(store[:, :, 3], (fields[:, :, 1] + fields[:, :, 2]) / 2)
+        assert np.allclose(store.sampling, np.linspace(1e-3, 2e-3, n_wvl_final)[np.newaxis])
@@ -0,0 +1,138 @@
+"""
+The atmosphere stores and aberration maps in iop.map_cache, which are keyed by what they are made from and shared
+by every test and every number of timesteps
+"""
+
+import os
+
+import numpy as np
+import pytest
+import tables
+
+import medis.atmosphere as atmos
+import medis.aberrations as aber
+from medis.params import sp, tp, atmp, iop
+from medis.utils import readFITS
+
+lens = {'name': 'primary', 'diam': 8.0, 'aber_vals': [5e-18, 2.0, 3.1]}
+
+
+@pytest.fixture
+def map_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(iop, 'atmosdir', str(tmp_path / 'atmos'))
+    monkeypatch.setattr(iop, 'aberdir', str(tmp_path / 'aberrations'))
+    os.makedirs(iop.atmosdir)
+    os.makedirs(iop.aberdir)
+    monkeypatch.setattr(sp, 'grid_size', 16)
+    monkeypatch.setattr(sp, 'startframe', 0)
+    monkeypatch.setattr(sp, 'num_processes', 1)
+    monkeypatch.setattr(sp, 'verbose', False)
+    monkeypatch.setattr(tp, 'use_atmos', True)
+    monkeypatch.setattr(tp, 'lens_params', [lens])
+    monkeypatch.setattr(atmp, 'model', 'hcipy_standard')
+    monkeypatch.setattr(atmp, 'seed', 1)
+    monkeypatch.setattr(atmp, 'on_the_fly', False)
+    monkeypatch.setattr(atmp, 'correlated_sampling', False)
+    return tmp_path
+
+
+def read_store():
+    with tables.open_file(atmos.get_store(), mode='r') as h5file:
+        return h5file.root.opd[:]
+
+
+def test_keys_ignore_numframes(map_cache, monkeypatch):
+    monkeypatch.setattr(sp, 'numframes', 10)
+    store, aber_map = atmos.get_store(), aber.map_filename(lens['name'])
+    monkeypatch.setattr(sp, 'numframes', 100)
+    monkeypatch.setattr(sp, 'startframe', 50)
+    assert atmos.get_store() == store
+    assert aber.map_filename(lens['name']) == aber_map
+
+    monkeypatch.setattr(atmp, 'seed', 2)
+    monkeypatch.setattr(sp, 'grid_size', 32)
+    assert atmos.get_store() != store
+    assert aber.map_filename(lens['name']) != aber_map
+
+
+@pytest.mark.parametrize('num_processes', [1, 2, 3])
+def test_append_matches_one_shot(map_cache, monkeypatch, num_processes):
+    monkeypatch.setattr(sp, 'numframes', 4)
+    atmos.gen_atmos(debug=False)
+    one_shot = read_store()
+    os.remove(atmos.get_store())
+
+    monkeypatch.setattr(sp, 'num_processes', num_processes)
+    monkeypatch.setattr(sp, 'numframes', 1)
+    atmos.gen_atmos(debug=False)
+    monkeypatch.setattr(sp, 'startframe', 1)
+    monkeypatch.setattr(sp, 'numframes', 3)
+    atmos.gen_atmos(debug=False)
+
+    appended = read_store()
+    assert appended.shape == one_shot.shape == (4, sp.grid_size, sp.grid_size)
+    assert np.array_equal(appended, one_shot)
+
+
+def test_append_only_makes_new_timesteps(map_cache, monkeypatch):
+    made = []
+    opd = atmos.ScreenEngine.opd
+    monkeypatch.setattr(atmos.ScreenEngine, 'opd', lambda engine, it: made.append(it) or opd(engine, it))
+    monkeypatch.setattr(sp, 'numframes', 3)
+    atmos.gen_atmos(debug=False)
+    monkeypatch.setattr(sp, 'startframe', 3)
+    monkeypatch.setattr(sp, 'numframes', 2)
+    atmos.gen_atmos(debug=False)
+
+    assert made == list(range(5))
+    engine = atmos.ScreenEngine(atmp.seed)
+    assert np.array_equal(read_store(), [engine.opd(it) for it in range(5)])  # the same maps as on the fly
+
+
+
+def test_unseeded_store_matches_on_the_fly(map_cache, monkeypatch):
+    monkeypatch.setattr(atmp, 'seed', None)
+    monkeypatch.setattr(sp, 'numframes', 3)
+    np.random.seed(5)
+    expected = np.random.random(3)
+
+    np.random.seed(5)
+    atmos.gen_atmos(debug=False)
+    assert np.array_equal(np.random.random(3), expected)
+    assert atmp.seed is None
+
+    assert atmos.stored_frames(atmos.get_store()) == (3, atmos.engine_seed())
+    engine = atmos.get_engine()
+    assert np.array_equal(read_store(), [engine.opd(it) for it in range(3)])
+
+def test_corrsequence_matches_recursion():
+    """ the linear filter gives the python recursion it replaced, which started from r[0] = 0 """
+    n, tau = 200, 7.
+    np.random.seed(3)
+    g = np.random.normal(0, 1, n)
+    f = np.exp(-1. / tau)
+    r = np.zeros(n)
+    for i in range(1, n):
+        r[i] = r[i - 1] * f + g[i] * np.sqrt(1 - f**2)
+
+    np.random.seed(3)
+    t, filtered = atmos.corrsequence(n, tau)
+    assert np.array_equal(t, np.arange(n))
+    assert np.allclose(filtered, r, rtol=1e-12, atol=1e-12)
+
+
+def test_random_state_untouched(map_cache, monkeypatch):
+    monkeypatch.setattr(sp, 'numframes', 2)
+    np.random.seed(5)
+    expected = np.random.random(3)
+
+    np.random.seed(5)
+    aber.generate_maps(lens['aber_vals'], lens['diam'], lens['name'])
+    atmos.gen_atmos(debug=False)
+    assert np.array_equal(np.random.random(3), expected)
+
+    first = readFITS(aber.map_filename(lens['name']))
+    os.remove(aber.map_filename(lens['name']))
+    np.random.seed(6)  # the map only depends on the map key
+    aber.generate_maps(lens['aber_vals'], lens['diam'], lens['name'])
+    assert np.array_equal(readFITS(aber.map_filename(lens['name'])), first)
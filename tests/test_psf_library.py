@@ -0,0 +1,94 @@
+"""
+Injecting companions from an off-axis PSF library into star-only fields and intensity cubes
+"""
+
+import numpy as np
+import pytest
+import tables
+
+import medis.optics as opx
+import medis.psf_library as psf_library
+from medis.params import ap, sp, tp, iop
+from medis.psf_library import PSFLibrary
+
+separations, n_angles, n_wvl, size = [2., 4.], 4, 3, 8
+positions, contrasts = [[3., 1.], [-1., -2.5]], [1e-2, 1e-3]
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    """ a PSFLibrary loaded from a file of random grid PSFs instead of being propagated """
+    monkeypatch.setattr(iop, 'psf_library', str(tmp_path))
+    monkeypatch.setattr(psf_library, 'library_key', lambda *args: 'test')
+    monkeypatch.setattr(tp, 'prescription', 'test')
+    monkeypatch.setattr(tp, 'rot_rate', 0)
+    monkeypatch.setattr(sp, 'startframe', 0)
+    monkeypatch.setattr(sp, 'save_list', ['atmosphere', 'detector'])
+
+    rng = np.random.default_rng(0)
+    shape = (len(separations), n_angles, n_wvl, size, size)
+    psfs = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+    with tables.open_file(str(tmp_path / 'test_test.h5'), mode='w') as h5file:
+        h5file.create_array(h5file.root, 'psfs', psfs)
+        h5file.create_array(h5file.root, 'pixel_matrix', np.tile(0.5 * np.eye(2), (n_wvl, 1, 1)))
+        h5file.create_array(h5file.root, 'sampling', np.ones(n_wvl))
+        h5file.root._v_attrs.parity = 1
+
+    with PSFLibrary(separations, n_angles) as library:
+        yield library
+
+
+def star(shape):
+    rng = np.random.default_rng(1)
+    return rng.standard_normal(shape) + 1j * rng.standard_normal(shape)
+
+
+def test_inject_fields(library):
+    data = star((2, 2, n_wvl, 1, size, size)).astype(np.complex64)  # (t, plane, wvl, body, x, y) star only
+    fields = library.inject(data, positions, contrasts)
+
+    assert fields.shape == (2, 2, n_wvl, 1 + len(positions), size, size)
+    assert np.array_equal(fields[:, :, :, :1], data)
+    assert not fields[:, 0, :, 1:].any()  # only the detector gets the companions
+    for ic, (position, contrast) in enumerate(zip(positions, contrasts)):
+        expected = np.sqrt(contrast) * library.psf(position)
+        assert np.allclose(fields[:, 1, :, 1 + ic], expected, atol=1e-6)
+
+
+def test_inject_cube(library):
+    cube = np.abs(star((2, n_wvl, size, size)))**2  # (t, wvl, x, y)
+    injected = library.inject(cube, positions, contrasts)
+
+    added = sum(contrast * np.abs(library.psf(position))**2 for position, contrast in zip(positions, contrasts))
+    assert injected.shape == cube.shape
+    assert np.allclose(injected - cube, added[np.newaxis], atol=1e-6)
+
+
+def test_inject_shape_mismatch(library):
+    with pytest.raises(ValueError):
+        library.inject(star((1, 2, n_wvl + 1, 1, size, size)), positions, contrasts)
+    with pytest.raises(ValueError):
+        library.inject(np.ones((1, n_wvl, size + 1, size + 1)), positions, contrasts)
+
+
+def test_pixel_matrix_on_the_mft_grid(params, monkeypatch, companions):
+    """ a companion on the sp.focal_mft detector is the star shifted by detector_pixel_matrix """
+    companions([1.])
+    monkeypatch.setattr(sp, 'grid_size', 64)
+    monkeypatch.setattr(sp, 'save_list', ['detector'])
+    native = sp.beam_ratio * ap.wvl_range[0] / tp.entrance_d * 180 / np.pi * 3600
+    monkeypatch.setattr(sp, 'focal_mft', True)
+    monkeypatch.setattr(sp, 'mft_grid', (32, 1.5 * native))  # detector pixels of 1.5 FFT pixels
+
+    pixel_matrix = psf_library.detector_pixel_matrix()
+    position = np.linalg.solve(pixel_matrix[0], [1.3, -0.8])
+    companions([1.], [position])
+    wfo = opx.Wavefronts()
+    wfo.initialize_proper(set_up_beam=True)
+    wfo.loop_collection(opx.offset_companion)
+    fields, _ = wfo.mft_focal_plane(20.)
+    star, companion = fields[0, :, 0], fields[0, :, 1]
+
+    shifts = np.einsum('wpk,k->wp', pixel_matrix, position)
+    error = min(np.linalg.norm(opx.fourier_shift(star, parity * shifts) - companion) for parity in [1, -1])
+    assert error < 0.05 * np.linalg.norm(companion)
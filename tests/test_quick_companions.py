@@ -0,0 +1,84 @@
+"""
+Companions made by shifting the star (sp.quick_companions) against companions propagated in full
+"""
+
+import numpy as np
+import proper
+import pytest
+
+import medis.optics as opx
+from medis.params import ap, sp, tp
+
+fl = 20.  # focal length of the lens [m]
+shifts = [[0.3, -0.6], [2., -3.]]  # sub-pixel and whole pixel shifts of the companions at the first wavelength
+
+
+@pytest.fixture
+def params(params, monkeypatch, companions):
+    monkeypatch.setattr(sp, 'grid_size', 64)
+
+    # positions whose shifts at the first wavelength are shifts
+    companions([1e-2, 1e-3], [[1., 0.], [0., 1.]])
+    pixel_matrix = np.array(opx.companion_offsets()[0][:, 0]).T
+    companions([1e-2, 1e-3], [np.linalg.solve(pixel_matrix, shift) for shift in shifts])
+
+
+def focus(step=0):
+    """ (n_wavelengths, n_bodies, x, y) centred fields at the focus of a lens """
+    wfo = opx.Wavefronts()
+    wfo.initialize_proper(set_up_beam=True)
+    if wfo.num_bodies > 1:
+        wfo.loop_collection(opx.offset_companion, step=step)
+    wfo.loop_collection(proper.prop_circular_aperture, radius=tp.entrance_d / 2)
+    wfo.loop_collection(opx.prop_pass_lens, fl, fl)
+    return np.array([[proper.prop_shift_center(wf.wfarr) for wf in sources] for sources in wfo.wf_collection])
+
+
+def quick_error(step=0):
+    """ relative error of each companion made by shifting the star, for the better of the two parities """
+    full = focus(step)
+    sp.quick_companions = True
+    try:
+        star = focus(step)
+    finally:
+        sp.quick_companions = False
+
+    errors = []
+    for parity in [1, -1]:
+        quick = opx.add_quick_companions(star[np.newaxis], step, parity)[0]
+        errors.append([np.linalg.norm(quick[:, ib] - full[:, ib]) / np.linalg.norm(full[:, ib])
+                       for ib in range(full.shape[1])])
+    return min(errors, key=max)
+
+
+def test_quick_matches_full(params):
+    errors = quick_error()
+    assert errors[0] == 0  # the star is left alone
+    assert max(errors[1:]) < 1e-4
+
+
+def test_quick_matches_full_rotated(params, monkeypatch):
+    monkeypatch.setattr(tp, 'rot_rate', 30)  # the analytic rotation of companion_offsets
+    assert max(quick_error(step=7)) < 1e-4
+
+
+def test_offsets_are_cached(params, monkeypatch):
+    opx.companion_offsets()
+    monkeypatch.setattr(proper, 'prop_begin', None)  # rotating the companions doesn't need a wavefront
+    monkeypatch.setattr(tp, 'rot_rate', 90 / sp.sample_time)
+    rotated, amps = opx.companion_offsets(step=1)
+    assert np.allclose(rotated[:, 0], np.array(shifts)[:, ::-1] * [1, -1])
+    assert np.allclose(amps, np.sqrt(ap.contrast)[:, np.newaxis])
+
+
+def test_fourier_shift():
+    rng = np.random.default_rng(0)
+    fields = rng.standard_normal((2, 16, 16)) + 1j * rng.standard_normal((2, 16, 16))
+    assert np.allclose(opx.fourier_shift(fields, [[2, -3], [0, 5]]),
+                       [np.roll(fields[0], (2, -3), axis=(0, 1)), np.roll(fields[1], (0, 5), axis=(0, 1))])
+    half = opx.fourier_shift(fields, [[0.5, 0.25]] * 2)
+    assert np.allclose(opx.fourier_shift(half, [[0.5, 0.75]] * 2), np.roll(fields, (1, 1), axis=(1, 2)))
+    assert np.allclose(opx.shift_ramp([[0, 0]], (4, 4)), 1)
+
+    intensity = np.abs(fields)**2
+    assert np.isrealobj(opx.fourier_shift(intensity, [[0.5, 0.5]] * 2))
@@ -0,0 +1,116 @@
+"""
+Resuming a run from the timestep ranges Telescope.save_fields records in /completed of fields.h5
+"""
+
+import os
+
+import numpy as np
+import pytest
+import tables
+
+import medis.fields_codec as codec
+from medis.params import ap, sp, iop
+from medis.telescope import Telescope
+
+n_wvl, grid_size, numframes = 2, 4, 6
+
+
+@pytest.fixture
+def telescope(tmp_path, monkeypatch):
+    """ a Telescope that can only save and validate fields, with a small 6 timestep simulation """
+    monkeypatch.setattr(ap, 'n_wvl_init', n_wvl)
+    monkeypatch.setattr(ap, 'n_wvl_final', n_wvl)
+    monkeypatch.setattr(ap, 'interp_on_read', False)
+    monkeypatch.setattr(ap, 'contrast', [])
+    monkeypatch.setattr(sp, 'grid_size', grid_size)
+    monkeypatch.setattr(sp, 'save_list', ['atmosphere'])
+    monkeypatch.setattr(sp, 'save_specs', {})
+    monkeypatch.setattr(sp, 'startframe', 0)
+    monkeypatch.setattr(sp, 'numframes', numframes)
+    monkeypatch.setattr(sp, 'fields_storage', None)
+    monkeypatch.setattr(sp, 'fields_codec', None)
+    monkeypatch.setattr(iop, 'fields', str(tmp_path / 'fields.h5'))
+
+    telescope = Telescope.__new__(Telescope)  # skip the prescription set up
+    telescope.sampling = np.ones((1, n_wvl))
+    return telescope
+
+
+def chunk(first, last):
+    """ fields of timesteps [first, last) laid out as create_fields saves them """
+    rng = np.random.default_rng(first)
+    shape = (last - first, 1, n_wvl, 1, grid_size, grid_size)
+    return (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+
+
+def n_rows(filename):
+    with tables.open_file(filename, mode='r') as h5file:
+        return codec.fields_array(h5file).nrows, h5file.root.completed.nrows
+
+
+@pytest.mark.parametrize('fields_codec', [None, {'error_bound': 1e-3, 'keyframe_interval': 3}])
+def test_incomplete_tail_is_dropped(telescope, monkeypatch, fields_codec):
+    monkeypatch.setattr(sp, 'fields_codec', fields_codec)
+    telescope.save_fields(chunk(0, 2), span=(0, 2))
+    telescope.save_fields(chunk(2, 4), span=(2, 4))
+    telescope.save_fields(chunk(4, 6))  # the run died before this range was recorded
+
+    assert telescope.completed_steps() == 4
+    assert n_rows(iop.fields) == (4, 2)
+
+    telescope.encoder = None  # a resumed run starts a new encoder
+    telescope.save_fields(chunk(4, 6), span=(4, 6))
+    assert telescope.completed_steps() == numframes
+    with tables.open_file(iop.fields, mode='r') as h5file:
+        fields = codec.fields_array(h5file)[:]
+    expected = np.concatenate([chunk(0, 2), chunk(2, 4), chunk(4, 6)])
+    assert np.allclose(fields, expected, atol=2e-3)
+
+
+def test_nothing_done_deletes_the_file(telescope):
+    telescope.save_fields(chunk(0, 2))
+
+    assert telescope.completed_steps() == 0
+    assert not os.path.exists(iop.fields)
+
+
+def test_without_completed_is_complete(telescope):
+    fields = chunk(0, 3)
+    with tables.open_file(iop.fields, mode='w') as h5file:  # written before ranges were recorded
+        h5file.create_earray(h5file.root, 'data', obj=fields)
+
+    assert telescope.completed_steps() == numframes
+    with tables.open_file(iop.fields, mode='r') as h5file:
+        assert np.array_equal(h5file.root.data[:], fields)
+
+
+def test_resumed_run_returns_every_timestep(telescope, monkeypatch):
+    monkeypatch.setattr(ap, 'companion', False)
+    monkeypatch.setattr(sp, 'save_to_disk', True)
+    monkeypatch.setattr(sp, 'save_queue', 0)
+    monkeypatch.setattr(sp, 'num_processes', 1)
+    monkeypatch.setattr(sp, 'quick_companions', False)
+    expected = np.concatenate([chunk(0, 2), chunk(2, 4), chunk(4, 6)])
+    telescope.save_fields(expected[:2], span=(0, 2))
+    telescope.save_fields(expected[2:4], span=(2, 4))  # the run died after the first 4 timesteps
+
+    # the state Telescope.__init__ leaves for a resumed run that fits in one chunk
+    telescope.fields_exists = False
+    telescope.resume_step = telescope.completed_steps()
+    telescope.markov = True
+    telescope.chunk_steps = numframes
+    telescope.num_chunks = 1
+    telescope.usesave = False
+    telescope.fieldssize = 0
+    telescope.encoder = None
+    made = []
+
+    def run_timestep(t):
+        made.append(t)
+        return expected[t], np.ones((1, n_wvl))
+    monkeypatch.setattr(telescope, 'run_timestep', run_timestep)
+
+    fields = telescope()['fields']
+    assert made == [4, 5]
+    assert fields.shape[0] == numframes
+    assert np.array_equal(fields, expected)
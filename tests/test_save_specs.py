@@ -0,0 +1,93 @@
+"""
+Per-plane save specs (sp.save_specs): the shape and content save_plane writes, and the MKID camera reading planes
+saved as intensity
+"""
+
+import numpy as np
+import proper
+import pytest
+
+import medis.MKIDS as MKIDS
+import medis.optics as opx
+from medis.params import ap, sp
+
+specs = [{}, {'roi': 8}, {'bin': 2}, {'downsample': 4}, {'roi': 12, 'bin': 3}, {'intensity': True},
+         {'intensity': True, 'bin': 2, 'dtype': np.float64}, {'dtype': np.complex128},
+         {'roi': 8, 'downsample': 2, 'intensity': True}]
+
+
+@pytest.fixture
+def params(params, monkeypatch, companions):
+    companions([1e-2])
+    monkeypatch.setattr(sp, 'grid_size', 16)
+    monkeypatch.setattr(sp, 'save_list', ['atmosphere', 'detector'])
+
+
+def random_wavefronts():
+    """ Wavefronts whose fields are noise, so every pixel of a saved plane is checked """
+    wfo = opx.Wavefronts()
+    wfo.initialize_proper()
+    rng = np.random.default_rng(0)
+    for wf in wfo.wf_collection.flat:
+        wf.wfarr[...] = rng.standard_normal(wf.wfarr.shape) + 1j * rng.standard_normal(wf.wfarr.shape)
+    return wfo
+
+
+@pytest.mark.parametrize('batched', [False, True])
+@pytest.mark.parametrize('spec', specs)
+def test_save_plane_matches_spec(params, monkeypatch, spec, batched):
+    monkeypatch.setattr(sp, 'batched_wavefronts', batched)
+    monkeypatch.setattr(sp, 'save_specs', {'atmosphere': {'roi': 12}, 'detector': spec})
+    wfo = random_wavefronts()
+    centred = np.array([[proper.prop_shift_center(wf.wfarr) for wf in sources] for sources in wfo.wf_collection])
+    sampling = [proper.prop_get_sampling(wf) for wf in wfo.wf_collection[:, 0]]
+
+    wfo.save_plane('atmosphere')
+    wfo.save_plane('detector')
+
+    saved = opx.plane_size('detector')
+    assert saved == spec.get('roi', sp.grid_size) // (spec.get('bin', 1) * spec.get('downsample', 1))
+    size = max(saved, 12)  # smaller planes are padded to the largest
+    assert opx.saved_size() == size
+    assert wfo.Efield_planes.shape == opx.saved_shape() == (2, 2, 2, size, size)
+    assert wfo.Efield_planes.dtype == opx.saved_dtype()
+
+    assert np.allclose(wfo.Efield_planes[0], opx.reduce_plane(centred, 'atmosphere'))
+    assert np.allclose(wfo.Efield_planes[1], opx.reduce_plane(centred, 'detector'))
+    lo = opx.saved_size() // 2 - saved // 2
+    detector = wfo.Efield_planes[1, ..., lo:lo + saved, lo:lo + saved]
+    if spec.get('intensity'):
+        assert np.allclose(detector.imag, 0)
+        # binning sums the intensity, so the total is kept when the whole roi is binned
+        if spec.get('downsample', 1) == 1:
+            roi = spec.get('roi', sp.grid_size)
+            lo_roi = sp.grid_size // 2 - roi // 2
+            assert np.allclose(detector.real.sum(axis=(-2, -1)),
+                               np.sum(np.abs(centred[..., lo_roi:lo_roi + roi, lo_roi:lo_roi + roi])**2,
+                                      axis=(-2, -1)))
+    assert np.allclose(wfo.plane_sampling[1], np.array(sampling) * spec.get('bin', 1) * spec.get('downsample', 1))
+
+
+def test_quantize_intensity_matches_complex(params, monkeypatch):
+    """ the camera gives the same cube from a detector saved as intensity as from the complex detector """
+    monkeypatch.setattr(sp, 'focal_mft', True)  # so the cube is only cut out, see rescale_cube
+    monkeypatch.setattr(sp, 'mft_grid', (8, 0.01))
+    monkeypatch.setattr(sp, 'quick_detect', True)
+    monkeypatch.setattr(ap, 'interp_on_read', False)
+    monkeypatch.setattr(ap, 'n_wvl_final', 2)
+    rng = np.random.default_rng(0)
+    fields = rng.standard_normal((3, 2, 2, 2, 8, 8)) + 1j * rng.standard_normal((3, 2, 2, 2, 8, 8))
+
+    cubes = []
+    for intensity in [False, True]:
+        monkeypatch.setattr(sp, 'save_specs', {'detector': {'intensity': intensity}})
+        camera = MKIDS.Camera.__new__(MKIDS.Camera)
+        camera.product = 'rebinned_cube'
+        camera.platescale = 0.01
+        camera.array_size = np.array([8, 8])
+        saved = np.abs(fields)**2 if intensity else fields
+        camera.quantize(saved.astype(opx.saved_dtype()))
+        cubes.append(camera.rebinned_cube)
+
+    assert cubes[0].shape == (3, 2, 8, 8)
+    assert np.allclose(cubes[0], cubes[1], rtol=1e-5)
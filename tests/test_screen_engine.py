@@ -0,0 +1,97 @@
+"""
+The frozen flow ScreenEngine that makes the atmosphere screens in memory (atmp.on_the_fly)
+"""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from scipy import integrate, special
+
+import medis.atmosphere as atmos
+from medis.params import sp, tp, atmp
+
+
+@pytest.fixture
+def params(params, monkeypatch):
+    monkeypatch.setattr(sp, 'sample_time', 0.01)
+    monkeypatch.setattr(sp, 'startframe', 0)
+    monkeypatch.setattr(sp, 'numframes', 10)
+    monkeypatch.setattr(tp, 'entrance_d', 5)
+    monkeypatch.setattr(atmp, 'model', 'single')
+    monkeypatch.setattr(atmp, 'vel', 5)
+    monkeypatch.setattr(atmp, 'seed', None)
+    monkeypatch.setattr(atmp, 'correlated_sampling', False)
+
+
+def test_any_timestep(params):
+    engine = atmos.ScreenEngine(3)
+    in_order = [engine.opd(it) for it in range(12)]
+    assert np.array_equal(atmos.ScreenEngine(3).opd(11), in_order[11])
+    assert not np.array_equal(atmos.ScreenEngine(4).opd(11), in_order[11])
+
+
+def test_steps_are_shifts(params, monkeypatch):
+    monkeypatch.setattr(atmp, 'vel', 0.25 * tp.entrance_d / sp.grid_size / sp.sample_time)  # a quarter pixel a step
+    engine = atmos.ScreenEngine(0)
+    screens = np.array([engine.opd(it) for it in range(5)], dtype=np.float64)
+    scale = np.abs(screens).max()
+
+    # the flow is along x (the last axis) and the screen is interpolated linearly between pixels
+    assert np.allclose(screens[1, :, :-1], 0.75 * screens[0, :, :-1] + 0.25 * screens[0, :, 1:], atol=1e-3 * scale)
+    assert np.allclose(screens[4, :, :-1], screens[0, :, 1:], atol=1e-5 * scale)
+
+
+def test_structure_function(params):
+    """ the structure function of the screens against von Karman, band limited to the frequencies of the grid """
+    separations = np.array([2, 4, 8])
+    measured = []
+    for seed in range(20):
+        engine = atmos.ScreenEngine(seed)
+        for it in range(0, 400, 80):
+            screen = engine.opd(it).astype(np.float64)
+            measured.append([[np.mean((screen[r:] - screen[:-r])**2) for r in separations],
+                             [np.mean((screen[:, r:] - screen[:, :-r])**2) for r in separations]])
+    measured = np.mean(measured, axis=0)
+
+    f = np.logspace(-5, np.log10(0.5 / engine.dx), 100000)
+    theory = [integrate.trapezoid(4 * np.pi * f * engine.psd(f**2, 0) * (1 - special.j0(2 * np.pi * f * r * engine.dx)),
+                                  f) for r in separations]
+    assert np.allclose(measured / theory, 1, atol=0.15)
+
+
+def test_engine_seed(params, monkeypatch):
+    first = atmos.get_engine()
+    assert atmp.seed is None  # the params are left as they were
+    assert atmos.get_engine() is first
+    assert first.seed == atmos.engine_seed()
+    store = atmos.get_store()
+
+    monkeypatch.setattr(atmp, 'vel', 7)  # new params make a new engine with a new seed
+    assert atmos.get_engine().seed != first.seed
+    monkeypatch.setattr(atmp, 'vel', 5)
+    assert atmos.get_store() == store
+
+    monkeypatch.setattr(atmp, 'seed', 11)
+    assert atmos.get_engine().seed == 11
+
+
+def test_load_step_from_threads(params, monkeypatch):
+    """ the threads of sp.collection_mode='thread' share the engine and the step cache """
+    monkeypatch.setattr(atmp, 'on_the_fly', True)
+    monkeypatch.setattr(atmp, 'vel', 200)  # a new block every few timesteps
+    monkeypatch.setattr(atmos.ScreenEngine, 'block_cache_size', 1)
+    monkeypatch.setattr(atmos, '_step_cache', {'key': None})
+    steps = np.random.default_rng(0).permutation([it for it in range(40) for _ in range(4)])
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # so the threads interleave within load_step
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            screens = list(executor.map(atmos.load_step, steps))
+    finally:
+        sys.setswitchinterval(interval)
+
+    engine = atmos.ScreenEngine(atmos.engine_seed())
+    for it, screen in zip(steps, screens):
+        assert np.array_equal(screen, engine.opd(it))
@@ -0,0 +1,76 @@
+"""
+The cached screens of the static segments of a prescription (sp.static_segments) against running every optic
+"""
+
+import os
+
+import numpy as np
+import proper
+import pytest
+
+import medis.aberrations as aber
+import medis.static_optics as static
+from medis.params import sp, tp, iop
+
+lenses = [{'aber_vals': [5e-18, 2.0, 3.1], 'diam': 0.2, 'focal_length': 1.2, 'dist': 1.345, 'name': 'CPA'},
+          {'aber_vals': [5e-18, 2.0, 3.1], 'diam': 0.2, 'focal_length': 1.2, 'dist': 1.345, 'name': 'NCPA'}]
+
+
+@pytest.fixture
+def params(params, tmp_path, monkeypatch, companions):
+    monkeypatch.syspath_prepend(os.path.join(iop.prescriptions_root, 'general_telescope'))
+    monkeypatch.setattr(iop, 'aberdir', str(tmp_path))
+    companions([1e-2], [[2., -1.]])
+    monkeypatch.setattr(sp, 'save_list', ['NCPA', 'pre_coron', 'detector'])  # NCPA is saved inside the segment
+    monkeypatch.setattr(sp, 'closed_loop', False)
+    monkeypatch.setattr(sp, 'ao_delay', 0)
+    monkeypatch.setattr(tp, 'prescription', 'general_telescope')
+    monkeypatch.setattr(tp, 'lens_params', lenses)
+    monkeypatch.setattr(tp, 'use_atmos', False)
+    monkeypatch.setattr(tp, 'use_ao', False)
+    monkeypatch.setattr(tp, 'use_aber', True)
+    monkeypatch.setattr(tp, 'obscure', True)
+    monkeypatch.setattr(tp, 'cg_type', None)
+    monkeypatch.setattr(aber, 'loaded_maps', {})
+    for lens in lenses:
+        aber.generate_maps(lens['aber_vals'], lens['diam'], lens['name'])
+    static.clear_cache()
+    yield
+    static.clear_cache()
+
+
+def run(steps):
+    return [proper.prop_run(tp.prescription, 1, sp.grid_size, PASSVALUE={'iter': t}, QUIET=True) for t in steps]
+
+
+@pytest.mark.parametrize('batched', [False, True])
+def test_segments_match_every_optic(params, monkeypatch, batched):
+    monkeypatch.setattr(sp, 'batched_wavefronts', batched)
+    monkeypatch.setattr(sp, 'static_segments', False)
+    expected = run(range(3))
+
+    monkeypatch.setattr(sp, 'static_segments', True)
+    folded = []
+    fold = static.StaticSegment.fold
+    monkeypatch.setattr(static.StaticSegment, 'fold',
+                        lambda segment, *args: folded.append(segment.cached is not None) or fold(segment, *args))
+    segments = run(range(3))
+
+    assert set(key[0] for key in static._segments) == {'CPA', 'post_ao'}
+    assert any(folded) and not all(folded)  # the later timesteps replay the screens of the first
+    for (fields, sampling), (expected_fields, expected_sampling) in zip(segments, expected):
+        assert np.all(np.abs(fields).max(axis=(-2, -1)) > 0)  # every plane, wavelength and body was saved
+        assert np.array_equal(fields, expected_fields)
+        assert np.array_equal(sampling, expected_sampling)
+
+
+def test_replay_on_a_later_timestep(params, monkeypatch):
+    """ a cache made at one timestep replays the same optics at any other """
+    monkeypatch.setattr(sp, 'batched_wavefronts', False)
+    monkeypatch.setattr(sp, 'static_segments', False)
+    expected = run([7])
+
+    monkeypatch.setattr(sp, 'static_segments', True)
+    run([0])
+    segments = run([7])
+    assert np.array_equal(segments[0][0], expected[0][0])
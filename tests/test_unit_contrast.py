@@ -0,0 +1,94 @@
+"""
+Reusing fields stored at unit contrast (sp.unit_contrast) after ap.contrast changes, instead of rerunning the
+simulation
+"""
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+import medis.optics as opx
+import medis.utils as mu
+from medis.params import ap, sp, tp, atmp, mp, iop, IO_params
+from medis.CDI import cdi
+from medis.fields_store import FieldsStore
+from medis.medis_main import RunMedis
+from medis.telescope import Telescope
+
+old_contrast, new_contrast = [1e-3], [1e-2]
+
+
+@pytest.fixture
+def testdir(tmp_path, monkeypatch):
+    """ a testdir whose params.pkl and fields.h5 were made at old_contrast with sp.unit_contrast """
+    for attr, value in vars(IO_params(datadir=str(tmp_path), testname='unit_contrast')).items():
+        monkeypatch.setattr(iop, attr, value)
+    monkeypatch.setattr(ap, 'contrast', old_contrast)
+    monkeypatch.setattr(ap, 'n_wvl_init', 2)
+    monkeypatch.setattr(ap, 'n_wvl_final', 2)
+    monkeypatch.setattr(ap, 'interp_on_read', False)
+    monkeypatch.setattr(sp, 'unit_contrast', True)
+    monkeypatch.setattr(sp, 'grid_size', 4)
+    monkeypatch.setattr(sp, 'focal_mft', False)
+    monkeypatch.setattr(sp, 'save_list', ['atmosphere', 'detector'])
+    monkeypatch.setattr(sp, 'save_specs', {'detector': {'intensity': True}})
+    monkeypatch.setattr(sp, 'fields_storage', None)
+    monkeypatch.setattr(sp, 'fields_codec', None)
+    monkeypatch.setattr(sp, 'startframe', 0)
+    monkeypatch.setattr(sp, 'numframes', 2)
+
+    run = RunMedis.__new__(RunMedis)  # skip the checks __init__ makes so they can be made here
+    run.params = {'ap': ap, 'tp': tp, 'atmp': atmp, 'cp': cdi, 'iop': iop, 'sp': sp, 'mp': mp}
+    run.make_testdir()
+
+    rng = np.random.default_rng(0)
+    shape = (2, 2, 2, 2, 4, 4)  # (t, plane, wvl, body, x, y)
+    bodies = rng.standard_normal(shape) + 1j * rng.standard_normal(shape)
+
+    telescope = Telescope.__new__(Telescope)  # only save_fields is needed, not the prescription set up
+    telescope.sampling = np.ones((2, 2))
+    telescope.save_fields(propagate(bodies, opx.stored_body_scaling()), span=(0, 2))
+    return run, bodies
+
+
+def propagate(bodies, scaling):
+    """ the saved fields of a run whose bodies have amplitudes scaling. The detector is saved as intensity """
+    fields = bodies * scaling[:, np.newaxis, np.newaxis]
+    fields[:, 1] = np.abs(fields[:, 1])**2
+    return fields.astype(np.complex64)
+
+
+def test_contrast_change_reuses_fields(testdir, monkeypatch):
+    run, bodies = testdir
+    monkeypatch.setattr(ap, 'contrast', new_contrast)
+    open(iop.telescope, 'w').close()  # a product made at the old contrast
+
+    assert all(run.check_params().values())
+    assert run.contrast_changed
+
+    run.update_contrast()
+    assert not os.path.exists(iop.telescope)
+    assert os.path.exists(iop.fields)
+    with open(iop.params_logs, 'rb') as handle:
+        assert pickle.load(handle)['ap'].contrast == new_contrast
+
+    direct = propagate(bodies, opx.body_scaling(new_contrast))
+    assert np.allclose(mu.open_obs_sequence_hdf5(iop.fields), direct, rtol=1e-5)
+    with FieldsStore(iop.fields) as store:
+        assert np.allclose(store[:], direct, rtol=1e-5)
+        assert np.allclose(store[:, 1], direct[:, 1], rtol=1e-5)
+
+
+def test_contrast_change_needs_unit_contrast(testdir, monkeypatch):
+    run, bodies = testdir
+    with open(iop.params_logs, 'rb') as handle:
+        loaded = pickle.load(handle)
+    loaded['sp'].unit_contrast = False  # fields made at the old contrast can't be rescaled
+    with open(iop.params_logs, 'wb') as handle:
+        pickle.dump(loaded, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    monkeypatch.setattr(ap, 'contrast', new_contrast)
+
+    assert not run.check_params()['ap']
+    assert not run.contrast_changed